@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+from classes import engine
+from classes.population import UserPopulation
+from classes.consts import THRESHOLD
+
+BASE_ADNETWORKS = ["Unity", "Facebook", "Admob"]
+
+
+def get_adnetwork_names(n_adnetworks):
+    """Returning n_adnetworks ad-network names: the ad-networks of classes.consts.MAX_CAPACITY_PER_ADNETWORK first,
+    then Network3, Network4, ..."""
+
+    return (BASE_ADNETWORKS + [f"Network{i}" for i in range(len(BASE_ADNETWORKS), n_adnetworks)])[:n_adnetworks]
+
+
+def generate_beta_params(n_adnetworks, n_beta_params, beta_spread, max_valuation, rng):
+    """Returning a (ad-networks x n_beta_params x 4) array of "a,b,loc,scale" Beta parameters around the Beta(1, 6)
+    of the synthetic data: a and b are multiplied by exp(U(-beta_spread, beta_spread)) and the ad-networks get
+    different scales, up to max_valuation."""
+
+    params = np.zeros((n_adnetworks, n_beta_params, 4))
+    params[:, :, 0] = np.exp(rng.uniform(-beta_spread, beta_spread, size=(n_adnetworks, n_beta_params)))
+    params[:, :, 1] = 6 * np.exp(rng.uniform(-beta_spread, beta_spread, size=(n_adnetworks, n_beta_params)))
+    params[:, :, 3] = max_valuation * rng.uniform(0.5, 1, size=(n_adnetworks, 1))
+    return params
+
+
+def generate_valuation_matrix(n_users, n_adnetworks=3, n_beta_params=100, beta_spread=0.5, max_valuation=0.1,
+                              mean_impressions=1, seed=None, chunk_size=10 ** 6):
+    """Yielding a synthetic valuation matrix, in the format of data/valuation_folder/synthetic_valuation_matrix.csv,
+    as DataFrame chunks of chunk_size users (so that 10M users never sit in memory at once).
+    Every cell is the "a,b,loc,scale" parameters of a Beta distribution, one of the n_beta_params parameter tuples of
+    its ad-network (see generate_beta_params); a user has 1 + Poisson(mean_impressions - 1) impressions."""
+
+    rng = np.random.default_rng(seed)
+    adnetwork_names = get_adnetwork_names(n_adnetworks)
+    params = generate_beta_params(n_adnetworks, n_beta_params, beta_spread, max_valuation, rng)
+    cells = [np.array([",".join(f"{value:.4g}" for value in cell) for cell in params[n]]) for n in range(n_adnetworks)]
+
+    for start in range(0, n_users, chunk_size):
+        size = min(chunk_size, n_users - start)
+        impressions = 1 + rng.poisson(max(mean_impressions - 1, 0), size=size)
+        chunk = pd.DataFrame({"user_id": np.arange(1000000 + start, 1000000 + start + size),
+                              "impressions": impressions, "revenue": 0, "rpi": 0})
+        for n, adnetwork_name in enumerate(adnetwork_names):
+            chunk[adnetwork_name] = cells[n][rng.integers(n_beta_params, size=size)]
+        yield chunk
+
+
+def save_valuation_matrix(path, n_users, **params):
+    """Writing the valuation matrix of generate_valuation_matrix(n_users, **params) to the csv file path."""
+
+    for i, chunk in enumerate(generate_valuation_matrix(n_users, **params)):
+        chunk.to_csv(path, mode='w' if i == 0 else 'a', header=i == 0, index=False)
+    return path
+
+
+def generate_waterfall(n_ad_units, n_adnetworks=3, max_price=60, users=None):
+    """Returning a waterfall DataFrame, in the format of data/waterfall_data/init_synth_waterfall1.csv, of n_ad_units
+    'High' ad-units whose floor prices go down evenly from max_price (towards 1, by THRESHOLD at most) while the
+    ad-networks take turns, so that two successive ad-units never share an ad-network.
+    With users (a population.UserPopulation), the impressions and revenue of the ad-units are those of a simulation
+    of the users, so the calibration of create_real_users has a consistent target; otherwise they are 0."""
+
+    adnetwork_names = get_adnetwork_names(n_adnetworks)
+    step = min(THRESHOLD, (max_price - 1) / max(n_ad_units - 1, 1))
+    prices = np.round(max_price - step * np.arange(n_ad_units)).astype(int)
+    names = [adnetwork_names[i % n_adnetworks] for i in range(n_ad_units)]
+    ad_unit_names = [f"{name} U{i} ${price}" for i, (name, price) in enumerate(zip(names, prices))]
+    impressions = np.zeros(n_ad_units)
+    revenue = np.zeros(n_ad_units)
+    if users is not None:
+        arrays = engine.WaterfallArrays(prices / 1000,
+                                        np.array([users.adnetwork_names.index(name) for name in names]),
+                                        np.ones(n_ad_units), np.ones(n_ad_units))
+        stats = engine.simulate(arrays, users.valuations, users.impressions, users.scale, users.valuation_sums)
+        impressions, revenue = stats.impressions, stats.revenue
+    return pd.DataFrame({"Section": "High", "Order": np.arange(1, n_ad_units + 1), "Ad unit": ad_unit_names, "RPM": 0,
+                         "Impressions": impressions.astype(int), "Network fill rate": 0,
+                         "Revenue": np.round(revenue, 3), "Network RPM": 0,
+                         "Ad unit id": [f"bench{i}" for i in range(n_ad_units)]})
+
+
+def generate_population(n_users, n_adnetworks=3, n_beta_params=100, beta_spread=0.5, max_valuation=0.1,
+                        mean_impressions=1, seed=None, dtype=np.float64):
+    """Returning a population.UserPopulation drawn directly from the distribution of generate_valuation_matrix
+    (without the csv round trip), for the benchmarks that do not time the parsing."""
+
+    rng = np.random.default_rng(seed)
+    adnetwork_names = get_adnetwork_names(n_adnetworks)
+    params = generate_beta_params(n_adnetworks, n_beta_params, beta_spread, max_valuation, rng)
+    valuations = np.empty((n_users, n_adnetworks), dtype=dtype)
+    for n in range(n_adnetworks):
+        cell = params[n, rng.integers(n_beta_params, size=n_users)]
+        valuations[:, n] = cell[:, 2] + cell[:, 3] * rng.beta(cell[:, 0], cell[:, 1])
+    impressions = 1 + rng.poisson(max(mean_impressions - 1, 0), size=n_users)
+    return UserPopulation(np.arange(n_users), impressions, valuations, adnetwork_names, dtype=dtype)
@@ -0,0 +1,182 @@
+"""Timing the paths of the simulator that get slow in production, on synthetic populations and waterfalls of
+configurable sizes (see benchmarks.generator), e.g.
+    python -m benchmarks.run_benchmarks --users 10000 1000000 --ad-units 3 10 100 --output bench.json
+The results are written as JSON, one record per benchmark and size with the timings of every repeat, together with
+the commit and the environment, so that runs of two commits can be compared:
+    python -m benchmarks.run_benchmarks --compare bench_old.json bench.json"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+from classes.waterfall import Waterfall
+from classes.utils import create_real_users, optimize_factors
+from models.run_algorithms import run_model
+from models.search_and_score import generate_valid_neighbors, validation_single_change
+from benchmarks.generator import get_adnetwork_names, save_valuation_matrix, generate_waterfall, generate_population
+
+BENCHMARKS = ["waterfall_run", "generate_valid_neighbors", "validation_single_change", "create_real_users",
+              "optimize_factors", "run_model_iteration"]
+WATERFALL_BENCHMARKS = {"generate_valid_neighbors", "validation_single_change"}  # not depending on the users
+
+
+def time_call(func, repeats):
+    """Returning the wall-clock seconds of repeats calls of func."""
+
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def get_environment():
+    """Returning the commit (and whether the tree has local changes) and the versions the benchmarks ran with."""
+
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {"commit": git("rev-parse", "HEAD"), "dirty": None if status is None else len(status) > 0,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "numpy": np.__version__, "pandas": pd.__version__, "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+
+
+def run_benchmarks(users_sizes, ad_units_sizes, n_adnetworks=3, benchmarks=BENCHMARKS, repeats=3, seed=0,
+                   generator_params=None, work_dir=None, verbose=True):
+    """Running the benchmarks for every number of users in users_sizes and of ad-units in ad_units_sizes (the
+    benchmarks of WATERFALL_BENCHMARKS only once per number of ad-units) and returning the list of records.
+    generator_params are passed to the generator (n_beta_params, beta_spread, max_valuation, mean_impressions).
+    The generated csv files and the run_model outputs are written to work_dir (a temporary directory if None)."""
+
+    generator_params = {} if generator_params is None else generator_params
+    adnetwork_names = get_adnetwork_names(n_adnetworks)
+    records = []
+
+    def record(benchmark, n_users, n_ad_units, seconds, **extra):
+        records.append({"benchmark": benchmark, "n_users": n_users, "n_ad_units": n_ad_units,
+                        "n_adnetworks": n_adnetworks, "repeats": len(seconds), "seconds": seconds,
+                        "min": min(seconds), "median": float(np.median(seconds)), **extra})
+        if verbose:
+            print(f"{benchmark:26s} users={n_users} ad_units={n_ad_units}: min {min(seconds):.4f}s, "
+                  f"median {np.median(seconds):.4f}s")
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for n_ad_units in ad_units_sizes:
+            waterfall = Waterfall(df=generate_waterfall(n_ad_units, n_adnetworks))
+            if "generate_valid_neighbors" in benchmarks:
+                rng = np.random.default_rng(seed)
+                neighbors = generate_valid_neighbors(waterfall, rng)
+                record("generate_valid_neighbors", None, n_ad_units,
+                       time_call(lambda: generate_valid_neighbors(waterfall, rng), repeats),
+                       n_neighbors=len(neighbors))
+            if "validation_single_change" in benchmarks:
+                record("validation_single_change", None, n_ad_units,
+                       time_call(lambda: [validation_single_change(waterfall, j, waterfall)
+                                          for j in range(len(waterfall.ad_units))], repeats),
+                       n_calls=len(waterfall.ad_units))
+
+        for n_users in users_sizes:
+            population = generate_population(n_users, n_adnetworks, seed=seed, **generator_params)
+            csv_path_users = os.path.join(tmp_dir, f"users_{n_users}.csv")
+            if {"create_real_users", "run_model_iteration"} & set(benchmarks):
+                save_valuation_matrix(csv_path_users, n_users, n_adnetworks=n_adnetworks, seed=seed,
+                                      **generator_params)
+
+            for n_ad_units in ad_units_sizes:
+                waterfall_df = generate_waterfall(n_ad_units, n_adnetworks, users=population)
+                csv_path_waterfall = os.path.join(tmp_dir, f"waterfall_{n_users}_{n_ad_units}.csv")
+                waterfall_df.to_csv(csv_path_waterfall, index=False)
+                waterfall = Waterfall(csv_path=csv_path_waterfall)
+
+                if "waterfall_run" in benchmarks:
+                    record("waterfall_run", n_users, n_ad_units,
+                           time_call(lambda: waterfall.run(population, reset_waterfall=True), repeats))
+                if "optimize_factors" in benchmarks:
+                    record("optimize_factors", n_users, n_ad_units,
+                           time_call(lambda: optimize_factors(population, waterfall,
+                                                              {adnetwork: 1 for adnetwork in adnetwork_names}),
+                                     repeats))
+                if "create_real_users" in benchmarks:
+                    # time the cold path, calibration included: the factors are not cached without cache_dir
+                    record("create_real_users", n_users, n_ad_units,
+                           time_call(lambda: create_real_users(csv_path_users, Waterfall(csv_path=csv_path_waterfall),
+                                                               adnetwork_names, seed=seed),
+                                     repeats))
+                if "run_model_iteration" in benchmarks:
+                    # one S&S iteration (max_evaluations=1 stops after the first batch of neighbors); the first,
+                    # untimed, call fills the population cache so that the parsing is not timed again
+                    save_path = os.path.join(tmp_dir, f"outputs_{n_users}_{n_ad_units}")
+                    os.makedirs(save_path, exist_ok=True)
+
+                    def run_iteration():
+                        run_model(csv_path_waterfall, csv_path_users, "bench", save_path,
+                                  os.path.join(tmp_dir, "log"), 'SandS', adnetwork_names, max_evaluations=1,
+                                  seed=seed)
+                    run_iteration()
+                    record("run_model_iteration", n_users, n_ad_units, time_call(run_iteration, repeats))
+    return records
+
+
+def compare_results(old_path, new_path):
+    """Printing the ratio of the min timings of two JSON result files (> 1 when the new run is faster)."""
+
+    with open(old_path) as fp:
+        old = json.load(fp)
+    with open(new_path) as fp:
+        new = json.load(fp)
+    print(f"old: {old['environment']['commit']}, new: {new['environment']['commit']}")
+    old_records = {(r["benchmark"], r["n_users"], r["n_ad_units"], r["n_adnetworks"]): r for r in old["results"]}
+    for r in new["results"]:
+        key = (r["benchmark"], r["n_users"], r["n_ad_units"], r["n_adnetworks"])
+        if key in old_records:
+            old_min = old_records[key]['min']
+            print(f"{r['benchmark']:26s} users={r['n_users']} ad_units={r['n_ad_units']}: "
+                  f"{old_min:.4f}s -> {r['min']:.4f}s (x{old_min / max(r['min'], 1e-12):.2f})")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[10000, 100000], help="numbers of users")
+    parser.add_argument("--ad-units", type=int, nargs="+", default=[3, 10, 30, 100], help="numbers of ad-units")
+    parser.add_argument("--adnetworks", type=int, default=3, help="number of ad-networks")
+    parser.add_argument("--beta-params", type=int, default=100, help="distinct Beta parameters per ad-network")
+    parser.add_argument("--beta-spread", type=float, default=0.5, help="log-spread of the Beta parameters")
+    parser.add_argument("--max-valuation", type=float, default=0.1, help="largest valuation scale")
+    parser.add_argument("--impressions", type=float, default=1, help="mean impressions per user")
+    parser.add_argument("--benchmarks", nargs="+", default=BENCHMARKS, choices=BENCHMARKS)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", default=None, help="directory of the temporary files")
+    parser.add_argument("--output", default="benchmarks.json", help="JSON file of the results")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two JSON result files and exit")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    generator_params = {"n_beta_params": args.beta_params, "beta_spread": args.beta_spread,
+                        "max_valuation": args.max_valuation, "mean_impressions": args.impressions}
+    config = dict(vars(args), **generator_params)
+    results = run_benchmarks(args.users, args.ad_units, args.adnetworks, args.benchmarks, args.repeats, args.seed,
+                             generator_params, args.work_dir)
+    with open(args.output, "w") as fp:
+        json.dump({"environment": get_environment(), "config": config, "results": results}, fp, indent=2)
+    print(f"results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
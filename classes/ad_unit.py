@@ -1,13 +1,14 @@
 import numpy as np
 
-from classes.consts import DEFAULT_AD_NETWORK_NAME, DEFAULT_AD_UNIT_NAME
+from classes.consts import DEFAULT_AD_NETWORK_NAME, DEFAULT_AD_UNIT_NAME, MED_VALUATION_FACTOR
 
 class AdUnit:
 
     n_ad_unit = 0
 
     def __init__(self, adnetwork_name, ad_unit_name, order=0, section='Auto', price=None,
-                 p_acceptance=1, rpm=0.0, impressions=0, fill_rate=0.0, revenue=0.0, ad_unit_id=None, **kwrgs):
+                 p_acceptance=1, rpm=0.0, impressions=0, fill_rate=0.0, revenue=0.0, ad_unit_id=None, rng=None,
+                 **kwrgs):
 
         self.ad_unit_id = AdUnit.get_next_ad_unit_id(ad_unit_id)
 
@@ -16,7 +17,7 @@ class AdUnit:
         self.order = order
 
         self.section = section
-        self.price = price if price is not None else self.get_initialize_price()
+        self.price = price if price is not None else self.get_initialize_price(rng)
         self.p_acceptance = p_acceptance
 
         self.rpm = float(rpm)
@@ -33,8 +34,8 @@ class AdUnit:
 
         self.kwrgs = kwrgs
 
-    def get_initialize_price(self):
-        return np.random.randint(min(5, 99), 100)
+    def get_initialize_price(self, rng=None):
+        return np.random.randint(min(5, 99), 100) if rng is None else int(rng.integers(min(5, 99), 100))
 
     @staticmethod
     def get_next_ad_unit_id(proposed_ad_unit_id):
@@ -74,13 +75,14 @@ class AdUnit:
     def get_revenue(self):
         return self.revenue
 
-    def ask_impression(self, user):
+    def ask_impression(self, user, rng=None):
         self.views += user.valuations['impressions']
         user_valuation = user.get_valuation(self.adnetwork_name)
         if self.ad_unit_name.find('Med') != -1: #for Admob Med only
-            user_valuation *= 1.1
+            user_valuation *= MED_VALUATION_FACTOR
         price = self.price / 1000
-        if user_valuation is not None and price <= user_valuation and np.random.uniform() < self.p_acceptance:
+        uniform = np.random.uniform() if rng is None else rng.random()  # rng: a numpy Generator
+        if user_valuation is not None and price <= user_valuation and uniform < self.p_acceptance:
             # Accepted impression
             self.impressions += user.valuations['impressions']
             self.revenue += price * user.valuations['impressions']
@@ -0,0 +1,152 @@
+class AdUnitList(list):
+    """The ad-units of a waterfall in waterfall order, with an index of the position of every ad-unit id.
+    The ad-units are changed through splice / move / set_price (or replaced by reset), which update the index in the
+    range that changed instead of re-sorting the list. numbered is set while the order of every ad-unit is its
+    position + 1, and rises counts the successive ad-units whose price goes up, so that when it is 0 (decreasing
+    prices) the position of a price is found by bisection (see find_price_position)."""
+
+    def __init__(self, ad_units=()):
+        super().__init__(ad_units)
+        self.reset()
+
+    def reset(self, ad_units=None, renumber=False):
+        """Replacing the ad-units by ad_units (if given) and rebuilding the index; with renumber the orders of the
+        ad-units are set to their positions."""
+
+        if ad_units is not None:
+            list.__setitem__(self, slice(None), ad_units)
+        if renumber:
+            for i, ad_unit in enumerate(self):
+                ad_unit.order = i + 1
+        self.positions = {ad_unit.ad_unit_id: i for i, ad_unit in enumerate(self)}
+        self.rises = sum(1 for i in range(len(self) - 1) if self.is_rise(i))
+        self.numbered = all(ad_unit.order == i + 1 for i, ad_unit in enumerate(self))
+
+    def is_rise(self, i):
+        return 0 <= i < len(self) - 1 and self[i].price < self[i + 1].price
+
+    def get_position(self, ad_unit_id):
+        """Returning the position of the ad-unit with the given id, None if it is not in the list."""
+
+        return self.positions.get(ad_unit_id)
+
+    def splice(self, start, stop, ad_units, renumber=True):
+        """Replacing the ad-units at positions start to stop by ad_units. With renumber, the orders of the ad-units
+        whose position changed are set to their new position; otherwise the list is no longer numbered."""
+
+        self.rises -= sum(self.is_rise(i) for i in range(start - 1, stop))
+        for ad_unit in self[start:stop]:
+            del self.positions[ad_unit.ad_unit_id]
+        list.__setitem__(self, slice(start, stop), ad_units)
+        end = start + len(ad_units)
+        self.rises += sum(self.is_rise(i) for i in range(start - 1, end))
+        self.update_index(start, end if len(ad_units) == stop - start else len(self), renumber)
+
+    def update_index(self, start, stop, renumber=True):
+        """Updating the positions (and with renumber the orders) of the ad-units at positions start to stop."""
+
+        for i in range(start, stop):
+            ad_unit = self[i]
+            if renumber:
+                ad_unit.order = i + 1
+            self.positions[ad_unit.ad_unit_id] = i
+        self.numbered = self.numbered and renumber
+
+    def move(self, position, new_position):
+        """Moving the ad-unit at position to new_position (a position in the list without it). Only the rises at the
+        two ends of the move change, the ad-units in between are shifted by one."""
+
+        self.rises -= self.is_rise(position - 1) + self.is_rise(position)
+        ad_unit = list.pop(self, position)
+        self.rises += self.is_rise(position - 1)
+        self.rises -= self.is_rise(new_position - 1)
+        list.insert(self, new_position, ad_unit)
+        self.rises += self.is_rise(new_position - 1) + self.is_rise(new_position)
+        self.update_index(min(position, new_position), max(position, new_position) + 1)
+
+    def set_price(self, position, price):
+        """Setting the price of the ad-unit at position (it is not moved)."""
+
+        self.rises -= self.is_rise(position - 1) + self.is_rise(position)
+        self[position].set_price(price)
+        self.rises += self.is_rise(position - 1) + self.is_rise(position)
+
+    def find_price_position(self, price, order_sign=-1, exclude=None):
+        """Returning the position of an ad-unit with price placed as Waterfall.set_ad_unit_order does: above the first
+        ad-unit with the same or a lower price (below it if it has the same price and order_sign=+1), at the bottom
+        if there is none. With exclude, the position is in the list without the ad-unit at position exclude."""
+
+        n = len(self) - (exclude is not None)
+
+        def get_price(v):
+            return self[v if exclude is None or v < exclude else v + 1].price
+
+        rises = self.rises
+        if exclude is not None:  # the rises of the list without the excluded ad-unit
+            rises -= self.is_rise(exclude - 1) + self.is_rise(exclude)
+            rises += 0 < exclude < len(self) - 1 and self[exclude - 1].price < self[exclude + 1].price
+        if rises == 0:
+            low, high = 0, n
+            while low < high:
+                middle = (low + high) // 2
+                if get_price(middle) <= price:
+                    high = middle
+                else:
+                    low = middle + 1
+            k = low
+        else:
+            k = next((v for v in range(n) if get_price(v) <= price), n)
+        if k < n and order_sign > 0 and get_price(k) == price:
+            k += 1
+        return k
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self.reset()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.reset()
+
+    def __iadd__(self, ad_units):
+        list.extend(self, ad_units)
+        self.reset()
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.reset()
+        return self
+
+    def append(self, ad_unit):
+        list.append(self, ad_unit)
+        self.reset()
+
+    def extend(self, ad_units):
+        list.extend(self, ad_units)
+        self.reset()
+
+    def insert(self, position, ad_unit):
+        list.insert(self, position, ad_unit)
+        self.reset()
+
+    def remove(self, ad_unit):
+        list.remove(self, ad_unit)
+        self.reset()
+
+    def pop(self, position=-1):
+        ad_unit = list.pop(self, position)
+        self.reset()
+        return ad_unit
+
+    def clear(self):
+        list.clear(self)
+        self.reset()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.reset()
+
+    def reverse(self):
+        list.reverse(self)
+        self.reset()
@@ -0,0 +1,97 @@
+import os
+import hashlib
+import numpy as np
+
+from classes.population import UserPopulation
+
+
+def get_file_hash(path, chunk_size=2 ** 20):
+    """Returning the sha1 of the content of the file at path."""
+
+    sha = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_cache_key(*parts, **params):
+    """Returning a short key hashing the given parts (file hashes, bytes or strings) and parameters, e.g.
+    get_cache_key(get_file_hash(csv_path), beta_size=1, adnetworks=['Unity', 'Admob'])."""
+
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else str(part).encode())
+    for key in sorted(params):
+        value = params[key]
+        if not isinstance(value, (str, int, float, type(None))):
+            value = list(value)  # e.g. a pandas Index of ad-networks
+        sha.update(f"{key}={value!r};".encode())
+    return sha.hexdigest()[:16]
+
+
+def save_population(cache_dir, key, users):
+    """Saving the population under cache_dir/users_<key>, one .npy file per column so that load_population can
+    memory-map them. The directory is written under a temporary name and renamed, so readers never see a partial
+    entry."""
+
+    path = os.path.join(cache_dir, f"users_{key}")
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    arrays = {"user_ids": users.user_ids, "impressions": users.impressions, "valuations": users.valuations,
+              "adnetwork_names": np.array(users.adnetwork_names), "scale": users.scale}
+    if users.valuation_sums is not None:
+        arrays["valuation_sums"] = users.valuation_sums
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), array)
+    if os.path.exists(path):  # another run cached the same population meanwhile
+        for name in os.listdir(tmp_path):
+            os.remove(os.path.join(tmp_path, name))
+        os.rmdir(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+    return path
+
+
+def load_population(cache_dir, key, mmap_mode='r'):
+    """Returning the population saved by save_population under key (None if it is not cached). With mmap_mode='r'
+    the arrays are memory-mapped instead of read."""
+
+    path = os.path.join(cache_dir, f"users_{key}")
+    if not os.path.isdir(path):
+        return None
+
+    def load(name):
+        file = os.path.join(path, f"{name}.npy")
+        return np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else None
+
+    valuations = load("valuations")
+    return UserPopulation(load("user_ids"), load("impressions"), valuations, load("adnetwork_names").tolist(),
+                          scale=load("scale"), dtype=valuations.dtype, valuation_sums=load("valuation_sums"))
+
+
+def delete_population(cache_dir, key):
+    """Deleting the population saved by save_population under key, if it is cached."""
+
+    path = os.path.join(cache_dir, f"users_{key}")
+    if os.path.isdir(path):
+        for name in os.listdir(path):
+            os.remove(os.path.join(path, name))
+        os.rmdir(path)
+
+
+def save_factors(path, factors):
+    """Saving calibration factors (a dictionary of ad-network -> factor) to an .npz file."""
+
+    with open(path, "wb") as fp:
+        np.savez(fp, adnetwork_names=np.array(list(factors.keys())), factors=np.array(list(factors.values()),
+                                                                                        dtype=float))
+
+
+def load_factors(path):
+    """Loading the calibration factors saved by save_factors, None if there are none."""
+
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return dict(zip(data["adnetwork_names"].tolist(), data["factors"].tolist()))
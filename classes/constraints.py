@@ -0,0 +1,222 @@
+import numpy as np
+from bisect import bisect_left, bisect_right
+
+from classes.consts import THRESHOLD, MAX_PRICE
+
+
+class WaterfallConstraints:
+    """Index of the validity constraints of a sequence of ad-units (the ad-units of a Waterfall or of a
+    waterfall_state.WaterfallState), built once in O(n).
+    The positions of the ad-units of every ad-network are kept sorted (in a valid waterfall they are sorted by price
+    too), so the closest ad-units of the same ad-network above and below any position are found by bisection, and a
+    single change or insertion is checked in O(log n) without scanning or copying the ad-units.
+    An ad-unit with price p between the ad-units prev (above) and next (below) is valid if
+    - p is strictly below the price of the closest ad-unit of its ad-network above it, and strictly above the price
+      of the closest one below it (0 if there is none),
+    - p is within THRESHOLD of the prices of prev and next, and 0 <= p <= MAX_PRICE,
+    - prev and next belong to other ad-networks;
+    an ad-unit alone in its waterfall is always valid (the rules of search_and_score.validation_single_change)."""
+
+    def __init__(self, ad_units):
+        self.ad_units = ad_units
+        self.prices = [ad_unit.price for ad_unit in ad_units]
+        self.adnetworks = [ad_unit.adnetwork_name for ad_unit in ad_units]
+        self.positions = {}  # ad-network -> increasing positions of its ad-units
+        for i, adnetwork in enumerate(self.adnetworks):
+            self.positions.setdefault(adnetwork, []).append(i)
+        self.descending = all(self.prices[i] >= self.prices[i + 1] for i in range(len(self.prices) - 1))
+        # a change of such ad-units is re-sorted by price only (waterfall_state.WaterfallState.sorted_by_price also
+        # handles the 'Auto' section and the 'Cross' ad-network), see is_valid_price_change and is_valid_insert
+        self.sortable = self.descending and 'Cross' not in self.positions and \
+            all(ad_unit.section != 'Auto' for ad_unit in ad_units)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def get_same_adnetwork_prices(self, adnetwork, above, below):
+        """Returning the prices of the closest ad-units of adnetwork at or above the position above and at or below the
+        position below (np.inf and 0 if there are none)."""
+
+        positions = self.positions.get(adnetwork, [])
+        k = bisect_right(positions, above) if above is not None else 0
+        upper = self.prices[positions[k - 1]] if k > 0 else np.inf
+        k = bisect_left(positions, below) if below is not None else len(positions)
+        lower = self.prices[positions[k]] if k < len(positions) else 0
+        return upper, lower
+
+    def check(self, adnetwork, price, prev, next, check_next=True):
+        """Returning whether an ad-unit of adnetwork with price is valid between the ad-units at positions prev and next
+        (None at the top or at the bottom of the waterfall). The ad-units of the same ad-network are looked for above
+        prev and below next; without check_next the price gap and the ad-network of next are not checked."""
+
+        if prev is None and next is None:
+            return True
+        upper, lower = self.get_same_adnetwork_prices(adnetwork, prev, next)
+        if price >= upper or price <= lower or price > MAX_PRICE or price < 0:
+            return False
+        if prev is not None and (abs(price - self.prices[prev]) > THRESHOLD or adnetwork == self.adnetworks[prev]):
+            return False
+        if check_next and next is not None and \
+                (abs(price - self.prices[next]) > THRESHOLD or adnetwork == self.adnetworks[next]):
+            return False
+        return True
+
+    def is_valid_at(self, j):
+        """Returning whether the j-th ad-unit is valid in this waterfall (search_and_score.validation_single_change)."""
+
+        return self.check(self.adnetworks[j], self.prices[j], j - 1 if j > 0 else None,
+                          j + 1 if j + 1 < len(self.prices) else None)
+
+    def is_valid(self):
+        """Returning whether the whole waterfall is valid: every ad-unit but the first is checked against the ad-unit
+        above it and the ad-units of its ad-network (search_and_score.validation_entire_waterfall)."""
+
+        return all(self.check(self.adnetworks[j], self.prices[j], j - 1, j + 1, check_next=False)
+                   for j in range(1, len(self.prices)))
+
+    def is_valid_price_change(self, i, price):
+        """Returning whether setting the price of the i-th ad-unit, and re-sorting the ad-units by price (as
+        waterfall_state.WaterfallState.with_price), gives a waterfall in which the ad-unit now at position i and the
+        changed ad-unit are valid (search_and_score.validation_single_change). Requires sortable.
+        The new order is not built: the changed ad-unit is moved virtually, just before the position r of the first
+        ad-unit it ends up above, and the two checks bisect this index."""
+
+        n = len(self.prices)
+        if (i == 0 or price <= self.prices[i - 1]) and (i + 1 == n or price >= self.prices[i + 1]):  # keeps its slot
+            return self.check(self.adnetworks[i], price, i - 1 if i > 0 else None, i + 1 if i + 1 < n else None)
+        if i > 0 and price > self.prices[i - 1]:  # moves up, above the ad-units with a lower price (stable sort)
+            r = self._bisect(lambda k: self.prices[k] < price, 0, i)
+            new_position = r
+        else:  # moves down, above the ad-units with the same or a lower price
+            r = self._bisect(lambda k: self.prices[k] <= price, i + 1, n)
+            new_position = r - 1
+
+        def get_ad_unit(t):
+            """(state position, adnetwork, price) of the t-th ad-unit of the new order (None as position for the
+            changed ad-unit)."""
+
+            if t == new_position:
+                return None, self.adnetworks[i], price
+            if new_position < i and new_position < t <= i:  # shifted down by the changed ad-unit
+                k = t - 1
+            elif new_position > i and i <= t < new_position:  # shifted up
+                k = t + 1
+            else:
+                k = t
+            return k, self.adnetworks[k], self.prices[k]
+
+        def get_same_adnetwork_price(adnetwork, position, exclude, step):
+            """Price of the closest ad-unit of adnetwork from position (a virtual, half-integer position for the
+            changed ad-unit) in the direction step, in the new order."""
+
+            positions = self.positions.get(adnetwork, [])
+            k = bisect_left(positions, position) - 1 if step < 0 else bisect_right(positions, position)
+            while 0 <= k < len(positions) and positions[k] in (i, exclude):
+                k += step
+            found = positions[k] if 0 <= k < len(positions) else None
+            moved = r - 0.5
+            if adnetwork == self.adnetworks[i] and exclude is not None and \
+                    (moved - position) * step > 0 and (found is None or (found - moved) * step > 0):
+                return price
+            if found is None:
+                return np.inf if step < 0 else 0
+            return self.prices[found]
+
+        def check_at(t):
+            if n == 1:
+                return True
+            k, adnetwork, unit_price = get_ad_unit(t)
+            position = r - 0.5 if k is None else k
+            upper = get_same_adnetwork_price(adnetwork, position, k, -1)
+            lower = get_same_adnetwork_price(adnetwork, position, k, 1)
+            if unit_price >= upper or unit_price <= lower or unit_price > MAX_PRICE or unit_price < 0:
+                return False
+            for other in (t - 1, t + 1):
+                if 0 <= other < n:
+                    _k, other_adnetwork, other_price = get_ad_unit(other)
+                    if abs(unit_price - other_price) > THRESHOLD or adnetwork == other_adnetwork:
+                        return False
+            return True
+
+        return check_at(i) and check_at(new_position)
+
+    def _bisect(self, predicate, low, high):
+        """Returning the first position in [low, high) where predicate holds (high if none), predicate being monotone
+        on the decreasing prices."""
+
+        while low < high:
+            middle = (low + high) // 2
+            if predicate(middle):
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def get_insert_position(self, price):
+        """Returning the position of a new ad-unit with price, above all the ad-units with the same or a lower price
+        (as waterfall_state.WaterfallState.with_insert)."""
+
+        if not self.descending:
+            return next((i for i, p in enumerate(self.prices) if p <= price), len(self.prices))
+        return self._bisect(lambda k: self.prices[k] <= price, 0, len(self.prices))
+
+    def is_valid_insert(self, adnetwork, price, position=None):
+        """Returning whether a new ad-unit of adnetwork with price is valid at position (by default where
+        get_insert_position puts it)."""
+
+        position = self.get_insert_position(price) if position is None else position
+        return self.check(adnetwork, price, position - 1 if position > 0 else None,
+                          position if position < len(self.prices) else None)
+
+    def get_price_interval(self, adnetwork, prev, next):
+        """Returning the (low, high) interval of the integer prices that are valid for an ad-unit of adnetwork between
+        the positions prev and next (see check), None if there are none."""
+
+        if prev is None and next is None:
+            return 0, MAX_PRICE
+        if (prev is not None and adnetwork == self.adnetworks[prev]) or \
+                (next is not None and adnetwork == self.adnetworks[next]):
+            return None
+        upper, lower = self.get_same_adnetwork_prices(adnetwork, prev, next)
+        low, high = max(int(np.floor(lower)) + 1, 0), min(int(np.ceil(upper)) - 1 if upper < np.inf else MAX_PRICE,
+                                                          MAX_PRICE)
+        for neighbor in (prev, next):
+            if neighbor is not None:
+                low = max(low, int(np.ceil(self.prices[neighbor] - THRESHOLD)))
+                high = min(high, int(np.floor(self.prices[neighbor] + THRESHOLD)))
+        return (low, high) if low <= high else None
+
+    def get_slot_interval(self, j):
+        """Returning the interval of the integer prices that are valid for the j-th ad-unit between its current
+        neighbors, and that keep it in its slot (between the prices of its neighbors), None if there are none."""
+
+        prev, next = j - 1 if j > 0 else None, j + 1 if j + 1 < len(self.prices) else None
+        interval = self.get_price_interval(self.adnetworks[j], prev, next)
+        if interval is None:
+            return None
+        low, high = interval
+        if next is not None:
+            low = max(low, int(np.ceil(self.prices[next])))
+        if prev is not None:
+            high = min(high, int(np.floor(self.prices[prev])))
+        return (low, high) if low <= high else None
+
+    def get_insert_intervals(self, adnetwork):
+        """Returning, for every insertion position of a new ad-unit of adnetwork, the interval of the integer prices
+        that are valid there and that put it there (see get_insert_position), as a list of (position, low, high).
+        The prices must be decreasing (see descending)."""
+
+        intervals = []
+        for position in range(len(self.prices) + 1):
+            prev, next = position - 1 if position > 0 else None, position if position < len(self.prices) else None
+            interval = self.get_price_interval(adnetwork, prev, next)
+            if interval is None:
+                continue
+            low, high = interval
+            if next is not None:
+                low = max(low, int(np.ceil(self.prices[next])))
+            if prev is not None:
+                high = min(high, int(np.ceil(self.prices[prev])) - 1)  # equal prices go above prev
+            if low <= high:
+                intervals.append((position, low, high))
+        return intervals
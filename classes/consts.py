@@ -7,12 +7,28 @@ DF_COLUMNS = ["adnetwork_name", "ad_unit_name", "order", "section", "price", "rp
 
 MAX_PRICE = 150
 THRESHOLD = 30 # maximal difference in price between two successive ad-units
+MED_VALUATION_FACTOR = 1.1 # users valuations are boosted by this factor for mediation ('Med') ad-units
 
 # For search and score
 VALIDATION = 1  # number of cross validation
 MAX_ITER = 40
 EPSILON = 0.1 # minimum improvement required in $$
 
+# For Monte-Carlo tree search
+N_SIMULATIONS = 100 # number of simulations (selection, expansion, rollout, backpropagation) per iteration
+ROLLOUT_DEPTH = 2 # number of moves of a rollout
+ROLLOUT_WIDTH = 4 # number of random neighbors scored at each move of a heuristic rollout
+EXPLORATION = 2 ** 0.5 # UCT exploration constant, rewards are normalized to [0, 1]
+
+# For racing neighbors on user subsamples
+RACING_FRACTIONS = (0.05, 0.2) # growing shares of the users a neighbor is scored on before the full population
+RACING_CONFIDENCE = 0.99 # a neighbor is dropped if it is below the incumbent with this (one-sided) confidence
+
+# For incremental re-optimization on a stream of valuation batches
+INCREMENTAL_WINDOW = 24 # number of batches kept in the population, older batches age out
+INCREMENTAL_GRID = (1.0, 0.96, 1.04) # relative steps of the calibration factors per update (the current one first)
+INCREMENTAL_FULL_EVERY = 24 # the neighbors of the optimum are re-scored on the whole population every so many updates
+
 MAX_CAPACITY_PER_ADNETWORK = {"Unity": 1,
                               "Facebook": 1,
                               "Admob": 1}
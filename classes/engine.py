@@ -0,0 +1,239 @@
+import numpy as np
+from collections import namedtuple
+
+from classes.consts import MED_VALUATION_FACTOR
+
+# Array representation of a waterfall (one entry per ad-unit, in waterfall order):
+# prices - floor prices in $ per impression (price / 1000),
+# adnetwork_idx - column of the ad-unit's ad-network in the valuation matrix (-1 if the ad-network has no column),
+# multipliers - factor applied to users valuations (MED_VALUATION_FACTOR for 'Med' ad-units, 1 otherwise),
+# p_acceptance - probability of accepting a user whose valuation is above the floor price.
+WaterfallArrays = namedtuple("WaterfallArrays", ["prices", "adnetwork_idx", "multipliers", "p_acceptance"])
+
+# Result of running a population through a waterfall. views, impressions, revenue and opt_revenue hold one entry per
+# ad-unit; capture holds, per user, the position of the ad-unit that bought the user (number of ad-units if none).
+SimulationStats = namedtuple("SimulationStats", ["views", "impressions", "revenue", "opt_revenue", "capture"])
+
+
+def get_rng(rng=None):
+    """Returning rng, or if it is None a numpy Generator seeded from the legacy global numpy generator, so that the
+    calls without a Generator are reproducible with np.random.seed (and resumed with its state, see
+    run_algorithms.save_checkpoint)."""
+
+    return np.random.default_rng(np.random.randint(2 ** 32, dtype=np.int64)) if rng is None else rng
+
+
+class CommonRandomNumbers:
+    """Acceptance uniforms of every user at every waterfall slot (position), drawn once and reused by all the
+    simulated waterfalls, so that candidates are compared under the same acceptance noise (common random numbers).
+    seed is an int, a numpy SeedSequence or None (fresh entropy). The uniforms of slot s are drawn from the stream of
+    spawn key (0, s) under seed (see get_stream), so any process given the same seed rebuilds exactly the same uniforms,
+    and slots are only drawn when a waterfall first reaches them."""
+
+    def __init__(self, n_users, seed=None):
+        self.n_users = n_users
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.columns = []
+
+    def get_stream(self, *key):
+        """Returning the numpy Generator of the independent stream of spawn key key under the seed. Keys (0, s) are
+        the uniforms of slot s, other keys are free for other streams derived from the same seed."""
+
+        return np.random.default_rng(np.random.SeedSequence(self.seed_sequence.entropy,
+                                                            spawn_key=self.seed_sequence.spawn_key + key))
+
+    def get(self, index, start, n_slots):
+        """Returning the (users x slots) uniforms of the users at positions index, for slots start to
+        start + n_slots."""
+
+        while len(self.columns) < start + n_slots:
+            self.columns.append(self.get_stream(0, len(self.columns)).random(self.n_users))
+        return np.column_stack([self.columns[slot][index] for slot in range(start, start + n_slots)]) \
+            if n_slots > 0 else np.zeros((len(index), 0))
+
+
+def get_waterfall_arrays(ad_units, adnetwork_names):
+    """Turning a list of ad-units into WaterfallArrays, where adnetwork_names are the ordered columns of the valuation
+    matrix."""
+
+    columns = {adnetwork_name: i for i, adnetwork_name in enumerate(adnetwork_names)}
+    prices = np.array([ad_unit.price for ad_unit in ad_units], dtype=float) / 1000
+    adnetwork_idx = np.array([columns.get(ad_unit.adnetwork_name, -1) for ad_unit in ad_units], dtype=int)
+    multipliers = np.array([MED_VALUATION_FACTOR if ad_unit.ad_unit_name.find('Med') != -1 else 1.0
+                            for ad_unit in ad_units], dtype=float)
+    p_acceptance = np.array([ad_unit.p_acceptance for ad_unit in ad_units], dtype=float)
+    return WaterfallArrays(prices, adnetwork_idx, multipliers, p_acceptance)
+
+
+def simulate(arrays, valuations, impressions, scale=None, valuation_sums=None, uniforms=None, rng=None):
+    """Running all users (rows of the valuations matrix, weighted by impressions) through the waterfall arrays.
+    Every user falls through the ad-units top-down and is bought by the first ad-unit whose floor price is below the
+    user's (multiplied) valuation, exactly as in AdUnit.ask_impression.
+    scale is an optional per ad-network factor applied to the valuations columns (see UserPopulation.scale).
+    valuation_sums, if given, holds per row the sum of valuation * impressions of all users merged into the row (see
+    UserPopulation.compress) and is used for opt_revenue instead of valuation * impressions.
+    An ad-unit with p_acceptance < 1 accepts a user only if its uniform is below p_acceptance: uniforms is an optional
+    (users x ad-units) matrix of these uniforms (see CommonRandomNumbers), otherwise they are drawn from the numpy
+    Generator rng."""
+
+    n_users = valuations.shape[0]
+    n_ad_units = len(arrays.prices)
+
+    views = np.zeros(n_ad_units, dtype=impressions.dtype)
+    accepted_impressions = np.zeros(n_ad_units, dtype=impressions.dtype)
+    revenue = np.zeros(n_ad_units)
+    opt_revenue = np.zeros(n_ad_units)
+    capture = np.full(n_users, n_ad_units)
+
+    active = np.arange(n_users)  # users that were not bought by any ad-unit so far
+    for i in range(n_ad_units):
+        if len(active) == 0:
+            break
+        active_impressions = impressions[active]
+        views[i] = active_impressions.sum()
+        if arrays.adnetwork_idx[i] < 0:
+            continue
+        user_valuations = valuations[active, arrays.adnetwork_idx[i]].astype(float)
+        if scale is not None:
+            user_valuations *= scale[arrays.adnetwork_idx[i]]
+        user_valuations *= arrays.multipliers[i]
+        accept = arrays.prices[i] <= user_valuations  # NaN (no valuation) is never accepted
+        if arrays.p_acceptance[i] < 1:
+            if uniforms is None:
+                rng = get_rng(rng)
+                accept &= rng.random(len(active)) < arrays.p_acceptance[i]
+            else:
+                accept &= uniforms[active, i] < arrays.p_acceptance[i]
+        accepted_impressions[i] = active_impressions[accept].sum()
+        revenue[i] = arrays.prices[i] * accepted_impressions[i]
+        if valuation_sums is None:
+            opt_revenue[i] = (user_valuations[accept] * active_impressions[accept]).sum()
+        else:
+            opt_revenue[i] = valuation_sums[active[accept], arrays.adnetwork_idx[i]].sum() * arrays.multipliers[i]
+            if scale is not None:
+                opt_revenue[i] *= scale[arrays.adnetwork_idx[i]]
+        capture[active[accept]] = i
+        active = active[~accept]
+
+    return SimulationStats(views, accepted_impressions, revenue, opt_revenue, capture)
+
+
+def apply_stats(ad_units, stats):
+    """Adding the simulation statistics to the ad-units fields (views, impressions, revenue and opt_revenue)."""
+
+    for i, ad_unit in enumerate(ad_units):
+        ad_unit.views += stats.views[i].item()
+        ad_unit.impressions += stats.impressions[i].item()
+        ad_unit.revenue += stats.revenue[i].item()
+        ad_unit.opt_revenue += stats.opt_revenue[i].item()
+
+
+def stack_waterfall_arrays(arrays_list):
+    """Stacking the WaterfallArrays of many waterfalls into (waterfalls x ad-units) matrices.
+    Shorter waterfalls are padded with ad-units that never accept a user; also returning the waterfalls lengths."""
+
+    lengths = np.array([len(arrays.prices) for arrays in arrays_list], dtype=int)
+    shape = (len(arrays_list), max(lengths.max(initial=0), 1))
+    prices = np.full(shape, np.inf)
+    adnetwork_idx = np.full(shape, -1)
+    multipliers = np.ones(shape)
+    p_acceptance = np.ones(shape)
+    for i, arrays in enumerate(arrays_list):
+        prices[i, :lengths[i]] = arrays.prices
+        adnetwork_idx[i, :lengths[i]] = arrays.adnetwork_idx
+        multipliers[i, :lengths[i]] = arrays.multipliers
+        p_acceptance[i, :lengths[i]] = arrays.p_acceptance
+    return WaterfallArrays(prices, adnetwork_idx, multipliers, p_acceptance), lengths
+
+
+def get_acceptance_uniforms(uniforms, users, i, n_waterfalls, n_users, rng):
+    """Returning the (waterfalls x users) acceptance uniforms of slot i: the common uniforms[users, i] of all
+    waterfalls, or independent draws from rng if uniforms is None."""
+
+    if uniforms is None:
+        return get_rng(rng).random((n_waterfalls, n_users))
+    return np.broadcast_to(uniforms[users, i], (n_waterfalls, n_users))
+
+
+def simulate_many(arrays_list, valuations, impressions, scale=None, valuation_sums=None, max_cells=2 ** 22,
+                  uniforms=None, rng=None):
+    """Running all users through many waterfalls at once and returning a list of SimulationStats (without capture),
+    one per waterfall. Users are processed in chunks so that at most max_cells (waterfall, user) pairs are held in
+    memory at a time, i.e. a whole batch of candidates costs about one scan of the population.
+    uniforms (users x ad-units of the longest waterfall) and rng are used as in simulate; with uniforms, all the
+    waterfalls see the same acceptance noise."""
+
+    stacked, lengths = stack_waterfall_arrays(arrays_list)
+    n_waterfalls, n_ad_units = stacked.prices.shape
+    n_users = valuations.shape[0]
+    scale = np.ones(valuations.shape[1]) if scale is None else scale
+
+    views = np.zeros((n_waterfalls, n_ad_units), dtype=impressions.dtype)
+    accepted_impressions = np.zeros((n_waterfalls, n_ad_units), dtype=impressions.dtype)
+    opt_revenue = np.zeros((n_waterfalls, n_ad_units))
+
+    has_adnetwork = stacked.adnetwork_idx >= 0
+    columns = np.where(has_adnetwork, stacked.adnetwork_idx, 0)
+    chunk_size = max(1, max_cells // max(n_waterfalls, 1))
+    for start in range(0, n_users, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_users))
+        chunk_valuations = valuations[chunk].astype(float)
+        chunk_impressions = impressions[chunk]
+        remaining = np.ones((n_waterfalls, len(chunk_impressions)), dtype=bool)
+        for i in range(n_ad_units):
+            if not remaining.any():
+                break
+            views[:, i] += np.where(remaining, chunk_impressions, 0).sum(axis=1)
+            user_valuations = chunk_valuations[:, columns[:, i]].T  # (waterfalls x users)
+            user_valuations *= scale[columns[:, i], None]
+            user_valuations *= stacked.multipliers[:, i, None]
+            accept = remaining & has_adnetwork[:, i, None] & (stacked.prices[:, i, None] <= user_valuations)
+            random_acceptance = stacked.p_acceptance[:, i] < 1
+            if random_acceptance.any():
+                accept[random_acceptance] &= get_acceptance_uniforms(uniforms, chunk, i, random_acceptance.sum(),
+                                                                     accept.shape[1], rng) < \
+                                             stacked.p_acceptance[random_acceptance, i, None]
+            accepted_impressions[:, i] += np.where(accept, chunk_impressions, 0).sum(axis=1)
+            if valuation_sums is None:
+                opt_revenue[:, i] += np.where(accept, user_valuations * chunk_impressions, 0).sum(axis=1)
+            else:
+                chunk_sums = valuation_sums[chunk][:, columns[:, i]].T
+                opt_revenue[:, i] += np.where(accept, chunk_sums, 0).sum(axis=1) * scale[columns[:, i]] * \
+                                     stacked.multipliers[:, i]
+            remaining &= ~accept
+
+    revenue = np.where(np.isfinite(stacked.prices), stacked.prices, 0) * accepted_impressions
+    return [SimulationStats(views[j, :lengths[j]], accepted_impressions[j, :lengths[j]], revenue[j, :lengths[j]],
+                            opt_revenue[j, :lengths[j]], None) for j in range(n_waterfalls)]
+
+
+def simulate_user_revenue(arrays_list, valuations, impressions, scale=None, uniforms=None, rng=None):
+    """Running all users through many waterfalls and returning a (waterfalls x users) matrix of the revenue that each
+    waterfall gets from each user (floor price of the ad-unit that bought the user times its impressions, 0 if no
+    ad-unit bought it). Meant for small user samples: the whole matrix is held in memory.
+    uniforms and rng are used as in simulate_many."""
+
+    stacked, _ = stack_waterfall_arrays(arrays_list)
+    n_waterfalls, n_ad_units = stacked.prices.shape
+    scale = np.ones(valuations.shape[1]) if scale is None else scale
+    valuations = valuations.astype(float)
+
+    has_adnetwork = stacked.adnetwork_idx >= 0
+    columns = np.where(has_adnetwork, stacked.adnetwork_idx, 0)
+    revenue = np.zeros((n_waterfalls, len(impressions)))
+    remaining = np.ones((n_waterfalls, len(impressions)), dtype=bool)
+    for i in range(n_ad_units):
+        if not remaining.any():
+            break
+        user_valuations = valuations[:, columns[:, i]].T  # (waterfalls x users)
+        user_valuations *= scale[columns[:, i], None]
+        user_valuations *= stacked.multipliers[:, i, None]
+        accept = remaining & has_adnetwork[:, i, None] & (stacked.prices[:, i, None] <= user_valuations)
+        random_acceptance = stacked.p_acceptance[:, i] < 1
+        if random_acceptance.any():
+            accept[random_acceptance] &= get_acceptance_uniforms(uniforms, slice(None), i, random_acceptance.sum(),
+                                                                 accept.shape[1], rng) < \
+                                         stacked.p_acceptance[random_acceptance, i, None]
+        revenue[accept] = (stacked.prices[:, i, None] * impressions)[accept]
+        remaining &= ~accept
+    return revenue
@@ -0,0 +1,99 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+class RunCallback:
+    """Hooks called by run_model with the run's RunMetrics and keyword arguments describing the event. Subclasses
+    override the events they need; any object with some of these methods can be used as a callback too.
+    - on_run_start(metrics, alg, waterfall_name)
+    - on_iteration(metrics, iteration, revenue, n_neighbors): after every search iteration
+    - on_adopt(metrics, iteration, revenue, waterfall): when the search adopts a better waterfall
+    - on_run_end(metrics, revenue)"""
+
+    def on_run_start(self, metrics, **info):
+        pass
+
+    def on_iteration(self, metrics, **info):
+        pass
+
+    def on_adopt(self, metrics, **info):
+        pass
+
+    def on_run_end(self, metrics, **info):
+        pass
+
+
+class RunMetrics:
+    """Timers and counters of a run.
+    phase(name) times a block and accumulates its seconds and number of calls per name (phases may be nested, each
+    one counts its own time); add(name, n) increments a counter and set(name, value) records a value. With
+    track_memory, the peak memory traced by tracemalloc between start and stop is recorded (tracing slows the run
+    down). callbacks are notified of the run events (see RunCallback)."""
+
+    def __init__(self, track_memory=False, callbacks=None):
+        self.track_memory = track_memory
+        self.callbacks = list(callbacks) if callbacks is not None else []
+        self.phases = {}
+        self.counters = {}
+        self.values = {}
+        self.start_time = None
+        self.seconds = None
+        self.peak_memory = None
+        self.started_tracing = False
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        if self.track_memory:
+            self.started_tracing = not tracemalloc.is_tracing()
+            if self.started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+        return self
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.start_time
+        if self.track_memory:
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            if self.started_tracing:
+                tracemalloc.stop()
+        return self
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds, calls = self.phases.get(name, (0.0, 0))
+            self.phases[name] = (seconds + time.perf_counter() - start, calls + 1)
+
+    def add(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def notify(self, event, **info):
+        for callback in self.callbacks:
+            hook = getattr(callback, f"on_{event}", None)
+            if hook is not None:
+                hook(self, **info)
+
+    def to_dict(self):
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self.start_time
+        evaluations = self.counters.get("evaluations", 0)
+        return {"seconds": seconds,
+                "phases": {name: {"seconds": phase_seconds, "calls": calls}
+                           for name, (phase_seconds, calls) in self.phases.items()},
+                "counters": dict(self.counters),
+                "evaluations_per_second": evaluations / seconds if seconds > 0 else None,
+                "peak_memory_bytes": self.peak_memory,
+                **self.values}
+
+    def save(self, path):
+        """Writing the metrics to the JSON file path."""
+
+        with open(path, "w") as fp:
+            json.dump(self.to_dict(), fp, indent=2, default=str)
@@ -0,0 +1,178 @@
+import hashlib
+import numpy as np
+
+from classes.user import User
+from classes.consts import MAX_PRICE, MED_VALUATION_FACTOR
+
+
+class UserPopulation:
+    """Columnar store of users: user ids, impression weights and a (users x ad-networks) valuation matrix, kept in
+    contiguous numpy arrays instead of one user.User object per user.
+    scale is a per ad-network factor applied to the valuations on read, so scaled populations share the same arrays.
+    valuation_sums is set only for compressed populations (see compress): per row and ad-network, the sum of
+    valuation * impressions over all the users merged into that row."""
+
+    def __init__(self, user_ids, impressions, valuations, adnetwork_names, scale=None, dtype=np.float64,
+                 valuation_sums=None):
+        self.user_ids = np.ascontiguousarray(user_ids)
+        self.impressions = np.ascontiguousarray(impressions)
+        self.valuations = np.ascontiguousarray(valuations, dtype=dtype).reshape(len(self.user_ids), -1)
+        self.adnetwork_names = list(adnetwork_names)
+        self.scale = np.ones(len(self.adnetwork_names)) if scale is None else np.array(scale, dtype=float)
+        self.valuation_sums = None if valuation_sums is None else np.ascontiguousarray(valuation_sums, dtype=float)
+
+        assert self.valuations.shape[1] == len(self.adnetwork_names), \
+            "valuations must have one column per ad-network"
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __repr__(self):
+        return f"UserPopulation: {len(self)} users, ad-networks: {self.adnetwork_names}, " \
+               f"scale: {dict(zip(self.adnetwork_names, self.scale.tolist()))}"
+
+    @staticmethod
+    def from_users(users, adnetwork_names=None, dtype=np.float64):
+        """Adapter for code that still holds a list of user.User objects (or a dictionary of user_id -> valuations).
+        Valuations missing for some ad-network are stored as NaN, i.e. never accepted."""
+
+        if type(users) == dict:
+            users = [User(user_id=user_id, valuations=users[user_id]) for user_id in users]
+        if adnetwork_names is None:
+            adnetwork_names = list(dict.fromkeys(adnetwork_name for user in users for adnetwork_name in user.valuations
+                                                 if adnetwork_name != 'impressions'))
+
+        user_ids = [user.user_id for user in users]
+        impressions = [user.valuations['impressions'] for user in users]
+        valuations = [[np.nan if user.get_valuation(adnetwork_name) is None else user.get_valuation(adnetwork_name)
+                       for adnetwork_name in adnetwork_names] for user in users]
+        return UserPopulation(user_ids, impressions, np.array(valuations, dtype=float).reshape(len(users), -1),
+                              adnetwork_names, dtype=dtype)
+
+    def to_users(self):
+        """Returning the (scaled) population as a list of user.User objects."""
+
+        valuations = self.get_valuations()
+        users = []
+        for user_id, user_impressions, user_valuations in zip(self.user_ids, self.impressions, valuations):
+            user_valuations = {adnetwork_name: value for adnetwork_name, value in zip(self.adnetwork_names,
+                                                                                      user_valuations.tolist())
+                               if not np.isnan(value)}
+            user_valuations['impressions'] = user_impressions
+            users.append(User(user_id=user_id, adnetwork_names=self.adnetwork_names, valuations=user_valuations))
+        return users
+
+    def get_valuations(self):
+        """Returning the scaled valuations matrix (a new float64 array)."""
+
+        return self.valuations.astype(float) * self.scale
+
+    def get_valuation_column(self, adnetwork_name):
+        """Returning the scaled valuations of all users for a single ad-network."""
+
+        i = self.adnetwork_names.index(adnetwork_name)
+        return self.valuations[:, i].astype(float) * self.scale[i]
+
+    def scaled(self, factors):
+        """Returning a view of the population with its valuations multiplied by factors, a dictionary mapping ad-network
+        to a scaling factor (ad-networks that are not in factors keep their current scale).
+        The view shares the ids, impressions and valuations arrays with this population, nothing is copied."""
+
+        scale = self.scale * np.array([factors.get(adnetwork_name, 1) for adnetwork_name in self.adnetwork_names],
+                                      dtype=float)
+        return UserPopulation(self.user_ids, self.impressions, self.valuations, self.adnetwork_names, scale=scale,
+                              dtype=self.valuations.dtype, valuation_sums=self.valuation_sums)
+
+    def subset(self, index):
+        """Returning the population of the users selected by index (a boolean mask or an array of positions)."""
+
+        valuation_sums = None if self.valuation_sums is None else self.valuation_sums[index]
+        return UserPopulation(self.user_ids[index], self.impressions[index], self.valuations[index],
+                              self.adnetwork_names, scale=self.scale, dtype=self.valuations.dtype,
+                              valuation_sums=valuation_sums)
+
+    @staticmethod
+    def concat(populations):
+        """Returning the population of the users of all the populations, which have the same ad-networks and scale
+        (e.g. the uncalibrated batches of a stream)."""
+
+        first = populations[0]
+        valuation_sums = None if any(users.valuation_sums is None for users in populations) else \
+            np.concatenate([users.valuation_sums for users in populations])
+        return UserPopulation(np.concatenate([users.user_ids for users in populations]),
+                              np.concatenate([users.impressions for users in populations]),
+                              np.concatenate([users.valuations for users in populations]), first.adnetwork_names,
+                              scale=first.scale, dtype=first.valuations.dtype, valuation_sums=valuation_sums)
+
+    def compress(self, max_price=MAX_PRICE):
+        """Collapsing the population into its unique joint price-grid cells.
+        Floor prices are whole dollars between 0 and max_price and a user is accepted iff price / 1000 <= valuation
+        (times MED_VALUATION_FACTOR for 'Med' ad-units), so users whose valuations fall between the same two grid
+        prices, for both multipliers and in every ad-network, get exactly the same accept/reject decisions. Each cell is
+        represented by the valuations of one of its users, weighted by the impressions of all of them, and keeps the
+        exact sum of valuation * impressions for opt_revenue.
+        The compressed population is lossless for integer floor prices in [0, max_price] and for the current scale
+        (check the prices with is_on_price_grid); compress after the calibration factors are applied. The
+        representatives are kept in float64 whatever the dtype of the population, as a float32 representative of a
+        scaled valuation may round into a neighboring cell.
+        It is not lossless for ad-units with p_acceptance < 1: a cell draws one uniform for all of its users, so its
+        revenue is only equal in expectation (get_users does not compress for such waterfalls, nor for waterfalls off
+        the price grid)."""
+
+        valuations = self.get_valuations()
+        grid = np.arange(max_price + 1) / 1000
+        buckets = []
+        for multiplier in (1.0, MED_VALUATION_FACTOR):
+            bucket = np.searchsorted(grid, valuations * multiplier, side='right')  # number of grid prices accepted
+            bucket[np.isnan(valuations)] = -1
+            buckets.append(bucket)
+        _, first_user, cell = np.unique(np.hstack(buckets), axis=0, return_index=True, return_inverse=True)
+        cell = cell.reshape(-1)
+        n_cells = len(first_user)
+
+        impressions = np.bincount(cell, weights=self.impressions, minlength=n_cells)
+        if np.issubdtype(self.impressions.dtype, np.integer):
+            impressions = impressions.astype(self.impressions.dtype)
+        weighted_valuations = np.nan_to_num(valuations) * self.impressions[:, None]
+        valuation_sums = np.column_stack([np.bincount(cell, weights=weighted_valuations[:, j], minlength=n_cells)
+                                          for j in range(len(self.adnetwork_names))])
+
+        return UserPopulation(np.arange(n_cells), impressions, valuations[first_user], self.adnetwork_names,
+                              dtype=np.float64, valuation_sums=valuation_sums)
+
+    def get_signature(self):
+        """Returning a content hash of the population as seen by the simulation (impressions, valuations,
+        valuation_sums and scale), so that scaled views with other factors get another signature."""
+
+        sha = hashlib.sha1()
+        for array in (self.impressions, self.valuations, self.valuation_sums, self.scale):
+            if array is not None:
+                sha.update(str(array.dtype).encode())
+                sha.update(array.tobytes())
+        return sha.hexdigest()
+
+    def save(self, path):
+        """Saving the population to an uncompressed .npz file."""
+
+        arrays = {} if self.valuation_sums is None else {"valuation_sums": self.valuation_sums}
+        with open(path, "wb") as fp:
+            np.savez(fp, user_ids=self.user_ids, impressions=self.impressions, valuations=self.valuations,
+                     adnetwork_names=np.array(self.adnetwork_names), scale=self.scale, **arrays)
+
+    @staticmethod
+    def load(path):
+        """Loading a population saved by UserPopulation.save."""
+
+        with np.load(path) as data:
+            return UserPopulation(data["user_ids"], data["impressions"], data["valuations"],
+                                  data["adnetwork_names"].tolist(), scale=data["scale"],
+                                  dtype=data["valuations"].dtype,
+                                  valuation_sums=data["valuation_sums"] if "valuation_sums" in data else None)
+
+
+def is_on_price_grid(prices, max_price=MAX_PRICE):
+    """Returning whether all the floor prices are whole dollars between 0 and max_price, the prices for which
+    UserPopulation.compress is lossless."""
+
+    prices = np.asarray(prices, dtype=float)
+    return bool(np.all((prices == np.round(prices)) & (prices >= 0) & (prices <= max_price)))
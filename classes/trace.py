@@ -0,0 +1,106 @@
+import json
+import time
+import queue
+import logging
+import logging.handlers
+
+from classes.waterfall import Waterfall
+
+
+class _RecordQueueHandler(logging.handlers.QueueHandler):
+    """Queue handler putting the records on the queue as they are: the trace records are dictionaries serialized
+    by the listener thread, so the search only pays for building them."""
+
+    def prepare(self, record):
+        return record
+
+
+class _JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.msg, default=str)
+
+
+class _WaterfallDump:
+    """Log message argument rendering the DataFrame of a waterfall only if the record is formatted, i.e. if the log
+    level lets it through."""
+
+    __slots__ = ("waterfall",)
+
+    def __init__(self, waterfall):
+        self.waterfall = waterfall
+
+    def __str__(self):
+        return self.waterfall.get_df().to_string()
+
+
+class TraceWriter:
+    """Append-only JSONL trace of a search: one compact record per line (see start, adopt, iteration and end), with
+    the changes of an adopted waterfall instead of the whole waterfall.
+    The records are put on a queue and written by a background logging.handlers.QueueListener, so the search never
+    waits for the file. Full waterfall DataFrames are rendered in the log only by dump, either on demand or every
+    dump_every iterations (see should_dump)."""
+
+    def __init__(self, path, dump_every=None):
+        self.path = path
+        self.dump_every = dump_every
+        self.queue = queue.SimpleQueue()
+        self.handler = logging.FileHandler(path, mode='a')
+        self.handler.setFormatter(_JsonFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, self.handler)
+        self.listener.start()
+        self.queue_handler = _RecordQueueHandler(self.queue)
+        self.logger = logging.getLogger(f"trace.{path}")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False  # the records go to the trace only, not to the log of the run
+        self.logger.addHandler(self.queue_handler)
+
+    def record(self, event, **fields):
+        self.logger.info({"event": event, "time": time.time(), **fields})
+
+    def start(self, waterfall, revenue, **fields):
+        """Recording the initial waterfall, as (ad_unit_id, adnetwork, ad-unit name, section, price) rows, and its
+        revenue."""
+
+        self.record("start", revenue=revenue, **fields,
+                    waterfall=[[ad_unit.ad_unit_id, ad_unit.adnetwork_name, ad_unit.ad_unit_name, ad_unit.section,
+                                int(ad_unit.price)] for ad_unit in waterfall.ad_units])
+
+    def adopt(self, iteration, evaluations, revenue, old_waterfall, waterfall):
+        """Recording the adoption of waterfall, by its changes from old_waterfall (see Waterfall.get_changes) as
+        (old_order, name, new_price, new_order) rows: -1 as old order for an insertion, -1 as new order for a
+        deletion."""
+
+        changes = [[int(old_order), name, int(price), int(order)]
+                   for old_order, name, price, order, _ad_unit in Waterfall.get_changes(old_waterfall, waterfall)]
+        self.record("adopt", iteration=iteration, evaluations=evaluations, revenue=revenue, changes=changes)
+
+    def iteration(self, iteration, evaluations, revenue, **fields):
+        self.record("iteration", iteration=iteration, evaluations=evaluations, revenue=revenue, **fields)
+
+    def end(self, revenue, **fields):
+        self.record("end", revenue=revenue, **fields)
+
+    def should_dump(self, iteration):
+        return self.dump_every is not None and iteration % self.dump_every == 0
+
+    @staticmethod
+    def dump(waterfall, label='waterfall'):
+        """Logging the full DataFrame of waterfall in the log of the run, rendered only if the INFO records are
+        written (also used before a trace is open, as TraceWriter.dump)."""
+
+        logging.info('%s - %s', label, _WaterfallDump(waterfall))
+
+    def close(self):
+        """Writing the queued records and closing the file."""
+
+        self.logger.removeHandler(self.queue_handler)
+        self.listener.stop()
+        self.handler.close()
+
+
+def read_trace(path):
+    """Returning the records of the JSONL trace at path, as a list of dictionaries."""
+
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
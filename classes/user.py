@@ -2,18 +2,20 @@ import numpy as np
 import pprint
 
 from classes.consts import DEFAULT_AD_NETWORK_NAME
+from classes.engine import get_rng
 
 class User:
 
     def __init__(self, user_id, adnetwork_names=None, beta_param=None, max_price=1, valuations=None,
-                 constant_valuation=False, use_default_ad_network=False):
+                 constant_valuation=False, use_default_ad_network=False, rng=None):
         self.user_id = user_id
         self.adnetwork_names = adnetwork_names if adnetwork_names is not None else list(valuations.keys())
         self.beta_param = beta_param
         self.constant_valuation = constant_valuation
         self.max_price = max_price
+        self.rng = get_rng(rng)
 
-        self.default_valuation = 0 if self.beta_param is None else np.random.beta(*self.beta_param) * self.max_price
+        self.default_valuation = 0 if self.beta_param is None else self.rng.beta(*self.beta_param) * self.max_price
 
         # Use default ad-network with price 0 to capture every user that is not captured by any other ad-network.
         self.use_default_ad_network = use_default_ad_network
@@ -32,7 +34,7 @@ class User:
         if self.constant_valuation:
             return self.default_valuation
         else:
-            return np.random.beta(*self.beta_param) * self.max_price
+            return self.rng.beta(*self.beta_param) * self.max_price
 
     def get_valuation(self, adnetworks_name):
         return self.valuations.get(adnetworks_name)
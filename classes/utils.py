@@ -1,120 +1,160 @@
 import numpy as np
 import pandas as pd
-import copy
-import pickle
 import os
 import logging
 
-from scipy.stats import beta
+from classes import engine
 from classes.ad_unit import AdUnit
-from classes.user import User
-from classes.consts import MAX_CAPACITY_PER_ADNETWORK
+from classes.population import UserPopulation
+from classes.cache import get_cache_key, save_factors, load_factors
+
+
+def sample_valuations(column, beta_size, rng):
+    """Parsing a column of valuations, each either a number or the "a,b[,loc[,scale]]" parameters of a Beta
+    distribution, and returning (valuations, number of parse errors).
+    Only the distinct cells are parsed (with pandas string operations), and all the Beta cells are sampled by a single
+    call of the numpy Generator rng, with per-cell parameters: a Beta cell gets the mean of beta_size samples.
+    Empty cells are NaN (never accepted) and not counted as errors; cells that cannot be parsed, or Beta parameters out
+    of their domain (a, b, scale > 0), are NaN and counted as errors."""
+
+    codes, cells = pd.factorize(column.astype(object).fillna('').astype(str))
+    cells = pd.Series(cells)
+    n_fields = cells.str.count(',').to_numpy() + 1
+    fields = cells.str.split(',', expand=True).reindex(columns=range(4))
+    present = fields.notna().to_numpy()
+    params = np.array(fields.apply(lambda field: pd.to_numeric(field, errors='coerce')), dtype=float)
+    missing = fields.apply(lambda field: field.str.strip().str.lower().isin(['nan', ''])).to_numpy()
+
+    errors = (present & np.isnan(params) & ~missing).any(axis=1) | (n_fields > 4)
+    params[:, 2] = np.where(n_fields >= 3, params[:, 2], 0)  # loc
+    params[:, 3] = np.where(n_fields >= 4, params[:, 3], 1)  # scale
+    is_beta = ~errors & (n_fields >= 2)
+    errors |= is_beta & ~((params[:, 0] > 0) & (params[:, 1] > 0) & (params[:, 3] > 0) &
+                          np.isfinite(params).all(axis=1))
+    is_beta &= ~errors
+
+    valuations = np.full(len(column), np.nan)
+    single = ~errors & (n_fields == 1)
+    valuations[single[codes]] = params[codes[single[codes]], 0]
+    rows = np.flatnonzero(is_beta[codes])
+    a, b, loc, scale = params[codes[rows]].T
+    valuations[rows] = loc + scale * rng.beta(a, b, size=(beta_size, len(rows))).mean(axis=0)
+    return valuations, int(errors[codes].sum())
+
+def read_valuations(path, users_df=None):
+    """Returning the valuation csv at path (or the already parsed users_df) without its revenue columns, the "_rpi"
+    suffix removed from the ad-network columns."""
 
+    if users_df is None: users_df = pd.read_csv(path)
+    users_df = users_df.rename(columns=lambda col: col.replace("_rpi", ""))
+    valuations_cols = [col for col in users_df.columns if col not in {'revenue', 'rpi'}]
+    return users_df[valuations_cols]
 
-def create_real_users(path, init_waterfall, adnetwork_names, users_df=None, path_log=None, beta_size=3):
-    """Creating users valuations from real data.
+def sample_users(users_df, adnetwork_names, beta_size=3, dtype=np.float64, seed=None, path_log=None):
+    """Returning the uncalibrated population.UserPopulation of the users of users_df (see read_valuations), their
+    valuations drawn by sample_valuations from the numpy Generator of seed."""
+
+    rng = np.random.default_rng(seed)
+    valuations = np.full((len(users_df), len(adnetwork_names)), np.nan)
+    errors = {}
+    for j, adNetwork in enumerate(adnetwork_names):
+        valuations[:, j], errors[adNetwork] = sample_valuations(users_df[adNetwork], beta_size, rng)
+    if path_log is not None:
+        logging.info(f"Total beta estimation errors: {sum(errors.values())}, per ad-network: {errors}")
+
+    return UserPopulation(users_df["user_id"].to_numpy(), users_df["impressions"].to_numpy(), valuations,
+                          adnetwork_names, dtype=dtype)
+
+def create_real_users(path, init_waterfall, adnetwork_names, users_df=None, path_log=None, beta_size=3,
+                      dtype=np.float64, seed=None, cache_dir=None):
+    """Creating users valuations from real data, returned as a population.UserPopulation.
     Utype = True if valuations are Beta dist
-    Ufactors = True learn the factors"""
+    Ufactors = True learn the factors
+    dtype is the type of the valuations matrix (np.float32 halves its memory).
+    seed seeds the numpy Generator drawing the Beta samples (see sample_valuations).
+    With cache_dir, the learned factors are cached in cache_dir/<csv name>_factors_<key>.npz, where key hashes the
+    valuations, the initial waterfall, the ad-networks and beta_size, so a changed input never reuses stale factors;
+    without it, they are learned on every call."""
 
     if path_log is not None:
         logging.basicConfig(filename=path_log, filemode='a', level=logging.INFO)
 
-    if users_df is None: users_df = pd.read_csv(path)
-    users_df.columns = [col.replace("_rpi", "") for col in users_df.columns]
-    valuations_cols = [col for col in users_df.columns if col not in {'revenue', 'rpi'}]
-    users_df = users_df[valuations_cols]
+    users_df = read_valuations(path, users_df)
 
     # validation for the sampling process
     if abs(init_waterfall.get_impressions() - sum(users_df.impressions)) / init_waterfall.get_impressions() > 0.2:
         if path_log is not None: logging.info("error. sum impressions in valuation and waterfall do not match")
 
-    users = []
-    for i in range(len(users_df)):
-        valuations = dict(users_df.iloc[i])
-        user_id = valuations.pop("user_id")
-        user = User(user_id=user_id, adnetwork_names=adnetwork_names, valuations=valuations)
-        users.append(user)
-
     # handle users with beta distribution
-    if not os.path.exists(f"{path[:-4]}_factors.txt"): # if factors file does not exist
+    key = get_cache_key(pd.util.hash_pandas_object(users_df[["impressions"] + list(adnetwork_names)]).values.tobytes(),
+                        init_waterfall.get_df().to_csv(index=False), adnetworks=adnetwork_names, beta_size=beta_size)
+    factors_path = None if cache_dir is None else \
+        os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}_factors_{key}.npz")
+    Factors = None if factors_path is None else load_factors(factors_path)
+    if Factors is None: # if factors file does not exist
         if path_log is not None: logging.info("Beta factors do not exists. Function will now estimate them")
-        Factors = copy.deepcopy(MAX_CAPACITY_PER_ADNETWORK)
-        for i in range(0, len(Factors)): Factors[i] = 1
-    else:
-        with open(f"{path[:-4]}_factors.txt", "rb") as fp:
-            Factors = pickle.load(fp)
+        Factors = {adNetwork: 1 for adNetwork in adnetwork_names}
 
-    cnt = 0
-    for user in users:
-        for adNetwork in adnetwork_names:
-            try:
-                _results = np.array(user.valuations[adNetwork].split(','), dtype=float)
-            except:
-                _results = np.array(user.valuations[adNetwork], dtype=float)
-            try:
-                if _results.size == 1:
-                    user.valuations[adNetwork] = np.mean(_results)
-                    user.valuations[adNetwork] *= Factors[adNetwork]
-                else:
-                    user.valuations[adNetwork] = np.mean(beta.rvs(*_results, size=beta_size))
-                    user.valuations[adNetwork] *= Factors[adNetwork]
-            except:
-                cnt += 1
-    if path_log is not None: logging.info(f"Total beta estimation errors: {cnt}")
-
-    if not os.path.exists(f"{path[:-4]}_factors.txt"):
-        cp_users = copy.deepcopy(users)
-        new_factors = optimize_factors(cp_users, init_waterfall, Factors)
-
-        for user in users:
-            for adNetwork in adnetwork_names:
-                user.valuations[adNetwork] *= new_factors[adNetwork]
-
-        with open(f"{path[:-4]}_factors.txt", "wb") as fp:
-            pickle.dump(new_factors, fp)
+    users = sample_users(users_df, adnetwork_names, beta_size, dtype, seed, path_log).scaled(Factors)
+
+    if factors_path is None or not os.path.exists(factors_path):
+        new_factors = optimize_factors(users, init_waterfall, Factors)
+        users = users.scaled(new_factors)
+        if factors_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_factors(factors_path, new_factors)
 
     return users
 
-def optimize_factors(cp_users, init_waterfall, Factors):
-    """Learn the coefficients to map the valuation mat to the real waterfall numberr of impressions"""
+def optimize_factors(users, init_waterfall, Factors, grid=None, n_rounds=1, tol=0):
+    """Learn the coefficients to map the valuation mat to the real waterfall numberr of impressions.
+    users is a population.UserPopulation. A candidate factor of an ad-network is applied as a multiplier of the
+    valuations seen by its ad-units, so all the grid values (0.8 to 1.2 by default) of an ad-network are scored by one
+    batched engine.simulate_many pass over the users, without copying users or waterfalls.
+    The ad-networks are calibrated one after the other, in the order of the waterfall; n_rounds > 1 repeats these
+    coordinate descent rounds until the objective improves by at most tol."""
 
-    def objective(Ad_unitsA, Ad_unitsB):
-        """This function measure how close are two waterfalls in terms of weighted impressions"""
-        wMAE = 0
-        for i in range(len(Ad_unitsA)):
-            wMAE += abs(Ad_unitsA[i].impressions-Ad_unitsB[i].impressions) * Ad_unitsA[i].weight
-        return wMAE
+    grid = np.arange(80, 122, 4) / 100 if grid is None else np.asarray(grid, dtype=float)
+    arrays = engine.get_waterfall_arrays(init_waterfall.ad_units, users.adnetwork_names)
+    impressions = np.array([ad_unit.impressions for ad_unit in init_waterfall.ad_units], dtype=float)
 
     # define the weights according to prices
-    total_prices = sum(ad_unit.price for ad_unit in init_waterfall.ad_units)
-    for ad_unit in init_waterfall.ad_units:
-        ad_unit.weight = ad_unit.price / total_prices
-
-    for ad_unit in init_waterfall.ad_units:
-        curr_adNetwork = ad_unit.adnetwork_name
-        curr_users = copy.deepcopy(cp_users)
-        for user in curr_users:
-            for adNetwork in user.adnetwork_names:
-                if adNetwork != curr_adNetwork:
-                    user.valuations[adNetwork] *= Factors[adNetwork]
-        best_score = np.inf
-        for i in range(80,122,4): # check between 0.8 and 1.2
-            val = i / 100
-            curr_waterfall = copy.deepcopy(init_waterfall)
-            curr_users_temp = copy.deepcopy(curr_users)
-            for user in curr_users_temp:
-                user.valuations[curr_adNetwork] *= val
-            _results = curr_waterfall.run(curr_users_temp, reset_waterfall=True)  # run users in the waterfall
-            score = objective(init_waterfall.ad_units,curr_waterfall.ad_units)
-            if score < best_score:
-                best_score = score
-                Factors[curr_adNetwork] = val
+    prices = np.array([ad_unit.price for ad_unit in init_waterfall.ad_units], dtype=float)
+    weights = prices / prices.sum()
+
+    def objective(stats):
+        """This function measure how close are two waterfalls in terms of weighted impressions"""
+        return float((np.abs(impressions - stats.impressions) * weights).sum())
+
+    def get_scores(curr_adNetwork, values):
+        column = users.adnetwork_names.index(curr_adNetwork)
+        scale = users.scale * np.array([Factors.get(adNetwork, 1) if adNetwork != curr_adNetwork else 1
+                                        for adNetwork in users.adnetwork_names], dtype=float)
+        arrays_list = [arrays._replace(multipliers=np.where(arrays.adnetwork_idx == column, arrays.multipliers * val,
+                                                            arrays.multipliers)) for val in values]
+        return [objective(stats) for stats in engine.simulate_many(arrays_list, users.valuations, users.impressions,
+                                                                    scale)]
+
+    adNetworks = list(dict.fromkeys(ad_unit.adnetwork_name for ad_unit in init_waterfall.ad_units
+                                    if ad_unit.adnetwork_name in users.adnetwork_names))
+    best_score = np.inf
+    for _ in range(n_rounds):
+        previous_score = best_score
+        for curr_adNetwork in adNetworks:
+            scores = get_scores(curr_adNetwork, grid)
+            best = int(np.argmin(scores))
+            Factors[curr_adNetwork] = float(grid[best])
+            best_score = scores[best]
+        if previous_score - best_score <= tol:
+            break
 
     return Factors
 
 def get_user_by_id(users, user_id):
     """find user in users list according to user_id"""
 
+    if isinstance(users, UserPopulation):
+        users = users.subset(users.user_ids == user_id).to_users()
     for user in users:
         if user.user_id == user_id:
             return user
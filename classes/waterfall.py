@@ -1,10 +1,15 @@
 import numpy as np
 import pandas as pd
+from contextlib import contextmanager
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+from classes import engine
 from classes.user import User
+from classes.population import UserPopulation
+from classes.waterfall_state import AdUnitState, WaterfallState
 from classes.ad_unit import AdUnit
+from classes.ad_unit_list import AdUnitList
 from classes.consts import DF_COLUMNS, MAX_CAPACITY_PER_ADNETWORK, THRESHOLD
 from classes.utils import create_ad_units
 
@@ -13,7 +18,8 @@ class Waterfall:
     def __init__(self, ad_units=None, df=None, csv_path=None, flag_add_default_ad_unit=False, default_p_acceptance=1,
                  brand_networks=("Ogury", "HyprMx"), smallest_price_change=1):
 
-        self.ad_units = ad_units
+        self.ad_units = AdUnitList(ad_units) if ad_units is not None else None
+        self.batch = None  # the edits of the current edit() block
         # Probability of accepting a user even if user valuation >= ad-unit floor price.
         self.default_p_acceptance = default_p_acceptance
         self.brand_networks = brand_networks  # Special ad-networks that have different logic.
@@ -46,6 +52,12 @@ class Waterfall:
         self.best_child = []
         self.best_grandchild = []
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if not isinstance(self.ad_units, AdUnitList):  # pickled before the ad-units were indexed
+            self.ad_units = AdUnitList(self.ad_units)
+        self.__dict__.setdefault("batch", None)
+
     def get_num_of_defaults(self):
         """Returning the number of ad-units in the automatic section."""
 
@@ -67,11 +79,95 @@ class Waterfall:
         assert ad_unit_id not in self.ad_units_by_id.keys(), \
             f"trying to add ad-unit with ad-unit id already in use: {ad_unit_id}"
 
-        self.ad_units.append(ad_unit)
         self.adnetworks_capacities[adnetwork_name] += 1
         self.ad_units_by_id[ad_unit_id] = ad_unit
-        if order:
-            self.set_ad_unit_order(ad_unit)
+        if self.batch is not None:
+            self.batch["removed"].pop(ad_unit_id, None)  # removed and re-added within the block: kept
+            position = self.ad_units.get_position(ad_unit_id)
+            if (position is None or self.ad_units[position] is not ad_unit) and ad_unit not in self.batch["added"]:
+                self.batch["added"].append(ad_unit)
+            if order:
+                self.batch["placed"][ad_unit_id] = (ad_unit, -1)
+            else:
+                self.batch["by_order"] = True
+        elif order and self.ad_units.numbered:
+            self.ad_units.splice(*[self.ad_units.find_price_position(ad_unit.price)] * 2, [ad_unit])
+            self.move_cross_down()
+        else:
+            self.ad_units.splice(len(self.ad_units), len(self.ad_units), [ad_unit], renumber=False)
+            if order:
+                self.set_ad_unit_order(ad_unit)
+
+    @contextmanager
+    def edit(self):
+        """Batch edits of the waterfall: within the with block, set_ad_unit_price, set_ad_unit_order, add_ad_unit and
+        remove_ad_unit change the prices, the capacities and the ids at once, but the ad-units are added, removed and
+        ordered only once when the block exits, e.g.
+            with waterfall.edit():
+                for ad_unit, price in changes:
+                    waterfall.set_ad_unit_price(ad_unit, price)
+                waterfall.remove_ad_unit(old_ad_unit)
+        On exit, the changed and added ad-units are placed by price (as set_ad_unit_order) among the other ad-units,
+        which keep their order; if an explicit order was given (set_price_and_order, add_ad_unit(order=False), a
+        number as order of set_ad_unit_price), the waterfall is re-ordered by order instead (see reorder). If the
+        block raises, the waterfall is restored as it was. A block inside a block joins it."""
+
+        if self.batch is not None:
+            yield self
+            return
+        snapshot = (list(self.ad_units), [(ad_unit, ad_unit.price, ad_unit.order) for ad_unit in self.ad_units],
+                    dict(self.adnetworks_capacities), dict(self.ad_units_by_id))
+        self.batch = {"placed": {}, "added": [], "removed": {}, "by_order": False}
+        try:
+            yield self
+        except BaseException:
+            ad_units, fields, self.adnetworks_capacities, self.ad_units_by_id = snapshot
+            for ad_unit, price, order in fields:
+                ad_unit.price, ad_unit.order = price, order
+            self.batch = None
+            self.ad_units.reset(ad_units)
+            raise
+        batch, self.batch = self.batch, None
+        self.apply_edits(batch)
+
+    def apply_edits(self, batch):
+        """Adding, removing and ordering the ad-units edited in an edit() block."""
+
+        removed, placed = batch["removed"], batch["placed"]
+        for ad_unit in removed.values():
+            ad_unit.order = -1
+        ad_units = [ad_unit for ad_unit in list(self.ad_units) + batch["added"]
+                    if self.ad_units_by_id.get(ad_unit.ad_unit_id) is ad_unit]
+        if batch["by_order"]:
+            self.ad_units.reset(ad_units)
+            for ad_unit, order_sign in placed.values():
+                if self.ad_units_by_id.get(ad_unit.ad_unit_id) is ad_unit:
+                    ad_unit.order = self.get_price_order(ad_unit, order_sign)
+            self.reorder()
+            return
+
+        if not self.ad_units.numbered:  # order the ad-units that keep their place first
+            self.ad_units.reset(ad_units)
+            self.reorder()
+            ad_units = list(self.ad_units)
+        kept = AdUnitList([ad_unit for ad_unit in ad_units if ad_unit.ad_unit_id not in placed])
+        inserted = {}
+        for ad_unit, order_sign in placed.values():
+            if self.ad_units_by_id.get(ad_unit.ad_unit_id) is ad_unit:
+                inserted.setdefault(kept.find_price_position(ad_unit.price, order_sign), []).append(ad_unit)
+        ad_units = []
+        for i in range(len(kept) + 1):
+            ad_units.extend(sorted(inserted.get(i, []), key=lambda ad_unit: -ad_unit.price))
+            if i < len(kept):
+                ad_units.append(kept[i])
+        self.ad_units.reset(ad_units, renumber=True)
+        self.move_cross_down()
+
+    def move_cross_down(self):
+        """"Cross" cannot be at the top of the waterfall: moving it below the first ad-unit (as reorder does)."""
+
+        if len(self.ad_units) > 1 and self.ad_units[0].adnetwork_name == 'Cross':
+            self.ad_units.move(0, 1)
 
     def reorder(self, sort_by='order', reverse=False):
         """Ordering the waterfall based on the sort_by column.
@@ -92,22 +188,35 @@ class Waterfall:
                 if ad_unit.section == 'Auto': # Do not change the order of 'default' instances
                     default_start = ad_unit.order
                     break
-            self.ad_units[0:default_start] = sorted(self.ad_units[0:default_start], key=sort_by_func, reverse=reverse) # sort without default
+            ad_units = list(self.ad_units)
+            ad_units[0:default_start] = sorted(ad_units[0:default_start], key=sort_by_func, reverse=reverse) # sort without default
         else:
-            self.ad_units = sorted(self.ad_units, key=sort_by_func, reverse=reverse)
+            ad_units = sorted(self.ad_units, key=sort_by_func, reverse=reverse)
 
-        if self.ad_units[0].adnetwork_name == 'Cross':
-            self.ad_units = [self.ad_units[1]] + [self.ad_units[0]] + self.ad_units[2:]
+        if ad_units[0].adnetwork_name == 'Cross':
+            ad_units = [ad_units[1]] + [ad_units[0]] + ad_units[2:]
 
-        for i, ad_unit in enumerate(self.ad_units):
-            ad_unit.order = i + 1
+        self.ad_units.reset(ad_units, renumber=True)
 
     def remove_ad_unit(self, ad_unit):
-        self.ad_units.remove(ad_unit)
+        if self.batch is not None:
+            if self.ad_units_by_id.get(ad_unit.ad_unit_id) is not ad_unit:
+                raise ValueError(f"{ad_unit.get_name()} is not in the waterfall")
+            self.batch["removed"][ad_unit.ad_unit_id] = ad_unit
+        else:
+            position = self.ad_units.get_position(ad_unit.ad_unit_id)
+            if position is None or self.ad_units[position] is not ad_unit:
+                raise ValueError(f"{ad_unit.get_name()} is not in the waterfall")
+            numbered = self.ad_units.numbered
+            self.ad_units.splice(position, position + 1, [], renumber=numbered)
         self.adnetworks_capacities[ad_unit.adnetwork_name] -= 1
         ad_unit.order = -1
         self.ad_units_by_id.pop(ad_unit.ad_unit_id)
-        self.reorder()
+        if self.batch is None:
+            if numbered:
+                self.move_cross_down()
+            else:
+                self.reorder()
 
     def get_adnetworks(self):
         return {ad_unit.adnetwork_name for ad_unit in self.ad_units}
@@ -154,33 +263,56 @@ class Waterfall:
         ad_units_params_per_adnetwork = {}
         for adnetwork in ad_unit_groups:
             ad_units_params_per_adnetwork[adnetwork] = [dict(self.df.iloc[i]) for i in ad_unit_groups[adnetwork]]
-        self.ad_units = create_ad_units(ad_units_params_per_adnetwork)
+        self.ad_units = AdUnitList(create_ad_units(ad_units_params_per_adnetwork))
         self.reorder()
 
-    def run_single_user(self, user):
+    def run_single_user(self, user, rng=None):
         """Running a user through the waterfall and returning an impression log which is either None, if the user wasn't
         accepted to any ad-unit, or a tuple indicating which ad-unit bought the user, in the format:
         impression = (user id, ad-unit name, user's real valuation, floor price of the ad-unit)"""
 
         for ad_unit in self.ad_units:
-            impression = ad_unit.ask_impression(user)
+            impression = ad_unit.ask_impression(user, rng)
             if impression is not None:
                 return impression
         return user.user_id, None, None, 0
 
-    def run(self, users, reset_waterfall=True):
+    def run(self, users, reset_waterfall=True, vectorized=True, rng=None):
         """Running many users through the waterfall.
-        users is either a list containing only user.User type objects, or users is a dictionary where each key is a
-        user_id and each value is the valuation dictionary of the users valuations. Utype is a flag if users represented by a
-        scalar or vector"""
+        users is either a population.UserPopulation, a list containing only user.User type objects, or users is a
+        dictionary where each key is a user_id and each value is the valuation dictionary of the users valuations.
+        Utype is a flag if users represented by a scalar or vector.
+        If vectorized is True all users are run at once by the numpy engine (classes.engine), otherwise every user is
+        asked by every ad-unit one by one.
+        For a UserPopulation the engine's SimulationStats are returned, otherwise the per-user impression log.
+        Random acceptances (p_acceptance < 1) are drawn from the numpy Generator rng (see engine.get_rng if None)."""
         if reset_waterfall:
             self.reset()
 
+        if isinstance(users, UserPopulation):
+            stats = engine.simulate(engine.get_waterfall_arrays(self.ad_units, users.adnetwork_names),
+                                    users.valuations, users.impressions, users.scale, users.valuation_sums, rng=rng)
+            engine.apply_stats(self.ad_units, stats)
+            return stats
+
+        if type(users) == dict:
+            users = [User(user_id=user_id, valuations=users[user_id]) for user_id in users]
+
+        if not vectorized:
+            return [self.run_single_user(user, rng) for user in users]
+
+        population = UserPopulation.from_users(users, list(dict.fromkeys(ad_unit.adnetwork_name
+                                                                         for ad_unit in self.ad_units)))
+        stats = self.run(population, reset_waterfall=False, rng=rng)
+
+        arrays = engine.get_waterfall_arrays(self.ad_units, population.adnetwork_names)
         results = []
-        for user in users:
-            if type(users) == dict:
-                user = User(user_id=user, valuations=users[user])
-            results.append(self.run_single_user(user))
+        for user_id, user_valuations, i in zip(population.user_ids, population.valuations, stats.capture):
+            if i < len(self.ad_units):
+                user_valuation = user_valuations[arrays.adnetwork_idx[i]] * arrays.multipliers[i]
+                results.append((user_id, self.ad_units[i].get_name(), user_valuation, self.ad_units[i].price))
+            else:
+                results.append((user_id, None, None, 0))
         return results
 
     def reset(self):
@@ -194,7 +326,25 @@ class Waterfall:
         """Calculating ad-unit order in the waterfall, according to its floor price, and placing it in the right place.
         In case of an ambiguity (same price as some other ad-unit) order_sign determines where to place it:
         if order_sign=-1 then the ad-unit will be place above all other ad-units with the same price;
-        if order_sign=+1 then the ad-unit will be place below all other ad-units with the same price."""
+        if order_sign=+1 then the ad-unit will be place below all other ad-units with the same price.
+        While the orders are the positions (see AdUnitList.numbered) the ad-unit is moved to its place directly."""
+
+        if self.batch is not None:
+            self.batch["placed"][ad_unit.ad_unit_id] = (ad_unit, order_sign)
+            return
+        if order and self.ad_units.numbered:
+            position = self.ad_units.get_position(ad_unit.ad_unit_id)
+            self.ad_units.move(position, self.ad_units.find_price_position(ad_unit.price, order_sign, position))
+            self.move_cross_down()
+            return
+        ad_unit.order = self.get_price_order(ad_unit, order_sign)
+        self.ad_units.numbered = False
+        if order:
+            self.reorder()
+
+    def get_price_order(self, ad_unit, order_sign=-1):
+        """Returning the (fractional) order that places ad_unit by its price among the orders of the other ad-units
+        (see set_ad_unit_order)."""
 
         ad_unit_order = np.inf
         for other_ad_unit in self.ad_units:
@@ -205,17 +355,28 @@ class Waterfall:
                 elif other_ad_unit.price == ad_unit.price:
                     ad_unit_order = other_ad_unit.order + order_sign * 0.5
                     break
-        ad_unit.order = ad_unit_order
-        ad_unit.order = ad_unit_order
-        if order:
-            self.reorder()
+        return ad_unit_order
 
     def set_price_and_order(self, ad_unit, price, order):
         """Set the price of the ad|_unit and reorder"""
 
-        ad_unit.set_price(price)
+        self.set_price(ad_unit, price)
         ad_unit.order = order
-        self.reorder()
+        self.ad_units.numbered = False
+        if self.batch is not None:
+            self.batch["by_order"] = True
+        else:
+            self.reorder()
+
+    def set_price(self, ad_unit, price):
+        """Setting the price of ad_unit without moving it (the prices of the ad-units are set through the waterfall,
+        which keeps its index of the ad-units, see AdUnitList)."""
+
+        position = self.ad_units.get_position(ad_unit.ad_unit_id)
+        if position is not None and self.ad_units[position] is ad_unit:
+            self.ad_units.set_price(position, price)
+        else:  # an ad-unit added in an edit() block
+            ad_unit.set_price(price)
 
     def set_ad_unit_price(self, ad_unit, price, order=True, order_sign=-1, perturb_price=False):
         """Setting the price of ad_unit and placing it in the right order.
@@ -226,13 +387,39 @@ class Waterfall:
         change if larger than self.smallest_price_change"""
 
         if self.smallest_price_change <= abs(price - ad_unit.price) or perturb_price or ad_unit.price <= 10:
-            ad_unit.set_price(price)
+            self.set_price(ad_unit, price)
             if type(order) in (int, float):
                 ad_unit.order = order
-                self.reorder()
+                self.ad_units.numbered = False
+                if self.batch is not None:
+                    self.batch["by_order"] = True
+                else:
+                    self.reorder()
             elif order:
                 self.set_ad_unit_order(ad_unit, order_sign=order_sign)
 
+    def to_state(self):
+        """Returning the waterfall as an immutable waterfall_state.WaterfallState (without the simulation fields)."""
+
+        return WaterfallState([AdUnitState.from_ad_unit(ad_unit) for ad_unit in self.ad_units])
+
+    @staticmethod
+    def from_state(state, stats=None):
+        """Initializing a waterfall from a waterfall_state.WaterfallState, keeping the ad-units ids.
+        stats, if given, are the engine.SimulationStats of the state and are set in the ad-units fields."""
+
+        ad_units = []
+        for i, ad_unit_state in enumerate(state.ad_units):
+            ad_unit = AdUnit(adnetwork_name=ad_unit_state.adnetwork_name, ad_unit_name=ad_unit_state.ad_unit_name,
+                             order=i + 1, section=ad_unit_state.section, price=ad_unit_state.price,
+                             p_acceptance=ad_unit_state.p_acceptance)
+            ad_unit.ad_unit_id = ad_unit_state.ad_unit_id
+            ad_units.append(ad_unit)
+        waterfall = Waterfall(ad_units=ad_units)
+        if stats is not None:
+            engine.apply_stats(waterfall.ad_units, stats)
+        return waterfall
+
     def get_revenue(self):
         return sum([ad_unit.revenue for ad_unit in self.ad_units])
 
@@ -243,30 +430,16 @@ class Waterfall:
         return pd.DataFrame([ad_unit.get_tuple() for ad_unit in self.ad_units], columns=DF_COLUMNS)
 
     def is_valid(self):
-        """checks if the waterfall has no conflicts"""
-
-        def get_next_price(ad_units_list, ad_unit):
-            """Returning the price of the instance before the given ad_unit from the same ad-network,
-            according to the order given by ad_units_list"""
-
-            price = None  # there is no ad_unit of the same adNetwork above
-            adnetwork_name = ad_unit.adnetwork_name
-            for ad_unit_other in ad_units_list:
-                if ad_unit.ad_unit_id == ad_unit_other.ad_unit_id:
-                    break
-                if ad_unit_other.adnetwork_name == adnetwork_name:
-                    price = ad_unit_other.price
-            return price
+        """checks if the waterfall has no conflicts (the search validates its waterfalls with
+        constraints.WaterfallConstraints)"""
 
         check = True
         if self.ad_units[0].adnetwork_name != 'Cross': # "Cross" cannot be at the top of the waterfall
             check = False
 
         for i in range(1, len(self.ad_units)):
-            val = get_next_price(self.ad_units[::-1], self.ad_units[i - 1])  if get_next_price(self.ad_units[::-1], self.ad_units[i - 1]) is not None else 0 # val is the next price of the same adNetwork
             if (self.ad_units[i].adnetwork_name == self.ad_units[i - 1].adnetwork_name and self.ad_units[i].section == 'High') or \
-                self.ad_units[i].get_price() - self.ad_units[i - 1].get_price() > THRESHOLD or \
-                    self.ad_units[i - 1] == val:
+                self.ad_units[i].get_price() - self.ad_units[i - 1].get_price() > THRESHOLD:
                 check = False
                 break
 
@@ -331,12 +504,8 @@ class Waterfall:
     def get_order_by_id(self, ad_unit_id):
         """this function returns the order of ad_unit in the waterfall according to its id."""
 
-        order = None
-        for i in self.ad_units:
-            if i.ad_unit_id == ad_unit_id:
-                order = i.order
-                break
-        return order
+        position = self.ad_units.get_position(ad_unit_id)
+        return self.ad_units[position].order if position is not None else None
 
     def set_best_child(self, child):
         self.best_child = child
@@ -0,0 +1,137 @@
+from classes.consts import MAX_CAPACITY_PER_ADNETWORK
+
+
+class AdUnitState:
+    """Immutable ad-unit: only the fields that define a waterfall (no simulation statistics).
+    The order of the ad-unit is its position in the WaterfallState holding it."""
+
+    __slots__ = ("ad_unit_id", "adnetwork_name", "ad_unit_name", "section", "price", "p_acceptance")
+
+    def __init__(self, ad_unit_id, adnetwork_name, ad_unit_name, section='Auto', price=0, p_acceptance=1):
+        for field, value in zip(AdUnitState.__slots__,
+                                (ad_unit_id, adnetwork_name, ad_unit_name, section, int(price), p_acceptance)):
+            object.__setattr__(self, field, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("AdUnitState is immutable, use with_price")
+
+    def __reduce__(self):
+        return AdUnitState, self.get_fields()
+
+    def __eq__(self, other):
+        return isinstance(other, AdUnitState) and self.get_fields() == other.get_fields()
+
+    def __hash__(self):
+        return hash(self.get_fields())
+
+    def get_fields(self):
+        return tuple(getattr(self, field) for field in AdUnitState.__slots__)
+
+    @staticmethod
+    def from_ad_unit(ad_unit):
+        return AdUnitState(ad_unit.ad_unit_id, ad_unit.adnetwork_name, ad_unit.ad_unit_name, ad_unit.section,
+                           ad_unit.price, ad_unit.p_acceptance)
+
+    def with_price(self, price):
+        return AdUnitState(self.ad_unit_id, self.adnetwork_name, self.ad_unit_name, self.section, price,
+                           self.p_acceptance)
+
+    def get_price(self):
+        return self.price
+
+    def get_name(self):
+        return f"{self.ad_unit_id}_{self.adnetwork_name}_{self.ad_unit_name}"
+
+    def get_key(self):
+        return self.adnetwork_name, self.section, self.price
+
+    def __repr__(self):
+        return f"{self.get_name():25s}-\tprice={self.price:2n}"
+
+
+class WaterfallState:
+    """Immutable waterfall: a tuple of AdUnitState in waterfall order.
+    with_price / with_insert / with_removal return a new state sharing all untouched AdUnitState objects with this
+    one, so neighbors are generated without copying the waterfall (compare Waterfall, which also holds the source
+    DataFrame and the simulation statistics of every ad-unit)."""
+
+    __slots__ = ("ad_units",)
+
+    def __init__(self, ad_units):
+        object.__setattr__(self, "ad_units", tuple(ad_units))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("WaterfallState is immutable")
+
+    def __reduce__(self):
+        return WaterfallState, (self.ad_units,)
+
+    def __len__(self):
+        return len(self.ad_units)
+
+    def __eq__(self, other):
+        return isinstance(other, WaterfallState) and self.ad_units == other.ad_units
+
+    def __hash__(self):
+        return hash(self.ad_units)
+
+    def __repr__(self):
+        return "\n".join(f"{i + 1:2n}  {ad_unit}" for i, ad_unit in enumerate(self.ad_units))
+
+    def get_order_by_id(self, ad_unit_id):
+        """Returning the order (1-based position) of the ad-unit with the given id, None if it is not in the state."""
+
+        for i, ad_unit in enumerate(self.ad_units):
+            if ad_unit.ad_unit_id == ad_unit_id:
+                return i + 1
+        return None
+
+    def get_prices(self):
+        return [ad_unit.price for ad_unit in self.ad_units]
+
+    def adnetwork_has_capacity(self, adnetwork):
+        """Checks if the given ad-network has a capacity to add another instance."""
+
+        n_ad_units = sum(1 for ad_unit in self.ad_units if ad_unit.adnetwork_name == adnetwork)
+        return n_ad_units < MAX_CAPACITY_PER_ADNETWORK[adnetwork]
+
+    def sorted_by_price(self):
+        """Same ordering as Waterfall.reorder(sort_by='price', reverse=True): sorting by descending price (stable) up to
+        the first ad-unit of the 'Auto' section, and never keeping a 'Cross' ad-unit at the top."""
+
+        ad_units = list(self.ad_units)
+        default_start = len(ad_units)
+        for i, ad_unit in enumerate(ad_units):
+            if ad_unit.section == 'Auto':
+                default_start = i + 1
+                break
+        ad_units[0:default_start] = sorted(ad_units[0:default_start], key=lambda ad_unit: float(ad_unit.price),
+                                           reverse=True)
+        if ad_units[0].adnetwork_name == 'Cross':
+            ad_units = [ad_units[1]] + [ad_units[0]] + ad_units[2:]
+        return WaterfallState(ad_units)
+
+    def with_price(self, i, price):
+        """Returning the state after setting the price of the i-th ad-unit, re-sorted by price."""
+
+        ad_units = list(self.ad_units)
+        ad_units[i] = ad_units[i].with_price(price)
+        return WaterfallState(ad_units).sorted_by_price()
+
+    def with_insert(self, ad_unit):
+        """Returning the state after inserting ad_unit above all ad-units with the same or a lower price."""
+
+        assert self.adnetwork_has_capacity(ad_unit.adnetwork_name), \
+            f"cannot add more ad-units from ad-network {ad_unit.adnetwork_name}"
+
+        position = len(self.ad_units)
+        for i, other_ad_unit in enumerate(self.ad_units):
+            if other_ad_unit.price <= ad_unit.price:
+                position = i
+                break
+        return WaterfallState(self.ad_units[:position] + (ad_unit,) + self.ad_units[position:]).sorted_by_price()
+
+    def with_removal(self, i):
+        """Returning the state without its i-th ad-unit."""
+
+        return WaterfallState(self.ad_units[:i] + self.ad_units[i + 1:])
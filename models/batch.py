@@ -0,0 +1,263 @@
+"""Optimizing many waterfalls in one batch, e.g. every app x geo x format waterfall of the night:
+    python -m models.batch data/batch_manifest.jsonl --save-path outputs --log my_log --n-jobs 4
+The manifest lists the jobs (see read_manifest). The populations of the jobs are calibrated and cached once, then the
+jobs run with run_algorithms.run_model on a pool of processes, the longest first, and a summary of the revenue uplift
+and run time of every job is written to <save-path>/batch_summary.csv."""
+
+import os
+import sys
+import json
+import time
+import inspect
+import argparse
+import logging
+import multiprocessing
+import pandas as pd
+
+from classes.waterfall import Waterfall
+from classes.consts import MAX_ITER, VALIDATION, MAX_PRICE, N_SIMULATIONS, ROLLOUT_DEPTH, ROLLOUT_WIDTH
+from models.run_algorithms import run_model, get_users
+
+# Arguments of run_model set by the batch itself, every other argument of run_model can be set by a job.
+BATCH_ARGUMENTS = ("csv_path_waterfall", "csv_path_users", "waterfall_name", "save_path", "path_log", "alg",
+                   "ADNETWORKS_list")
+JOB_FIELDS = ("name", "waterfall", "valuation", "alg", "adnetworks", "cost")
+
+
+def read_manifest(path):
+    """Returning the jobs of the manifest at path, a JSON Lines file with one job per line, e.g.
+        {"waterfall": "data/waterfall_data/init_synth_waterfall1.csv",
+         "valuation": "data/valuation_folder/synthetic_valuation_matrix.csv", "alg": "SandS", "seed": 3}
+    - waterfall and valuation are the initial waterfall and the valuation csv files,
+    - alg is the algorithm of run_model ('SandS' by default),
+    - name names the outputs of the job (the name of the waterfall csv by default, numbered if it is not unique for
+      its algorithm),
+    - adnetworks restricts the ad-networks (all the ad-networks of the valuation csv by default),
+    - cost overrides the estimated run time used to schedule the job (see estimate_cost), e.g. its run time in the
+      summary of a previous batch,
+    - any other key is a constraint of the search passed to run_model (time_budget, max_evaluations, seed,
+      racing_fractions, n_folds, ...).
+    Every job is returned as a dictionary of these fields, with its position in the manifest as id and the run_model
+    arguments as params."""
+
+    allowed = set(inspect.signature(run_model).parameters) - set(BATCH_ARGUMENTS)
+    jobs = []
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            for field in ("waterfall", "valuation"):
+                if field not in entry:
+                    raise ValueError(f"job {len(jobs)} of {path}: missing {field}")
+            params = {key: value for key, value in entry.items() if key not in JOB_FIELDS}
+            unknown = set(params) - allowed
+            if unknown:
+                raise ValueError(f"job {len(jobs)} of {path}: unknown arguments {sorted(unknown)}")
+            jobs.append({"id": len(jobs), "name": entry.get("name"), "waterfall": entry["waterfall"],
+                         "valuation": entry["valuation"], "alg": entry.get("alg", "SandS"),
+                         "adnetworks": entry.get("adnetworks"), "cost": entry.get("cost"), "params": params})
+
+    names = set()
+    for job in jobs:
+        name = job["name"] or os.path.splitext(os.path.basename(job["waterfall"]))[0]
+        unique_name, k = name, 1
+        while (unique_name, job["alg"]) in names:
+            k += 1
+            unique_name = f"{name}_{k}"
+        names.add((unique_name, job["alg"]))
+        job["name"] = unique_name
+    return jobs
+
+
+def get_population_folds(job):
+    """Returning the (fold, compress) arguments of run_algorithms.get_users of the populations run_model loads for
+    job."""
+
+    if job["alg"] == 'SandS' and job["params"].get("n_folds") is not None:
+        # the folds compress subsets of the calibrated population, the final search compresses all of it
+        return [(None, False), (None, True)]
+    if job["alg"] == 'SandS':
+        return [(i, True) for i in range(VALIDATION)]
+    return [(None, True)]
+
+
+def load_populations(task):
+    """Calibrating and caching (in save_path/cache, see run_algorithms.get_users) the populations of the jobs of one
+    valuation csv, which is parsed once for all of them.
+    Returning, per job id, the number of users of its population, the number of rows its searches simulate per
+    evaluation (the cells of the compressed population, or the users if it is not compressed), the number of ad-units
+    of its waterfall and the error that prevented loading them (None if there was none)."""
+
+    csv_path_users, jobs, save_path, path_log = task
+    logging.basicConfig(filename=path_log, filemode='a', level=logging.INFO)
+    sizes = {}
+    try:
+        users_df = pd.read_csv(csv_path_users)
+    except Exception as error:
+        logging.exception("batch: cannot read %s", csv_path_users)
+        return {job["id"]: (None, None, None, repr(error)) for job in jobs}
+    for job in jobs:
+        try:
+            waterfall = Waterfall(csv_path=job["waterfall"])
+            population_folds = get_population_folds(job)
+            sizes_per_search = [len(get_users(csv_path_users, job["waterfall"], waterfall, job["adnetworks"],
+                                              save_path, fold=fold, seed=job["params"].get("seed"), compress=compress,
+                                              users_df=users_df.copy(deep=False)))
+                                for fold, compress in population_folds]
+            # the sizes of the population of the last search of the job (the per-user population is cached with the
+            # compressed one)
+            last_fold, last_compress = population_folds[-1]
+            n_cells = sizes_per_search[-1]
+            n_users = n_cells if not last_compress else \
+                len(get_users(csv_path_users, job["waterfall"], waterfall, job["adnetworks"], save_path,
+                              fold=last_fold, seed=job["params"].get("seed"), compress=False,
+                              users_df=users_df.copy(deep=False)))
+            sizes[job["id"]] = (n_users, n_cells, len(waterfall.ad_units), None)
+        except Exception as error:
+            logging.exception("batch: cannot load the population of job %s", job["name"])
+            sizes[job["id"]] = (None, None, None, repr(error))
+    return sizes
+
+
+def estimate_cost(job, n_cells, n_ad_units):
+    """Returning a rough, relative estimate of the run time of job: the rows (n_cells, see load_populations) and
+    ad-units simulated per evaluation times the number of evaluations, max_evaluations if the job sets it, otherwise
+    MAX_ITER iterations of neighbors (about one per ad-unit for S&S, per fold and for the final search of a k-fold job,
+    and n_simulations simulations for MCTS) or the ladders of the price grid for DP. The folds of a k-fold job search
+    subsets of its population, they are counted as n_cells rows too."""
+
+    params = job["params"]
+    if params.get("max_evaluations") is not None:
+        n_evaluations = params["max_evaluations"]
+    elif job["alg"] == 'SandS':
+        n_evaluations = MAX_ITER * n_ad_units * (params["n_folds"] + 1 if params.get("n_folds") else VALIDATION)
+    elif job["alg"] == 'DP':
+        n_evaluations = len(job["adnetworks"]) * (MAX_PRICE + 1)
+    else:
+        n_evaluations = MAX_ITER * params.get("n_simulations", N_SIMULATIONS) * (1 + ROLLOUT_DEPTH * ROLLOUT_WIDTH)
+    return float(n_cells * n_ad_units * n_evaluations)
+
+
+def run_job(task):
+    """Running a job of the manifest with run_model (in a worker process of run_batch).
+    Returning its row of the batch summary."""
+
+    job, save_path, path_log = task
+    logging.basicConfig(filename=path_log, filemode='a', level=logging.INFO)
+    row = {"id": job["id"], "name": job["name"], "alg": job["alg"], "pid": os.getpid()}
+    start = time.perf_counter()
+    try:
+        _best_waterfall, save_best_revenue, *_ = run_model(job["waterfall"], job["valuation"], job["name"], save_path,
+                                                           path_log, job["alg"], job["adnetworks"], **job["params"])
+        init_revenue, revenue = save_best_revenue[0], save_best_revenue[-1]
+        row.update(status="done", init_revenue=init_revenue, revenue=revenue,
+                   uplift=revenue / init_revenue - 1 if init_revenue > 0 else None)
+        alg_name = job["alg"] if job["alg"] in ('SandS', 'DP') else 'MCTS'
+        with open(f"{save_path}/metrics_{alg_name}_{job['name']}.json") as fp:
+            metrics = json.load(fp)
+        row["evaluations"] = metrics["counters"].get("evaluations")
+        if "uplift" in metrics:  # the out-of-sample uplift of a k-fold validation
+            row.update(kfold_uplift=metrics["uplift"]["mean"], kfold_variance=metrics["uplift"]["variance"])
+    except Exception as error:
+        logging.exception("batch: job %s failed", job["name"])
+        row.update(status="failed", error=repr(error))
+    row["seconds"] = time.perf_counter() - start
+    return row
+
+
+def run_batch(jobs, save_path, path_log, n_jobs=None):
+    """Running the jobs (see read_manifest) on a pool of n_jobs processes (all the cpus by default, serially in this
+    process if n_jobs=1).
+    First the populations are calibrated and cached, one task per valuation csv, so every valuation csv is parsed once
+    and every distinct population is calibrated once: the jobs then memory-map the cached populations and share their
+    pages. The jobs are then scheduled longest first (by their cost, or estimate_cost), so that the long jobs do not
+    start last and leave the other processes idle. In the pool, every job scores its neighbors serially (n_jobs=1 in
+    run_model), the parallelism is across jobs.
+    A job that fails is logged and reported in the summary, it does not stop the batch.
+    The summary (one row per job, in the order of the manifest: initial and final revenue, uplift, evaluations, run
+    time, estimated cost) is saved to save_path/batch_summary.csv and returned as a DataFrame."""
+
+    os.makedirs(save_path, exist_ok=True)
+    logging.basicConfig(filename=path_log, filemode='a', level=logging.INFO)
+    n_jobs = n_jobs if n_jobs is not None else multiprocessing.cpu_count()
+    start = time.perf_counter()
+    adnetworks = {}  # valuation csv -> its ad-networks, as in main.py
+    for job in jobs:
+        if job["adnetworks"] is None:
+            if job["valuation"] not in adnetworks:
+                adnetworks[job["valuation"]] = \
+                    pd.read_csv(job["valuation"], sep=',', index_col=0, nrows=1).columns[3:].tolist()
+            job["adnetworks"] = adnetworks[job["valuation"]]
+        if n_jobs != 1 and job["params"].get("n_jobs", 1) != 1:
+            logging.info("batch: job %s runs serially in the batch pool", job["name"])
+            job["params"] = dict(job["params"], n_jobs=1)
+
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job["valuation"], []).append(job)
+    tasks = [(csv_path_users, group, save_path, path_log)
+             for csv_path_users, group in sorted(groups.items(), key=lambda item: -len(item[1]))]
+    pool = multiprocessing.Pool(min(n_jobs, len(jobs))) if n_jobs != 1 and len(jobs) > 1 else None
+    try:
+        sizes = {}
+        for task_sizes in (pool.imap_unordered(load_populations, tasks) if pool is not None else
+                           map(load_populations, tasks)):
+            sizes.update(task_sizes)
+        load_seconds = time.perf_counter() - start
+        logging.info(f"batch: {len(tasks)} valuation files loaded in {load_seconds:.1f}s")
+
+        rows = {}
+        for job in jobs:
+            n_users, n_cells, n_ad_units, error = sizes[job["id"]]
+            if error is not None:
+                rows[job["id"]] = {"id": job["id"], "name": job["name"], "alg": job["alg"], "status": "failed",
+                                   "error": error}
+                continue
+            job["estimated_cost"] = job["cost"] if job["cost"] is not None else \
+                estimate_cost(job, n_cells, n_ad_units)
+            rows[job["id"]] = {"n_users": n_users, "n_cells": n_cells, "n_ad_units": n_ad_units}
+        runnable = sorted((job for job in jobs if "estimated_cost" in job),
+                          key=lambda job: (-job["estimated_cost"], job["id"]))
+        job_tasks = [(job, save_path, path_log) for job in runnable]
+        for k, row in enumerate(pool.imap_unordered(run_job, job_tasks, chunksize=1) if pool is not None else
+                                map(run_job, job_tasks)):
+            rows[row["id"]].update(row)
+            logging.info(f"batch: {k + 1}/{len(job_tasks)} jobs ended, {row['name']} ({row['alg']}): "
+                         f"{row['status']} in {row['seconds']:.1f}s")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    summary = pd.DataFrame([dict(rows[job["id"]], waterfall=job["waterfall"], valuation=job["valuation"],
+                                 estimated_cost=job.get("estimated_cost")) for job in jobs])
+    summary = summary[[column for column in ("id", "name", "alg", "waterfall", "valuation", "status", "init_revenue",
+                                             "revenue", "uplift", "kfold_uplift", "kfold_variance", "evaluations",
+                                             "seconds", "estimated_cost", "n_users", "n_cells", "n_ad_units", "pid",
+                                             "error")
+                       if column in summary.columns]]
+    summary.to_csv(f"{save_path}/batch_summary.csv", index=False)
+    seconds = time.perf_counter() - start
+    done = summary[summary["status"] == "done"]
+    logging.info(f"batch: {len(done)}/{len(jobs)} jobs done in {seconds:.1f}s "
+                 f"({done['seconds'].sum() if len(done) > 0 else 0:.1f}s of job time), "
+                 f"mean uplift: {done['uplift'].mean() if len(done) > 0 else None}")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="JSON Lines file of the jobs")
+    parser.add_argument("--save-path", default="outputs", help="directory of the outputs and of the population cache")
+    parser.add_argument("--log", default="my_log", help="log file")
+    parser.add_argument("--n-jobs", type=int, default=None, help="number of processes (all the cpus by default)")
+    args = parser.parse_args(argv)
+
+    summary = run_batch(read_manifest(args.manifest), args.save_path, args.log, args.n_jobs)
+    print(summary.to_string(index=False))
+    print(f"summary saved to {args.save_path}/batch_summary.csv")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+import logging
+import numpy as np
+
+from classes.consts import THRESHOLD, MAX_PRICE
+from models.search_and_score import get_price_grid, get_price_buckets, create_waterfall, generate_canonical_ladders
+
+
+def estimate_ladder(ADNETWORKS_list, prices, users):
+    """Heuristic ladder of 'High' ad-units, one per ad-network, sorted by descending price and constraint-valid (as in
+    search_and_score.generate_canonical_ladders), by dynamic programming over the states (ad-networks used so far,
+    last ad-network, last price).
+    The recursion only sees the marginal acceptance rates of every ad-network: it assumes that the share of the users
+    reaching an ad-unit that it buys only depends on its ad-network and price, i.e. that the valuations of the
+    ad-networks are independent. They are not on real populations (the users reaching an ad-unit are those rejected
+    above, whose valuations in the other ad-networks are correlated), so the ladder is not optimal in general and its
+    revenue under independence differs from its revenue on the population; it is meant as the incumbent of the
+    branch-and-bound of generate_canonical_ladders (see optimize_ladder). The recursion is solved backward (largest
+    sets of used ad-networks first), in O(2^N * N^2 * P^2) for N ad-networks and P prices, and the ladder is read
+    forward from the stored arg-max pointers, as in Viterbi decoding.
+    Returning the ladder, a tuple of (adnetwork, price) from top to bottom, and its revenue under independence."""
+
+    prices = get_price_grid(prices)
+    n_adnetworks = len(ADNETWORKS_list)
+    buckets = get_price_buckets(ADNETWORKS_list, users)
+    impressions = users.impressions.astype(float)
+    total_impressions = impressions.sum()
+
+    # accept[n, j] = share of the impressions accepting prices[j] in the n-th ad-network
+    accept = np.zeros((n_adnetworks, len(prices)))
+    for n in range(n_adnetworks):
+        accepted = np.cumsum(np.bincount(buckets[:, n], weights=impressions, minlength=MAX_PRICE + 2)[::-1])[::-1]
+        accept[n] = accepted[prices + 1] / total_impressions
+    gain = prices / 1000 * accept  # revenue per reaching impression of an ad-unit (n, prices[j])
+
+    # next_valid[i, j]: an ad-unit priced prices[j] may follow an ad-unit priced prices[i]
+    next_valid = (prices[None, :] <= prices[:, None]) & (prices[:, None] - prices[None, :] <= THRESHOLD)
+    same_price = prices[None, :] == prices[:, None]
+    names_order = np.argsort(np.argsort(ADNETWORKS_list))  # rank of the ad-network names (ties order)
+
+    full = (1 << n_adnetworks) - 1
+    values = {}  # values[used][l, i] = best revenue per reaching impression below the ad-unit (l, prices[i])
+    pointers = {}  # pointers[used][l, i] = (n, j) of the next ad-unit, n = -1 if the ladder ends
+    for used in sorted(range(1, full + 1), key=lambda used: -bin(used).count('1')):
+        value = np.zeros((n_adnetworks, len(prices)))
+        pointer = np.full((n_adnetworks, len(prices), 2), -1)
+        for l in range(n_adnetworks):
+            if not used >> l & 1:
+                continue
+            for n in range(n_adnetworks):
+                if used >> n & 1:
+                    continue
+                below = gain[n] + (1 - accept[n]) * values[used | 1 << n][n]
+                valid = next_valid & ~same_price if names_order[n] < names_order[l] else next_valid
+                candidates = np.where(valid, below[None, :], -np.inf)
+                best = candidates.argmax(axis=1)
+                best_value = candidates[np.arange(len(prices)), best]
+                better = best_value > value[l]
+                value[l, better] = best_value[better]
+                pointer[l, better] = np.column_stack([np.full(better.sum(), n), best[better]])
+        values[used] = value
+        pointers[used] = pointer
+
+    # the first ad-unit has no constraint
+    revenue = 0.0
+    n, j = -1, -1
+    for first in range(n_adnetworks):
+        below = gain[first] + (1 - accept[first]) * values[1 << first][first]
+        if below.max() > revenue:
+            revenue = below.max()
+            n, j = first, int(below.argmax())
+
+    ladder = ()
+    used = 0
+    while n >= 0:
+        ladder += ((ADNETWORKS_list[n], int(prices[j])),)
+        used |= 1 << n
+        n, j = pointers[used][n, j]
+    return ladder, revenue * total_impressions
+
+
+def optimize_ladder(ADNETWORKS_list, users, path_log, prices=range(0, MAX_PRICE + 1), certify=True):
+    """Returning the best waterfall of 'High' ad-units (one per ad-network) found for the population, its revenue and
+    whether it is certified optimal.
+    The ladder of estimate_ladder (a heuristic, see there) is scored on the population and, if certify, used as the
+    incumbent of the branch-and-bound of generate_canonical_ladders, which only explores the ladders whose revenue
+    bound is above it: the returned waterfall is then optimal on the population (the optimality comes from the
+    branch-and-bound, the heuristic ladder only prunes it), and is the heuristic ladder unless some ladder strictly
+    beats it. Without certify, the heuristic ladder is returned as an approximate result."""
+
+    logging.basicConfig(filename=path_log, filemode = 'a', level=logging.INFO)
+    logging.info("running dynamic programming")
+
+    ladder, expected_revenue = estimate_ladder(ADNETWORKS_list, prices, users)
+    waterfall = create_waterfall([adnetwork for adnetwork, _ in ladder], [price for _, price in ladder])
+    waterfall.reorder(sort_by='price', reverse=True)
+    _results = waterfall.run(users, reset_waterfall=True)
+    revenue = waterfall.get_revenue()
+    logging.info(f"DP ladder: {ladder}, revenue: {revenue} (under independence: {expected_revenue})")
+    if not certify:
+        logging.info("DP ladder not certified: approximate")
+        return waterfall, revenue, False
+
+    best = [revenue, ladder]
+    cnt = 0
+    for curr_revenue, curr_ladder in generate_canonical_ladders(ADNETWORKS_list, prices, users,
+                                                                lambda: best[0], min_length=1):
+        cnt += 1
+        best = [curr_revenue, curr_ladder]
+    logging.info(f"number of ladders beating the DP ladder: {cnt}")
+    if best[1] != ladder:
+        ladder = best[1]
+        waterfall = create_waterfall([adnetwork for adnetwork, _ in ladder], [price for _, price in ladder])
+        waterfall.reorder(sort_by='price', reverse=True)
+        _results = waterfall.run(users, reset_waterfall=True)
+        revenue = waterfall.get_revenue()
+
+    return waterfall, revenue, True
@@ -0,0 +1,217 @@
+import numpy as np
+from collections import OrderedDict
+
+from classes.engine import WaterfallArrays, SimulationStats, CommonRandomNumbers, get_waterfall_arrays, simulate, \
+    simulate_many, apply_stats
+
+
+class EvaluationCache:
+    """LRU memoization of waterfall scores.
+    The key is a canonical signature of what the simulation depends on: the ordered ad-units (ad-network column, floor
+    price, valuation multiplier and acceptance probability) and the signature of the population, which covers the
+    calibration factors. Two waterfalls reached along different search paths share the same entry."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_signature(arrays, population_signature):
+        return (population_signature,) + tuple(field.tobytes() for field in arrays)
+
+    def get(self, key):
+        stats = self.entries.get(key)
+        if stats is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return stats
+
+    def put(self, key, stats):
+        self.entries[key] = stats
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def get_info(self):
+        requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.entries),
+                "hit_rate": self.hits / requests if requests > 0 else 0.0}
+
+
+class Evaluator:
+    """Scoring waterfalls on a fixed population.UserPopulation.
+    The evaluator keeps the simulation of an incumbent waterfall and, per user, the position of the ad-unit that bought
+    the user. A neighbor waterfall shares its top ad-units with the incumbent, so only the users that reach the first
+    modified ad-unit are re-simulated; the statistics of the unchanged prefix are reused.
+    Scores are memoized in an EvaluationCache of cache_size entries (cache_size=0 disables it).
+    Random acceptances (ad-units with p_acceptance < 1) use the common random numbers of seed: every waterfall sees the
+    same uniform for a given user at a given position, so scores are deterministic and candidates are compared under
+    the same noise."""
+
+    def __init__(self, users, waterfall=None, max_cells=2 ** 22, cache_size=10000, seed=None):
+        self.users = users
+        self.crn = CommonRandomNumbers(len(users), seed)
+        self.max_cells = max_cells  # memory bound of batched evaluations, in (waterfall, user) pairs
+        self.cache = EvaluationCache(cache_size) if cache_size > 0 else None
+        self.population_signature = users.get_signature() if self.cache is not None else None
+        self.n_evaluations = 0
+        self.n_users_simulated = 0
+
+        self.incumbent_arrays = None
+        self.incumbent_stats = None
+        self.users_by_capture = None  # users sorted by the position of the ad-unit that bought them
+        self.reach_start = None  # users reaching ad-unit k are users_by_capture[reach_start[k]:]
+        if waterfall is not None:
+            self.set_incumbent(waterfall)
+
+    def get_arrays(self, waterfall):
+        return get_waterfall_arrays(waterfall.ad_units, self.users.adnetwork_names)
+
+    def set_incumbent(self, waterfall, stats=None):
+        """Setting the waterfall that neighbors are compared to. stats is its SimulationStats, if already known."""
+
+        self.incumbent_arrays = self.get_arrays(waterfall)
+        if stats is None:
+            stats = self.simulate(self.incumbent_arrays, np.arange(len(self.users)))
+        self.incumbent_stats = stats
+        self.users_by_capture = np.argsort(stats.capture, kind='stable')
+        self.reach_start = np.searchsorted(stats.capture[self.users_by_capture],
+                                           np.arange(len(self.incumbent_arrays.prices) + 1))
+
+    def get_uniforms(self, arrays_list, index, start):
+        """Returning the common acceptance uniforms of the users at positions index for waterfall arrays starting at
+        position start, None if no ad-unit accepts at random."""
+
+        if all((arrays.p_acceptance >= 1).all() for arrays in arrays_list):
+            return None
+        return self.crn.get(index, start, max(len(arrays.prices) for arrays in arrays_list))
+
+    def simulate(self, arrays, index, start=0):
+        """Running the users at the given positions through the waterfall arrays (the ad-units of a waterfall from
+        position start)."""
+
+        self.n_users_simulated += len(index)
+        valuation_sums = None if self.users.valuation_sums is None else self.users.valuation_sums[index]
+        return simulate(arrays, self.users.valuations[index], self.users.impressions[index], self.users.scale,
+                        valuation_sums, self.get_uniforms([arrays], index, start))
+
+    def get_first_change(self, arrays):
+        """Returning the position of the first ad-unit that differs from the incumbent waterfall."""
+
+        n_common = min(len(arrays.prices), len(self.incumbent_arrays.prices))
+        same = np.ones(n_common, dtype=bool)
+        for field, incumbent_field in zip(arrays, self.incumbent_arrays):
+            same &= field[:n_common] == incumbent_field[:n_common]
+        return n_common if same.all() else int(np.argmin(same))
+
+    def get_stats(self, arrays):
+        """Returning the SimulationStats of the waterfall arrays, re-simulating only users that reach the first
+        modified ad-unit (capture is None for scores taken from the cache)."""
+
+        self.n_evaluations += 1
+        if self.cache is None:
+            return self.simulate_stats(arrays)
+        key = EvaluationCache.get_signature(arrays, self.population_signature)
+        stats = self.cache.get(key)
+        if stats is None:
+            stats = self.simulate_stats(arrays)
+            self.cache.put(key, stats._replace(capture=None))
+        return stats
+
+    def simulate_stats(self, arrays):
+        if self.incumbent_arrays is None:
+            return self.simulate(arrays, np.arange(len(self.users)))
+
+        k = self.get_first_change(arrays)
+        index = self.users_by_capture[self.reach_start[k]:]
+        suffix = self.simulate(WaterfallArrays(*(field[k:] for field in arrays)), index, k)
+
+        capture = self.incumbent_stats.capture.copy()
+        capture[index] = suffix.capture + k
+        return SimulationStats(*(np.concatenate([prefix[:k], stat])
+                                 for prefix, stat in zip(self.incumbent_stats[:-1], suffix[:-1])), capture)
+
+    def run(self, waterfall, reset_waterfall=True):
+        """Same as Waterfall.run for the evaluator's population."""
+
+        if reset_waterfall:
+            waterfall.reset()
+        stats = self.get_stats(self.get_arrays(waterfall))
+        apply_stats(waterfall.ad_units, stats)
+        return stats
+
+    def get_stats_many(self, arrays_list):
+        """Returning the SimulationStats (without capture) of many waterfall arrays from one batched pass over the
+        users that reach the first ad-unit modified by any of them."""
+
+        self.n_evaluations += len(arrays_list)
+        if self.cache is None:
+            return self.simulate_stats_many(arrays_list)
+
+        keys = [EvaluationCache.get_signature(arrays, self.population_signature) for arrays in arrays_list]
+        stats = {}
+        missing = {}
+        for key, arrays in zip(keys, arrays_list):
+            if key not in stats and key not in missing:
+                cached = self.cache.get(key)
+                if cached is None:
+                    missing[key] = arrays
+                else:
+                    stats[key] = cached
+        for key, key_stats in zip(missing, self.simulate_stats_many(list(missing.values()))):
+            self.cache.put(key, key_stats)
+            stats[key] = key_stats
+        return [stats[key] for key in keys]
+
+    def simulate_stats_many(self, arrays_list):
+        if len(arrays_list) == 0:
+            return []
+        k = 0 if self.incumbent_arrays is None else min(self.get_first_change(arrays) for arrays in arrays_list)
+        suffixes = self.simulate_many([WaterfallArrays(*(field[k:] for field in arrays)) for arrays in arrays_list], k)
+        if k == 0:
+            return suffixes
+        return [SimulationStats(*(np.concatenate([prefix[:k], stat])
+                                  for prefix, stat in zip(self.incumbent_stats[:-1], suffix[:-1])), None)
+                for suffix in suffixes]
+
+    def simulate_many(self, arrays_list, k):
+        """Running the users that reach ad-unit k of the incumbent waterfall through many waterfall arrays (the
+        suffixes of the candidates from ad-unit k)."""
+
+        index = np.arange(len(self.users)) if self.incumbent_arrays is None else \
+            self.users_by_capture[self.reach_start[k]:]
+        self.n_users_simulated += len(index)
+        valuation_sums = None if self.users.valuation_sums is None else self.users.valuation_sums[index]
+        return simulate_many(arrays_list, self.users.valuations[index], self.users.impressions[index],
+                             self.users.scale, valuation_sums, self.max_cells,
+                             self.get_uniforms(arrays_list, index, k))
+
+    def score_many(self, waterfalls):
+        """Returning the SimulationStats of a batch of waterfalls (or waterfall_state.WaterfallState), scored together
+        by a single vectorized pass, without touching their ad-units."""
+
+        return self.get_stats_many([self.get_arrays(waterfall) for waterfall in waterfalls])
+
+    def run_many(self, waterfalls, reset_waterfall=True):
+        """Same as Waterfall.run for a batch of waterfalls, scored together by a single vectorized pass."""
+
+        if reset_waterfall:
+            for waterfall in waterfalls:
+                waterfall.reset()
+        stats = self.score_many(waterfalls)
+        for waterfall, waterfall_stats in zip(waterfalls, stats):
+            apply_stats(waterfall.ad_units, waterfall_stats)
+        return stats
+
+    def close(self):
+        """Releasing the resources of the evaluator (none for the serial evaluator, see parallel.ParallelEvaluator)."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
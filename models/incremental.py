@@ -0,0 +1,287 @@
+"""Re-optimizing a waterfall every time a new batch of users and valuations arrives, e.g. every hour:
+    python -m models.incremental data/valuation_folder/synthetic_valuation_matrix.csv \
+        --waterfall data/waterfall_data/init_synth_waterfall1.csv --name app1 --save-path outputs --log my_log
+Each call ingests the batch into the population of the last --window batches, updates the calibration factors and
+restarts the search from the previous optimum (see IncrementalOptimizer), whose state is kept in
+<save-path>/incremental_<name>.pkl between the calls."""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import numpy as np
+import pandas as pd
+
+from classes.waterfall import Waterfall
+from classes.population import UserPopulation
+from classes.utils import read_valuations, sample_users, optimize_factors
+from classes.cache import get_file_hash, get_cache_key, save_population, load_population, delete_population
+from classes.metrics import RunMetrics
+from classes.consts import EPSILON, INCREMENTAL_WINDOW, INCREMENTAL_GRID, INCREMENTAL_FULL_EVERY
+from models.evaluator import Evaluator
+from models.search_and_score import generate_valid_neighbor_states
+from models.run_algorithms import search_and_score, score_neighbor_states, save_checkpoint, load_checkpoint, \
+    can_compress
+
+
+class IncrementalOptimizer:
+    """Optimizing a waterfall on a stream of valuation batches, each update starting from the previous optimum.
+    - The population is the last window batches (see ingest): every batch is sampled once, kept uncalibrated in
+      save_path/cache and memory-mapped, and the batches older than the window age out.
+    - The calibration factors are learned once on the first population (as create_real_users does), then every update
+      moves each of them by at most one relative step of grid (the current factor is kept on ties), within
+      factor_bounds, starting from the previous factors.
+    - The optimum is kept with a sample of its neighbors and their revenues (see score_neighborhood). When the factors
+      did not change, the revenue of a waterfall on the new population is its previous revenue plus its revenue on the
+      new batch minus its revenue on the aged-out batches, so the neighbors are re-scored on these users only (see
+      rescore_delta); only the neighbors whose revenue moved relative to the optimum's can now beat it. When the factors
+      changed, or every full_every updates, the neighbors are re-scored on the whole population instead.
+    - The search (search_and_score) is restarted only if a neighbor beats the optimum by more than EPSILON, from that
+      neighbor; otherwise the optimum is kept and the update costs the ingestion, the calibration and the re-scoring
+      of the neighbors.
+    The optimizer is pickled to save_path/incremental_{name}.pkl (see save and load), without its populations."""
+
+    def __init__(self, csv_path_waterfall, ADNETWORKS_list, save_path, name, window=INCREMENTAL_WINDOW, beta_size=1,
+                 grid=INCREMENTAL_GRID, full_every=INCREMENTAL_FULL_EVERY, factor_bounds=(0.8, 1.2), seed=None):
+        self.csv_path_waterfall = csv_path_waterfall
+        self.adnetwork_names = list(ADNETWORKS_list)
+        self.save_path = save_path
+        self.name = name
+        self.window = window
+        self.beta_size = beta_size
+        self.grid = grid
+        self.factor_bounds = factor_bounds  # the range of the grid of optimize_factors
+        self.full_every = full_every
+        self.seed = seed
+        self.batches = []  # (batch_id, cache key) of the batches of the population, oldest first
+        self.n_batches = 0  # batches ingested so far
+        self.n_updates = 0
+        self.last_full_update = 0  # last update that scored the neighbors on the whole population
+        self.factors = None
+        self.state = None  # the optimum, a waterfall_state.WaterfallState
+        self.revenue = None
+        self.neighbors = []  # states of the neighbors of the optimum
+        self.neighbor_revenues = np.zeros(0)
+
+    @staticmethod
+    def get_path(save_path, name):
+        return f"{save_path}/incremental_{name}.pkl"
+
+    def save(self):
+        save_checkpoint(IncrementalOptimizer.get_path(self.save_path, self.name), {"optimizer": self})
+
+    @staticmethod
+    def load(save_path, name):
+        """Returning the optimizer saved under name in save_path, None if there is none."""
+
+        # the optimizer draws from its own seed sequences: the global numpy generator of the caller is left as it is
+        checkpoint = load_checkpoint(IncrementalOptimizer.get_path(save_path, name), restore_random_state=False)
+        return None if checkpoint is None else checkpoint["optimizer"]
+
+    def get_cache_dir(self):
+        return f"{self.save_path}/cache"
+
+    def ingest(self, csv_path_users, batch_id=None):
+        """Sampling the users of the valuation csv and adding them to the population, as its newest batch; the batches
+        beyond the window are dropped from the population (but not from the cache yet).
+        Returning the population of the new batch and the (batch_id, cache key) of the dropped batches."""
+
+        seed = None if self.seed is None else np.random.SeedSequence(self.seed, spawn_key=(4, self.n_batches))
+        users = sample_users(read_valuations(csv_path_users), self.adnetwork_names, self.beta_size, seed=seed)
+        key = get_cache_key(get_file_hash(csv_path_users), name=self.name, batch=self.n_batches,
+                            adnetworks=self.adnetwork_names, beta_size=self.beta_size, seed=self.seed)
+        save_population(self.get_cache_dir(), key, users)
+        self.batches.append((self.n_batches if batch_id is None else batch_id, key))
+        self.n_batches += 1
+        removed, self.batches = self.batches[:-self.window], self.batches[-self.window:]
+        return users, removed
+
+    def get_users(self):
+        """Returning the uncalibrated population of the batches of the window."""
+
+        return UserPopulation.concat([load_population(self.get_cache_dir(), key) for _batch_id, key in self.batches])
+
+    def calibrate(self, users, waterfall):
+        """Updating the calibration factors of the uncalibrated population users for the observed waterfall (see
+        utils.optimize_factors). Returning whether the factors changed."""
+
+        if self.factors is None:
+            self.factors = optimize_factors(users, waterfall, {adnetwork: 1 for adnetwork in self.adnetwork_names})
+            return True
+        steps = optimize_factors(users.scaled(self.factors), waterfall,
+                                 {adnetwork: 1 for adnetwork in self.adnetwork_names}, grid=self.grid)
+        factors = {adnetwork: float(np.clip(self.factors[adnetwork] * steps[adnetwork], *self.factor_bounds))
+                   for adnetwork in self.adnetwork_names}
+        changed = factors != self.factors
+        self.factors = factors
+        return changed
+
+    def score_neighborhood(self, users, seed, metrics):
+        """Scoring the optimum and a sample of its valid neighbors (see search_and_score) on the calibrated,
+        compressed population users."""
+
+        neighbors_seed, evaluator_seed = seed.spawn(2)
+        evaluator = Evaluator(users, seed=evaluator_seed)
+        with metrics.phase("simulation"):
+            evaluator.set_incumbent(self.state)
+        self.revenue = float(evaluator.incumbent_stats.revenue.sum())
+        with metrics.phase("neighbors"):
+            neighbors = generate_valid_neighbor_states(self.state, np.random.default_rng(neighbors_seed))
+        scored = score_neighbor_states(evaluator, neighbors, metrics)
+        self.neighbors = [state for state, _stats in scored]
+        self.neighbor_revenues = np.array([float(stats.revenue.sum()) for _state, stats in scored])
+        metrics.add("neighbors_scored", len(scored))
+
+    def rescore_delta(self, added, removed, seed, metrics, compress=True):
+        """Updating the revenues of the optimum and of its neighbors for the batch added and the list of batches
+        removed (uncalibrated populations), by scoring them on these users only (compressed if compress).
+        Returning the number of neighbors whose revenue moved relative to the optimum's."""
+
+        states = [self.state] + self.neighbors
+        deltas = np.zeros(len(states))
+        for batches, sign, batch_seed in zip(([added], removed), (1, -1), seed.spawn(2)):
+            if len(batches) == 0:
+                continue
+            users = UserPopulation.concat(batches).scaled(self.factors)
+            users = users.compress() if compress else users
+            evaluator = Evaluator(users, cache_size=0, seed=batch_seed)
+            with metrics.phase("simulation"):
+                evaluator.set_incumbent(self.state)  # the neighbors share their top ad-units with the optimum
+                deltas += sign * np.array([float(stats.revenue.sum()) for stats in evaluator.score_many(states)])
+        self.revenue += deltas[0]
+        self.neighbor_revenues = self.neighbor_revenues + deltas[1:]
+        return int((np.abs(deltas[1:] - deltas[0]) > 1e-9).sum())
+
+    def get_start(self, best, users, seed, metrics):
+        """Returning the neighbor best as the waterfall the search restarts from, with its simulation fields on the
+        calibrated, compressed population users (search_and_score deletes the ad-units that sell too little)."""
+
+        evaluator = Evaluator(users, cache_size=0, seed=seed)
+        with metrics.phase("simulation"):
+            stats = evaluator.score_many([self.neighbors[best]])[0]
+        return Waterfall.from_state(self.neighbors[best], stats)
+
+    def update(self, csv_path_users, batch_id=None, csv_path_waterfall=None, **search_params):
+        """Ingesting the valuation csv of a new batch and re-optimizing the waterfall. csv_path_waterfall is the
+        observed waterfall the factors are calibrated on (the previous one if None); its impressions should cover the
+        period of the window. search_params are passed to search_and_score (e.g. time_budget, max_evaluations).
+        The optimum is saved to save_path/final_incremental_waterfall_{name}.csv and a row describing the update is
+        appended to save_path/incremental_{name}.csv; the outputs of the last search are those of search_and_score
+        for the name incremental_{name}.
+        Returning the optimal waterfall and its revenue."""
+
+        metrics = RunMetrics().start()
+        self.n_updates += 1
+        update_seed = np.random.SeedSequence(self.seed, spawn_key=(5, self.n_updates)) if self.seed is not None else \
+            np.random.SeedSequence()
+        delta_seed, neighbors_seed, start_seed, search_seed = update_seed.spawn(4)
+        if csv_path_waterfall is not None:
+            self.csv_path_waterfall = csv_path_waterfall
+        waterfall = Waterfall(csv_path=self.csv_path_waterfall)
+
+        with metrics.phase("load_users"):
+            added, removed = self.ingest(csv_path_users, batch_id)
+            users = self.get_users()
+        with metrics.phase("calibration"):
+            factors_changed = self.calibrate(users, waterfall)
+        compress = can_compress(waterfall)  # the searched waterfalls keep the prices of the observed one on the grid
+        with metrics.phase("load_users"):
+            compressed_users = users.scaled(self.factors)
+            if compress:
+                compressed_users = compressed_users.compress()
+
+        n_moved = None
+        if self.state is None:
+            mode, start = "initial", waterfall
+        else:
+            if factors_changed or (self.full_every is not None and
+                                   self.n_updates - self.last_full_update >= self.full_every):
+                mode = "full"
+                self.score_neighborhood(compressed_users, neighbors_seed, metrics)
+                self.last_full_update = self.n_updates
+            else:
+                mode = "delta"
+                removed_users = [load_population(self.get_cache_dir(), key) for _batch_id, key in removed]
+                with metrics.phase("delta"):
+                    n_moved = self.rescore_delta(added, removed_users, delta_seed, metrics, compress)
+            best = int(np.argmax(self.neighbor_revenues)) if len(self.neighbors) > 0 else None
+            # as the stop condition of search_and_score, a neighbor must improve the optimum by more than EPSILON
+            start = None if best is None or self.neighbor_revenues[best] - self.revenue <= EPSILON else \
+                self.get_start(best, compressed_users, start_seed, metrics)
+        logging.info(f"incremental update {self.n_updates} of {self.name}: batch {self.batches[-1][0]}, "
+                     f"{len(self.batches)} batches, {len(users)} users, factors: {self.factors}, mode: {mode}, "
+                     f"moved neighbors: {n_moved}, search: {start is not None}")
+
+        if start is not None:  # a neighbor beats the optimum, or there is none yet: restart the search from it
+            # the outputs of the search are replaced at every update, under the name of the incremental optimization
+            best_waterfall, _save_best_revenue, _stopped = search_and_score(
+                start, compressed_users, f"incremental_{self.name}", self.save_path, 0, metrics=metrics,
+                seed=None if self.seed is None else int(search_seed.generate_state(1)[0]), **search_params)
+            self.state = best_waterfall.to_state()
+            self.score_neighborhood(compressed_users, neighbors_seed, metrics)
+            self.last_full_update = self.n_updates
+        for _batch_id, key in removed:
+            delete_population(self.get_cache_dir(), key)
+        metrics.stop()
+
+        best_waterfall = Waterfall.from_state(self.state)
+        row = {"update": self.n_updates, "batch_id": self.batches[-1][0], "n_batches": len(self.batches),
+               "n_users": len(users), "n_cells": len(compressed_users), "factors_changed": factors_changed,
+               "mode": mode, "n_neighbors": len(self.neighbors), "n_moved": n_moved, "search": start is not None,
+               "revenue": self.revenue, "seconds": metrics.seconds}
+        history_path = f"{self.save_path}/incremental_{self.name}.csv"
+        with metrics.phase("output"):
+            best_waterfall.get_df().to_csv(f"{self.save_path}/final_incremental_waterfall_{self.name}.csv",
+                                           index=False)
+            pd.DataFrame([row]).to_csv(history_path, mode='a', header=not os.path.exists(history_path), index=False)
+            metrics.save(f"{self.save_path}/metrics_incremental_{self.name}.json")
+        self.save()
+        return best_waterfall, self.revenue
+
+
+def run_incremental(csv_path_users, csv_path_waterfall, name, save_path, path_log, ADNETWORKS_list, batch_id=None,
+                    window=INCREMENTAL_WINDOW, beta_size=1, grid=INCREMENTAL_GRID, full_every=INCREMENTAL_FULL_EVERY,
+                    seed=None, **search_params):
+    """Ingesting the valuation csv of a new batch into the incremental optimization of name (see
+    IncrementalOptimizer), which is created from the observed waterfall csv on the first call and resumed from
+    save_path on the next ones (window, beta_size, grid, full_every and seed are then those of the first call);
+    csv_path_waterfall is the waterfall the factors are calibrated on.
+    Returning the optimal waterfall and its revenue."""
+
+    logging.basicConfig(filename=path_log, filemode='a', level=logging.INFO)
+    os.makedirs(save_path, exist_ok=True)
+    start_time = time.time()
+    optimizer = IncrementalOptimizer.load(save_path, name)
+    if optimizer is None:
+        optimizer = IncrementalOptimizer(csv_path_waterfall, ADNETWORKS_list, save_path, name, window=window,
+                                         beta_size=beta_size, grid=grid, full_every=full_every, seed=seed)
+    waterfall, revenue = optimizer.update(csv_path_users, batch_id, csv_path_waterfall, **search_params)
+    logging.info(f"incremental update of {name} done in {time.time() - start_time:.1f}s, revenue: {revenue}")
+    return waterfall, revenue
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("valuation", help="valuation csv of the new batch")
+    parser.add_argument("--waterfall", required=True, help="observed waterfall csv the factors are calibrated on")
+    parser.add_argument("--name", required=True, help="name of the incremental optimization")
+    parser.add_argument("--batch-id", default=None, help="label of the batch (its number by default)")
+    parser.add_argument("--save-path", default="outputs", help="directory of the outputs and of the state")
+    parser.add_argument("--log", default="my_log", help="log file")
+    parser.add_argument("--window", type=int, default=INCREMENTAL_WINDOW, help="number of batches kept")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--max-evaluations", type=int, default=None, help="evaluations budget of a search")
+    parser.add_argument("--time-budget", type=float, default=None, help="seconds budget of a search")
+    args = parser.parse_args(argv)
+
+    adnetworks = pd.read_csv(args.valuation, sep=',', index_col=0, nrows=1).columns[3:]
+    waterfall, revenue = run_incremental(args.valuation, args.waterfall, args.name, args.save_path, args.log,
+                                         adnetworks, batch_id=args.batch_id, window=args.window, seed=args.seed,
+                                         max_evaluations=args.max_evaluations, time_budget=args.time_budget)
+    print(waterfall.get_df())
+    print(f"revenue: {revenue}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,166 @@
+import math
+import time
+import numpy as np
+
+from classes.engine import get_rng
+from classes.metrics import RunMetrics
+from classes.consts import N_SIMULATIONS, ROLLOUT_DEPTH, ROLLOUT_WIDTH, EXPLORATION
+from models.search_and_score import generate_valid_neighbor_states, delete_invalid_ad_units
+
+
+class Node:
+    """Node of the search tree: a waterfall_state.WaterfallState, its engine.SimulationStats and the UCT statistics of
+    the simulations that went through it."""
+
+    def __init__(self, state, stats, parent=None):
+        self.state = state
+        self.stats = stats
+        self.revenue = float(stats.revenue.sum())
+        self.parent = parent
+        self.children = []
+        self.untried = None  # neighbor states not expanded yet, generated on the first visit
+        self.visits = 0
+        self.total_reward = 0.0  # sum of the (raw) revenues backpropagated through the node
+
+    def is_expandable(self):
+        return self.untried is None or len(self.untried) > 0
+
+
+class MonteCarloTreeSearch:
+    """UCT Monte-Carlo tree search over waterfall states.
+    A simulation selects a path of the tree by UCT, expands one untried neighbor of the last node, plays a rollout of
+    rollout_depth moves from it and backpropagates the best revenue met on the way. Rollouts are 'random' (one random
+    neighbor per move) or 'heuristic' (the best of rollout_width random neighbors, scored in one batch).
+    The tree is kept between iterations: advance() moves the root to its best improving child and keeps its subtree.
+    Every simulation costs 1 + rollout_depth * rollout_width evaluations at most, so the cost of an iteration is set by
+    n_simulations and / or time_budget instead of growing with the number of neighbors.
+    All the random choices (neighbor price steps, expansion order, rollout samples) are drawn from the numpy Generator
+    rng, which is pickled with the tree.
+    The neighbors generation, simulation and delete_invalid phases are timed in metrics (a metrics.RunMetrics)."""
+
+    def __init__(self, evaluator, state, stats=None, exploration=EXPLORATION, rollout='heuristic',
+                 rollout_depth=ROLLOUT_DEPTH, rollout_width=ROLLOUT_WIDTH, rng=None, metrics=None):
+        assert rollout in ('random', 'heuristic'), f"unknown rollout: {rollout}"
+        self.evaluator = evaluator
+        self.metrics = RunMetrics() if metrics is None else metrics
+        self.rng = get_rng(rng)
+        self.exploration = exploration
+        self.rollout_depth = rollout_depth
+        self.rollout_width = rollout_width if rollout == 'heuristic' else 1
+        self.n_evaluations = 0
+        self.max_evaluations = None  # the evaluations budget of the current search
+
+        if stats is None:
+            stats = self.evaluator.score_many([state])[0]
+            self.n_evaluations += 1
+        self.root = Node(state, stats)
+        self.best_state, self.best_stats, self.best_revenue = state, stats, self.root.revenue
+        self.min_reward = self.max_reward = self.root.revenue  # rewards are normalized by the range seen so far
+
+    def __getstate__(self):
+        # the tree is checkpointed without the evaluator (population, cache, worker pool) and the metrics of the run,
+        # which are set on resume
+        return {key: value for key, value in self.__dict__.items() if key not in ('evaluator', 'metrics')}
+
+    def score(self, states):
+        """Scoring states, deleting their invalid instances and re-scoring the states that changed.
+        Returning a list of (state, stats) pairs."""
+
+        with self.metrics.phase("simulation"):
+            stats = self.evaluator.score_many(states)
+        self.n_evaluations += len(states)
+        with self.metrics.phase("delete_invalid"):
+            cleaned = [delete_invalid_ad_units(state, state_stats) for state, state_stats in zip(states, stats)]
+        changed = [i for i, (state, new_state) in enumerate(zip(states, cleaned)) if len(new_state) != len(state)]
+        with self.metrics.phase("simulation"):
+            for i, new_stats in zip(changed, self.evaluator.score_many([cleaned[i] for i in changed])):
+                stats[i] = new_stats
+        self.n_evaluations += len(changed)
+        for state, state_stats in zip(cleaned, stats):
+            revenue = float(state_stats.revenue.sum())
+            if revenue > self.best_revenue:
+                self.best_state, self.best_stats, self.best_revenue = state, state_stats, revenue
+        return list(zip(cleaned, stats))
+
+    def get_uct(self, node, child):
+        if self.max_reward > self.min_reward:
+            mean = (child.total_reward / child.visits - self.min_reward) / (self.max_reward - self.min_reward)
+        else:
+            mean = 0.0
+        return mean + self.exploration * math.sqrt(math.log(node.visits) / child.visits)
+
+    def select(self):
+        node = self.root
+        while not node.is_expandable() and len(node.children) > 0:
+            node = max(node.children, key=lambda child: self.get_uct(node, child))
+        return node
+
+    def expand(self, node):
+        if node.untried is None:
+            with self.metrics.phase("neighbors"):
+                node.untried = generate_valid_neighbor_states(node.state, self.rng)
+            self.metrics.add("neighbors_generated", len(node.untried))
+            self.rng.shuffle(node.untried)
+        if len(node.untried) == 0:
+            return node
+        state, stats = self.score([node.untried.pop()])[0]
+        child = Node(state, stats, parent=node)
+        node.children.append(child)
+        return child
+
+    def rollout(self, node):
+        """Returning the best revenue met in a rollout of rollout_depth moves from node."""
+
+        state, reward = node.state, node.revenue
+        for _ in range(self.rollout_depth):
+            if self.max_evaluations is not None and self.n_evaluations >= self.max_evaluations:
+                break
+            with self.metrics.phase("neighbors"):
+                neighbors = generate_valid_neighbor_states(state, self.rng)
+            self.metrics.add("neighbors_generated", len(neighbors))
+            if len(neighbors) == 0:
+                break
+            sample = self.rng.choice(len(neighbors), min(self.rollout_width, len(neighbors)), replace=False)
+            scored = self.score([neighbors[j] for j in sample])
+            state, stats = max(scored, key=lambda neighbor: float(neighbor[1].revenue.sum()))
+            reward = max(reward, float(stats.revenue.sum()))
+        return reward
+
+    def backpropagate(self, node, reward):
+        self.min_reward = min(self.min_reward, reward)
+        self.max_reward = max(self.max_reward, reward)
+        while node is not None:
+            node.visits += 1
+            node.total_reward += reward
+            node = node.parent
+
+    def search(self, n_simulations=N_SIMULATIONS, time_budget=None, max_evaluations=None):
+        """Running simulations until n_simulations were run, time_budget seconds passed or the search made
+        max_evaluations evaluations in total (None for no limit); the budget is also checked before every scored batch
+        of a rollout. Without any limit, n_simulations is N_SIMULATIONS.
+        Returning the number of simulations."""
+
+        if n_simulations is None and time_budget is None and max_evaluations is None:
+            n_simulations = N_SIMULATIONS
+        start = time.time()
+        self.max_evaluations = max_evaluations
+        cnt = 0
+        while (n_simulations is None or cnt < n_simulations) and \
+                (time_budget is None or time.time() - start < time_budget) and \
+                (max_evaluations is None or self.n_evaluations < max_evaluations):
+            node = self.expand(self.select())
+            self.backpropagate(node, self.rollout(node))
+            cnt += 1
+        return cnt
+
+    def advance(self):
+        """Moving the root to the child with the best mean reward among the children whose revenue is above the
+        root's, keeping the subtree below it (as S&S adopts a neighbor only if it beats the incumbent); the root is
+        kept, with its whole tree, if no child beats it.
+        Returning the root."""
+
+        children = [child for child in self.root.children if child.revenue > self.root.revenue]
+        if len(children) > 0:
+            self.root = max(children, key=lambda child: child.total_reward / max(child.visits, 1))
+            self.root.parent = None
+        return self.root
@@ -0,0 +1,108 @@
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+from classes.engine import CommonRandomNumbers, simulate_many
+from models.evaluator import Evaluator
+
+# Per-process state of the pool workers, set once by init_worker.
+_worker = {}
+
+
+def share_array(array):
+    """Copying array into a new shared memory block; returning the block and a light descriptor to attach it."""
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(descriptor):
+    """Attaching to a shared memory block created by share_array, without copying it."""
+
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def init_worker(descriptors, scale, max_cells, seed, worker_ids):
+    """Attaching a pool worker to the shared population (valuations, impressions, valuation_sums) and to the shared
+    users_by_capture index of the evaluator's incumbent waterfall. The worker rebuilds the evaluator's common random
+    numbers from their seed, and takes its own independent stream (for the other draws) from its id in the worker_ids
+    queue."""
+
+    _worker["scale"] = scale
+    _worker["max_cells"] = max_cells
+    _worker["shms"] = []
+    for key, descriptor in descriptors.items():
+        if descriptor is None:
+            _worker[key] = None
+        else:
+            shm, _worker[key] = attach_array(descriptor)
+            _worker["shms"].append(shm)  # keep the blocks open as long as the worker lives
+    _worker["crn"] = CommonRandomNumbers(len(_worker["impressions"]), seed)
+    _worker["rng"] = _worker["crn"].get_stream(1, worker_ids.get())
+
+
+def simulate_many_task(task):
+    """Scoring a part of a batch of waterfall arrays (the suffixes of the candidates from ad-unit k) on the users
+    users_by_capture[start:]."""
+
+    arrays_list, start, k = task
+    index = _worker["users_by_capture"][start:]
+    valuation_sums = None if _worker["valuation_sums"] is None else _worker["valuation_sums"][index]
+    uniforms = None if all((arrays.p_acceptance >= 1).all() for arrays in arrays_list) else \
+        _worker["crn"].get(index, k, max(len(arrays.prices) for arrays in arrays_list))
+    return simulate_many(arrays_list, _worker["valuations"][index], _worker["impressions"][index], _worker["scale"],
+                         valuation_sums, _worker["max_cells"], uniforms, _worker["rng"])
+
+
+class ParallelEvaluator(Evaluator):
+    """Evaluator that scores batches of waterfalls on a pool of worker processes.
+    The population is placed once in shared memory and never pickled per task: a task only holds the candidates arrays
+    (prices, ad-network columns, multipliers, p_acceptance) and the position from which users are re-simulated.
+    Results are the same as the serial Evaluator's (workers share its common random numbers), so the adopt-best logic
+    of the search is unchanged."""
+
+    def __init__(self, users, waterfall=None, max_cells=2 ** 22, cache_size=10000, n_jobs=None, seed=None):
+        self.n_jobs = n_jobs if n_jobs is not None else multiprocessing.cpu_count()
+        seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        worker_ids = multiprocessing.Queue()
+        for worker_id in range(self.n_jobs):
+            worker_ids.put(worker_id)
+        self.shms = {}
+        descriptors = {}
+        for key, array in (("valuations", users.valuations), ("impressions", users.impressions),
+                           ("valuation_sums", users.valuation_sums), ("users_by_capture", np.arange(len(users)))):
+            if array is None:
+                descriptors[key] = None
+            else:
+                self.shms[key], descriptors[key] = share_array(array)
+        self.shared_users_by_capture = np.ndarray(len(users), dtype=int, buffer=self.shms["users_by_capture"].buf)
+        self.pool = multiprocessing.Pool(self.n_jobs, initializer=init_worker,
+                                         initargs=(descriptors, users.scale, max_cells, seed, worker_ids))
+        super().__init__(users, waterfall=waterfall, max_cells=max_cells, cache_size=cache_size, seed=seed)
+
+    def set_incumbent(self, waterfall, stats=None):
+        super().set_incumbent(waterfall, stats)
+        self.shared_users_by_capture[...] = self.users_by_capture  # workers are idle between batches
+
+    def simulate_many(self, arrays_list, k):
+        start = 0 if self.incumbent_arrays is None else self.reach_start[k]
+        self.n_users_simulated += len(self.users) - start
+        parts = np.array_split(np.arange(len(arrays_list)), min(self.n_jobs, len(arrays_list)))
+        tasks = [([arrays_list[j] for j in part], start, k) for part in parts]
+        return [stats for part_stats in self.pool.map(simulate_many_task, tasks) for stats in part_stats]
+
+    def close(self):
+        """Stopping the workers and releasing the shared memory (once, later calls do nothing)."""
+
+        if not self.shms:
+            return
+        self.pool.close()
+        self.pool.join()
+        del self.shared_users_by_capture
+        for shm in self.shms.values():
+            shm.close()
+            shm.unlink()
+        self.shms = {}
@@ -0,0 +1,96 @@
+import numpy as np
+from scipy.stats import norm
+
+from classes.engine import simulate_user_revenue, get_rng
+from classes.consts import RACING_FRACTIONS, RACING_CONFIDENCE
+
+
+class NeighborRacing:
+    """Racing neighbors against the incumbent waterfall of an evaluator.Evaluator on growing user subsamples.
+    The samples are stratified by the ad-unit of the incumbent that bought the user (plus the users it did not sell),
+    and nested: at every stage the first sample_fractions[s] of each (randomly permuted) stratum is used. At each stage
+    the revenue difference between every surviving neighbor and the incumbent is estimated with its stratified
+    variance, and a neighbor is dropped when even its upper confidence bound is below 0, i.e. it is below the
+    incumbent with the given confidence. A neighbor often changes the outcome of a few users only (e.g. a one dollar
+    price step), which a sample may miss entirely and then shows no variance at all; so the variance of every sampled
+    stratum is computed with one more pseudo-observation, the largest gain a user of the stratum can bring (the highest
+    price of the neighbor minus the price the user pays to the incumbent, times the user's impressions). Dropped
+    neighbors cannot be adopted by S&S, which only adopts neighbors above the incumbent revenue, so only the survivors
+    need a full-population evaluation.
+    Neighbors are simulated with the evaluator's common random numbers, the noise the incumbent was simulated with, so
+    random acceptances do not add to the variance of the differences.
+    The neighbors are raced as generated, while S&S adopts them after deleting their invalid ad-units (see
+    search_and_score.delete_invalid_ad_units), which needs their full-population statistics. A deletion only removes
+    ad-units that sold almost nothing, so it seldom moves a neighbor across the incumbent, but a neighbor that would
+    beat the incumbent only once cleaned can be dropped."""
+
+    def __init__(self, evaluator, sample_fractions=RACING_FRACTIONS, confidence=RACING_CONFIDENCE, rng=None):
+        self.evaluator = evaluator
+        self.sample_fractions = sample_fractions
+        self.z = norm.ppf(confidence)
+        self.rng = get_rng(rng)
+        self.n_raced = 0
+        self.n_dropped = 0
+        self.n_users_simulated = 0  # (neighbor, user) pairs simulated on the samples
+        # (neighbor, user) pairs the evaluator would have simulated for the dropped neighbors, i.e. the users reaching
+        # their first change from the incumbent
+        self.n_users_skipped = 0
+
+    def get_strata(self):
+        evaluator = self.evaluator
+        bounds = list(evaluator.reach_start) + [len(evaluator.users)]
+        return [self.rng.permutation(evaluator.users_by_capture[bounds[k]:bounds[k + 1]])
+                for k in range(len(bounds) - 1) if bounds[k + 1] > bounds[k]]
+
+    def race(self, neighbors):
+        """Returning the neighbors (waterfall states or waterfalls) that survived the racing, in their order."""
+
+        evaluator = self.evaluator
+        users = evaluator.users
+        incumbent = evaluator.incumbent_arrays
+        capture = evaluator.incumbent_stats.capture
+        incumbent_prices = np.append(incumbent.prices, 0)  # capture == number of ad-units: no ad-unit bought the user
+        arrays_list = [evaluator.get_arrays(neighbor) for neighbor in neighbors]
+        n_reaching = np.array([len(users) - evaluator.reach_start[evaluator.get_first_change(arrays)]
+                               for arrays in arrays_list], dtype=int)
+        strata = self.get_strata()
+        max_prices = np.array([arrays.prices.max(initial=0) for arrays in arrays_list])
+        # the price paid to the incumbent by the users of a stratum, and their largest impressions
+        strata_bounds = [(incumbent_prices[capture[stratum[0]]], users.impressions[stratum].max())
+                         for stratum in strata]
+
+        alive = np.arange(len(neighbors))
+        for fraction in self.sample_fractions:
+            if len(alive) == 0:
+                break
+            sizes = [min(len(stratum), max(int(np.ceil(fraction * len(stratum))), 2)) for stratum in strata]
+            index = np.concatenate([stratum[:size] for stratum, size in zip(strata, sizes)])
+            alive_arrays = [arrays_list[j] for j in alive]
+            revenue = simulate_user_revenue(alive_arrays, users.valuations[index], users.impressions[index],
+                                            users.scale, evaluator.get_uniforms(alive_arrays, index, 0))
+            difference = revenue - incumbent_prices[capture[index]] * users.impressions[index]
+
+            estimate = np.zeros(len(alive))
+            variance = np.zeros(len(alive))
+            start = 0
+            for stratum, size, (price, max_impressions) in zip(strata, sizes, strata_bounds):
+                stratum_difference = difference[:, start:start + size]
+                estimate += len(stratum) / size * stratum_difference.sum(axis=1)
+                if size < len(stratum):
+                    max_gain = np.maximum(max_prices[alive] - price, 0) * max_impressions
+                    variance += len(stratum) ** 2 * (1 - size / len(stratum)) * \
+                        np.column_stack([stratum_difference, max_gain]).var(axis=1, ddof=1) / size
+                start += size
+
+            keep = estimate + self.z * np.sqrt(variance) >= 0
+            self.n_users_simulated += len(alive) * len(index)
+            self.n_users_skipped += int(n_reaching[alive[~keep]].sum())
+            alive = alive[keep]
+
+        self.n_raced += len(neighbors)
+        self.n_dropped += len(neighbors) - len(alive)
+        return [neighbors[j] for j in alive]
+
+    def get_info(self):
+        return {"raced": self.n_raced, "dropped": self.n_dropped, "users_simulated": self.n_users_simulated,
+                "users_saved": self.n_users_skipped - self.n_users_simulated}
@@ -1,20 +1,417 @@
 import copy
 import os
+import time
 import pickle
+import cProfile
+import multiprocessing
+import numpy as np
 import pandas as pd
 import logging
 
+from classes.ad_unit import AdUnit
 from classes.waterfall import Waterfall
 from classes.utils import create_real_users
-from classes.consts import EPSILON, MAX_ITER, VALIDATION
-from models.search_and_score import generate_valid_neighbors, delete_invalid_instances, generate_all_neighbors
+from classes.population import is_on_price_grid
+from classes.cache import get_file_hash, get_cache_key, save_population, load_population
+from classes.metrics import RunMetrics
+from classes.trace import TraceWriter
+from classes.consts import EPSILON, MAX_ITER, VALIDATION, N_SIMULATIONS, RACING_CONFIDENCE
+from models.evaluator import Evaluator
+from models.parallel import ParallelEvaluator
+from models.dynamic_programming import optimize_ladder
+from models.mcts import MonteCarloTreeSearch
+from models.racing import NeighborRacing
+from models.search_and_score import generate_valid_neighbor_states, delete_invalid_instances, delete_invalid_ad_units, \
+    generate_all_neighbors
 
 
-def run_model(csv_path_waterfall, csv_path_users, waterfall_name, save_path, path_log, alg, ADNETWORKS_list, flag = False):
+def score_neighbor_states(evaluator, neighbors, metrics=None):
+    """Scoring a batch of neighbor states, deleting their invalid instances and re-scoring them (timed in the
+    'simulation' and 'delete_invalid' phases of metrics, a metrics.RunMetrics).
+    Returning a list of (state, stats) pairs."""
+
+    metrics = RunMetrics() if metrics is None else metrics
+    with metrics.phase("simulation"):
+        stats = evaluator.score_many(neighbors)
+    with metrics.phase("delete_invalid"):
+        neighbors = [delete_invalid_ad_units(n, n_stats) for n, n_stats in zip(neighbors, stats)]
+    with metrics.phase("simulation"):
+        return list(zip(neighbors, evaluator.score_many(neighbors)))
+
+
+def can_compress(waterfall):
+    """Returning whether the searches from waterfall can run on the compressed population (see
+    UserPopulation.compress): its ad-units accept every user valued at their floor price or more (p_acceptance of 1)
+    and their prices are whole dollars between 0 and MAX_PRICE, which the price changes of the searches keep them."""
+
+    return all(ad_unit.p_acceptance >= 1 for ad_unit in waterfall.ad_units) and \
+        is_on_price_grid([ad_unit.price for ad_unit in waterfall.ad_units])
+
+
+def get_users(csv_path_users, csv_path_waterfall, waterfall, ADNETWORKS_list, save_path, beta_size=1, fold=None,
+              seed=None, compress=True, users_df=None):
+    """Returning the calibrated, compressed population of the valuation csv for the given initial waterfall (the
+    calibrated, per-user population if not compress).
+    The calibrated population and its compressed form are cached in save_path/cache under a key hashing the two csv
+    files, the ad-networks, beta_size, the cross-validation fold (each fold draws its own valuations) and the seed, and
+    are memory-mapped on warm runs; the calibration factors are cached there too (see create_real_users). With a
+    seed, the valuations of every fold are drawn from their own stream.
+    users_df is the already parsed valuation csv, if any (see create_real_users).
+    The population is not compressed for waterfalls it would not be lossless for (see can_compress)."""
+
+    compress = compress and can_compress(waterfall)
+    key = get_cache_key(get_file_hash(csv_path_users), get_file_hash(csv_path_waterfall), adnetworks=ADNETWORKS_list,
+                        beta_size=beta_size, fold=fold, seed=seed)
+    compressed_users = load_population(f"{save_path}/cache", f"{key}_compressed") if compress else None
+    if compressed_users is not None:
+        return compressed_users
+
+    users = load_population(f"{save_path}/cache", key)
+    if users is None:
+        users = create_real_users(path=csv_path_users, init_waterfall=waterfall, adnetwork_names=ADNETWORKS_list,
+                                  users_df=users_df, beta_size=beta_size, seed=None if seed is None else
+                                  np.random.SeedSequence(seed, spawn_key=(0, 0 if fold is None else fold + 1)),
+                                  cache_dir=f"{save_path}/cache")
+        save_population(f"{save_path}/cache", key, users)
+    if not compress:
+        return users
+    compressed_users = users.compress()  # lossless on the integer price grid, scales with the number of distinct cells
+    save_population(f"{save_path}/cache", f"{key}_compressed", compressed_users)
+    return compressed_users
+
+
+def save_checkpoint(path, checkpoint):
+    """Pickling the checkpoint dict to path (the search's numpy Generators are pickled with their state), with the
+    state of the legacy global numpy generator and the ad-unit ids counter.
+    The file is replaced atomically, so a job killed while writing keeps its previous checkpoint."""
+
+    checkpoint = dict(checkpoint, np_random_state=np.random.get_state(), n_ad_unit=AdUnit.n_ad_unit)
+    with open(f"{path}.tmp", "wb") as fp:
+        pickle.dump(checkpoint, fp)
+    os.replace(f"{path}.tmp", path)
+
+
+def load_checkpoint(path, restore_random_state=True):
+    """Returning the checkpoint dict saved at path (None if there is none), restoring the ad-unit ids counter and, with
+    restore_random_state (to resume a search), the legacy global numpy generator."""
+
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as fp:
+        checkpoint = pickle.load(fp)
+    if restore_random_state:
+        np.random.set_state(checkpoint["np_random_state"])
+    AdUnit.n_ad_unit = max(AdUnit.n_ad_unit, checkpoint["n_ad_unit"])
+    return checkpoint
+
+
+def get_checkpoint_path(save_path, alg, waterfall_name, users, seed, i=None):
+    """Returning the checkpoint path of a search of alg on the population users, under a key hashing the population
+    (see UserPopulation.get_signature, which covers the valuation and waterfall csv files it was drawn from and the
+    calibration) and the seed, so a run on other inputs or with another seed never resumes from it."""
+
+    key = get_cache_key(users.get_signature(), seed=seed)
+    return f"{save_path}/checkpoint_{alg}_{waterfall_name}{'' if i is None else f'_{i}'}_{key}.pkl"
+
+
+def is_budget_exhausted(start_time, time_budget, n_evaluations, max_evaluations):
+    """Checking if the run used its time_budget (seconds since start_time) or its max_evaluations (None for no
+    limit)."""
+
+    return (time_budget is not None and time.time() - start_time >= time_budget) or \
+        (max_evaluations is not None and n_evaluations >= max_evaluations)
+
+
+def add_evaluator_metrics(metrics, evaluator):
+    """Adding the counters of an evaluator.Evaluator (evaluations, users simulated, cache hits and misses) to
+    metrics."""
+
+    metrics.add("evaluations", evaluator.n_evaluations)
+    metrics.add("users_simulated", evaluator.n_users_simulated)
+    if evaluator.cache is not None:
+        metrics.add("cache_hits", evaluator.cache.hits)
+        metrics.add("cache_misses", evaluator.cache.misses)
+
+
+def search_and_score(waterfall, users, waterfall_name, save_path, i, n_jobs=1, seed=None, start_time=None,
+                     time_budget=None, max_evaluations=None, checkpoint_every=None, racing_fractions=None,
+                     racing_confidence=RACING_CONFIDENCE, metrics=None, dump_every=None):
+    """Running S&S from waterfall on the (compressed) population users, as the i-th run of waterfall_name, and saving
+    its final waterfall, revenue trace and neighbors counts to save_path. The budget, checkpoint, racing and seed
+    arguments are those of run_model; start_time is when the budget started (now if None).
+    The phases and counters of the search are recorded in metrics (a metrics.RunMetrics), which also notifies its
+    callbacks of the iterations and adoptions. The iterations and adoptions are traced to
+    save_path/trace_SandS_{waterfall_name}_{i}.jsonl (see trace.TraceWriter); the full waterfall is logged only at the
+    start, at the end and every dump_every iterations.
+    Returning the final waterfall, the revenue trace and whether the budget was exhausted."""
+
+    start_time = time.time() if start_time is None else start_time
+    metrics = RunMetrics() if metrics is None else metrics
+    stopped = False  # set when the time or evaluations budget is exhausted
+    convergence = 1
+    iter = 0
+    cnt = 0
+
+    search_seed, evaluator_seed, racing_seed = np.random.SeedSequence(seed, spawn_key=(1, i)).spawn(3)
+    rng = np.random.default_rng(search_seed)
+
+    evaluator = Evaluator(users, seed=evaluator_seed) if n_jobs == 1 else \
+        ParallelEvaluator(users, n_jobs=n_jobs, seed=evaluator_seed)
+    try:
+        save_best_revenue = []
+        with metrics.phase("delete_invalid"):
+            waterfall = delete_invalid_instances(waterfall)
+        with metrics.phase("simulation"):
+            evaluator.run(waterfall)  # run users in the waterfall, with the common random numbers of the search
+        logging.info("VALIDATION: " + str(i))
+        logging.info("init waterfall:")
+        with metrics.phase("logging"):
+            TraceWriter.dump(waterfall)
+        init_revenue = waterfall.get_revenue()
+        save_best_revenue.append(init_revenue)
+        logging.info(f"init revenue: {init_revenue}")
+
+        # start search and score
+        racing = NeighborRacing(evaluator, racing_fractions, racing_confidence,
+                                np.random.default_rng(racing_seed)) if racing_fractions else None
+        state = waterfall.to_state()  # the search works on immutable states, waterfalls are kept for reporting
+        iter_revenue = init_revenue
+        revenue = init_revenue
+        save_waterfalls = []
+        num_neighbors = [0]
+        checkpoint_path = get_checkpoint_path(save_path, "SandS", waterfall_name, users, seed, i)
+        checkpoint = load_checkpoint(checkpoint_path) if checkpoint_every is not None else None
+        if checkpoint is not None:  # resume the search where the checkpoint was saved
+            convergence, iter, cnt = checkpoint["convergence"], checkpoint["iter"], checkpoint["cnt"]
+            state, revenue, iter_revenue = checkpoint["state"], checkpoint["revenue"], checkpoint["iter_revenue"]
+            save_best_revenue, num_neighbors = checkpoint["save_best_revenue"], checkpoint["num_neighbors"]
+            save_waterfalls, rng = checkpoint["save_waterfalls"], checkpoint["rng"]
+            if racing is not None:
+                racing.rng = checkpoint["racing_rng"]
+            waterfall = Waterfall.from_state(state, evaluator.score_many([state])[0])
+            logging.info(f"resuming from checkpoint: iteration: {iter}. revenue: {revenue}")
+        # the trace thread starts after the worker pool of the evaluator is forked
+        trace = TraceWriter(f"{save_path}/trace_SandS_{waterfall_name}_{i}.jsonl", dump_every)
+        with metrics.phase("logging"):
+            trace.start(waterfall, revenue, validation=i, iteration=iter, evaluations=cnt)
+        while convergence and not stopped:
+            logging.info("validation: %s. iteration: %s.", i, iter)
+            iter += 1
+            with metrics.phase("simulation"):
+                evaluator.set_incumbent(state)  # the neighbors share their top ad-units with this waterfall
+            with metrics.phase("neighbors"):
+                neighbors = generate_valid_neighbor_states(state, rng)
+            metrics.add("neighbors_generated", len(neighbors))
+            if racing is not None:
+                with metrics.phase("racing"):
+                    neighbors = racing.race(neighbors)  # drop neighbors that are clearly below the incumbent
+            if max_evaluations is not None:  # the last batch is cut to the evaluations left
+                neighbors = neighbors[:max(max_evaluations - cnt, 0)]
+            neighbors = score_neighbor_states(evaluator, neighbors, metrics)  # neighbors is a list of (state, stats)
+            metrics.add("neighbors_scored", len(neighbors))
+            for n, n_stats in neighbors:
+                cnt += 1
+                curr_revenue = float(n_stats.revenue.sum())
+                if curr_revenue > revenue:  # adopt new waterfall
+                    state = n
+                    old_waterfall = waterfall
+                    with metrics.phase("copy"):
+                        waterfall = Waterfall.from_state(n, n_stats)
+                    save_waterfalls.append(waterfall)
+                    revenue = curr_revenue
+                    save_best_revenue.append(revenue)
+                    metrics.add("adoptions")
+                    metrics.notify("adopt", iteration=iter, revenue=revenue, waterfall=waterfall)
+                    with metrics.phase("logging"):
+                        trace.adopt(iter, cnt, revenue, old_waterfall, waterfall)
+            num_neighbors.append(cnt - sum(num_neighbors[:iter]))
+            metrics.add("iterations")
+            metrics.notify("iteration", iteration=iter, revenue=revenue, n_neighbors=num_neighbors[-1])
+            with metrics.phase("logging"):
+                trace.iteration(iter, cnt, revenue, n_neighbors=num_neighbors[-1])
+                if trace.should_dump(iter):
+                    trace.dump(waterfall, 'curr_waterfall')
+            if iter >= MAX_ITER or revenue - iter_revenue <= EPSILON:  # stop conditions
+                convergence = 0
+            iter_revenue = revenue  # the revenue in the current iteration (best neighbor)
+            if is_budget_exhausted(start_time, time_budget, cnt, max_evaluations):
+                logging.info(f"budget exhausted after {time.time() - start_time:.1f}s and {cnt} neighbors")
+                stopped = True
+            if checkpoint_every is not None and (iter % checkpoint_every == 0 or not convergence or stopped):
+                with metrics.phase("checkpoint"):
+                    save_checkpoint(checkpoint_path, {"convergence": convergence, "iter": iter, "cnt": cnt,
+                                                      "state": state, "revenue": revenue, "iter_revenue": iter_revenue,
+                                                      "save_best_revenue": save_best_revenue,
+                                                      "num_neighbors": num_neighbors,
+                                                      "save_waterfalls": save_waterfalls, "rng": rng,
+                                                      "racing_rng": None if racing is None else racing.rng})
+    finally:
+        evaluator.close()
+    logging.info("final S&S waterfall")
+    with metrics.phase("logging"):
+        trace.dump(waterfall)
+        trace.end(revenue, evaluations=cnt, stopped=stopped)
+        trace.close()
+    with metrics.phase("copy"):
+        best_waterfall = copy.deepcopy(waterfall)
+    add_evaluator_metrics(metrics, evaluator)
+    logging.info(f"total number of neighbors S: {cnt}")
+    if evaluator.cache is not None:
+        logging.info(f"evaluation cache: {evaluator.cache.get_info()}")
+    if racing is not None:
+        logging.info(f"racing: {racing.get_info()}")
+        for key, value in racing.get_info().items():
+            metrics.add(f"racing_{key}", value)
+    logging.info(f"final S&S revenue: {revenue}")
+    save_best_revenue.append(revenue)
+    with metrics.phase("output"):
+        waterfall.get_df().to_csv(f"{save_path}/final_SandS_waterfall_{waterfall_name}_{i}.csv", index=False)
+        pd.DataFrame(save_best_revenue).to_csv(f"{save_path}/revenue_SandS_{waterfall_name}_{i}.csv", index=False)
+        pd.DataFrame(num_neighbors).to_csv(f"{save_path}/neighbors_SandS_{waterfall_name}_{i}.csv", index=False)
+
+        with open(f"{save_path}/SandS_All_{waterfall_name}_{i}.txt", "wb") as fp:
+            pickle.dump(save_waterfalls, fp)
+    return best_waterfall, save_best_revenue, stopped
+
+
+def split_folds(n_users, n_folds, seed=None):
+    """Returning the positions of the held-out users of each of n_folds folds, a random partition of the users."""
+
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(3,)))
+    return np.array_split(rng.permutation(n_users), n_folds)
+
+
+def run_fold(task):
+    """Running the S&S of one fold of a k-fold validation (in a worker process) and scoring its final waterfall on the
+    held-out users.
+    The calibrated population is memory-mapped from the cache filled by run_model, so the folds share its pages
+    instead of parsing the valuation csv again. The search runs on the compressed training users; the initial and the
+    final waterfalls are then run on the compressed held-out users.
+    Returning a dictionary of the fold results, with the out-of-sample uplift (final / initial held-out revenue - 1)."""
+
+    (csv_path_waterfall, csv_path_users, waterfall_name, save_path, path_log, ADNETWORKS_list, fold, test_index, seed,
+     metrics_params, search_params) = task
+    logging.basicConfig(filename=path_log, filemode = 'a', level=logging.INFO)
+    metrics = RunMetrics(**metrics_params).start()
+
+    waterfall = Waterfall(csv_path=csv_path_waterfall)
+    with metrics.phase("load_users"):
+        users = get_users(csv_path_users, csv_path_waterfall, waterfall, ADNETWORKS_list, save_path, seed=seed,
+                          compress=False)
+        train = np.ones(len(users), dtype=bool)
+        train[test_index] = False
+        train_users, test_users = users.subset(train), users.subset(~train)
+        if can_compress(waterfall):
+            train_users, test_users = train_users.compress(), test_users.compress()
+
+    init_waterfall = copy.deepcopy(waterfall)
+    best_waterfall, save_best_revenue, stopped = search_and_score(waterfall, train_users, waterfall_name, save_path,
+                                                                  fold, seed=seed, metrics=metrics, **search_params)
+
+    init_waterfall = delete_invalid_instances(init_waterfall)
+    init_waterfall.run(test_users, reset_waterfall=True)
+    test_waterfall = copy.deepcopy(best_waterfall)
+    test_waterfall.run(test_users, reset_waterfall=True)
+    test_init_revenue, test_revenue = init_waterfall.get_revenue(), test_waterfall.get_revenue()
+    logging.info(f"fold {fold}: held-out revenue: {test_revenue} (initial waterfall: {test_init_revenue})")
+    return {"fold": fold, "n_train_users": int(train.sum()), "n_test_users": len(test_index),
+            "train_init_revenue": save_best_revenue[0], "train_revenue": save_best_revenue[-1],
+            "test_init_revenue": test_init_revenue, "test_revenue": test_revenue,
+            "uplift": test_revenue / test_init_revenue - 1 if test_init_revenue > 0 else np.nan,
+            "stopped": stopped, "waterfall": best_waterfall, "save_best_revenue": save_best_revenue,
+            "metrics": metrics.stop().to_dict()}
+
+
+def run_k_fold(csv_path_waterfall, csv_path_users, waterfall_name, save_path, path_log, ADNETWORKS_list, n_folds,
+               n_jobs=None, seed=None, metrics=None, **search_params):
+    """k-fold validation of S&S: the users are partitioned into n_folds folds and, for each fold, S&S optimizes the
+    waterfall on the other folds (in its own process, n_jobs processes at most) and the result is scored on the
+    held-out fold.
+    The per-fold results are saved to save_path/kfold_SandS_{waterfall_name}.csv and the mean and variance (over the
+    folds) of the out-of-sample uplift are logged; folds without held-out revenue for the initial waterfall have no
+    uplift (NaN) and are left out of them.
+    Every fold records its own metrics.RunMetrics (with the tracking and callbacks of metrics, which must then be
+    picklable); their counters are summed into metrics and the per-fold metrics are kept under 'folds'.
+    Returning the list of the fold results (see run_fold), the mean and the variance of the uplift."""
+
+    metrics = RunMetrics() if metrics is None else metrics
+    # calibrate and cache the population once, the fold processes memory-map it
+    with metrics.phase("load_users"):
+        users = get_users(csv_path_users, csv_path_waterfall, Waterfall(csv_path=csv_path_waterfall),
+                          ADNETWORKS_list, save_path, seed=seed, compress=False)
+    metrics_params = {"track_memory": metrics.track_memory, "callbacks": metrics.callbacks}
+    tasks = [(csv_path_waterfall, csv_path_users, f"{waterfall_name}_kfold", save_path, path_log, ADNETWORKS_list,
+              fold, test_index, seed, metrics_params, search_params)
+             for fold, test_index in enumerate(split_folds(len(users), n_folds, seed))]
+    n_jobs = min(n_folds, n_jobs if n_jobs is not None else multiprocessing.cpu_count())
+    with metrics.phase("folds"):
+        if n_jobs == 1:
+            results = [run_fold(task) for task in tasks]
+        else:
+            with multiprocessing.Pool(n_jobs) as pool:
+                results = pool.map(run_fold, tasks)
+    for result in results:
+        for name, value in result["metrics"]["counters"].items():
+            metrics.add(name, value)
+    metrics.set("folds", [result["metrics"] for result in results])
+
+    uplifts = np.array([result["uplift"] for result in results])
+    valid = uplifts[~np.isnan(uplifts)]
+    mean = float(np.mean(valid)) if len(valid) > 0 else np.nan
+    variance = float(np.var(valid, ddof=1)) if len(valid) > 1 else 0.0
+    pd.DataFrame([{key: value for key, value in result.items()
+                   if key not in ("waterfall", "save_best_revenue", "metrics")}
+                  for result in results]).to_csv(f"{save_path}/kfold_SandS_{waterfall_name}.csv", index=False)
+    logging.info(f"{n_folds}-fold out-of-sample uplift: mean: {mean}, variance: {variance}, "
+                 f"per fold: {uplifts.tolist()}")
+    metrics.set("uplift", {"mean": mean, "variance": variance, "folds": uplifts.tolist()})
+    return results, mean, variance
+
+
+def run_model(csv_path_waterfall, csv_path_users, waterfall_name, save_path, path_log, alg, ADNETWORKS_list, flag = False,
+              n_jobs=1, n_simulations=N_SIMULATIONS, simulation_time=None, rollout='heuristic', time_budget=None,
+              max_evaluations=None, checkpoint_every=None, racing_fractions=None, racing_confidence=RACING_CONFIDENCE,
+              seed=None, n_folds=None, track_memory=False, profile_path=None, callbacks=None, dump_every=None):
+    """Optimizing the waterfall with S&S (alg='SandS'), a dynamic programming ladder certified by branch-and-bound
+    (alg='DP', see dynamic_programming.optimize_ladder) or Monte-Carlo tree search (any other alg, see
+    mcts.MonteCarloTreeSearch).
+    n_jobs > 1 scores the neighbors on a pool of n_jobs worker processes sharing the user population.
+    Every MCTS iteration runs n_simulations simulations and / or runs for simulation_time seconds (None for no limit),
+    with 'random' or 'heuristic' rollouts; MCTS stops when an iteration neither improves the best revenue by more than
+    EPSILON nor moves the root (see mcts.MonteCarloTreeSearch.advance).
+    The S&S and MCTS searches are anytime: they stop when this call ran for time_budget seconds or when the search
+    scored max_evaluations neighbors (counted over resumed runs too), and return the best waterfall found so far.
+    With checkpoint_every, the search state (incumbent, counters, random generators, revenue trace) is saved every
+    checkpoint_every iterations to save_path, and a later call with the same arguments resumes from it.
+    With racing_fractions, e.g. (0.05, 0.2), S&S first races the neighbors on stratified user subsamples of these
+    sizes and drops those below the incumbent with racing_confidence (see racing.NeighborRacing); only the survivors
+    are scored on the full population, and only they count in max_evaluations.
+    All the randomness of a run (valuation draws, neighbor price steps, MCTS choices, racing samples and the common
+    random numbers of the evaluator) comes from independent streams spawned from seed, so a run with a seed is
+    reproducible; seed=None draws fresh entropy.
+    With n_folds, S&S first runs a k-fold validation (see run_k_fold): the folds run in n_jobs processes, each
+    scoring its neighbors serially, and only estimate the out-of-sample uplift (its mean and variance are logged and
+    saved to the metrics). The returned waterfall and revenue trace are those of a final S&S on all the users.
+    The run is instrumented by a metrics.RunMetrics: the time spent per phase (loading the users, neighbors
+    generation, racing, simulation, delete_invalid, copies, logging, checkpoints, outputs), counters (neighbors
+    generated and scored, evaluations, users simulated, cache hits) and, with track_memory, the tracemalloc peak
+    memory are saved to save_path/metrics_{alg}_{waterfall_name}.json at the end of the run. callbacks (see
+    metrics.RunCallback) are notified of the run start and end, of every iteration and of every adoption. With
+    profile_path, the run is also profiled by cProfile and the stats are dumped to profile_path (see pstats).
+    The S&S and MCTS searches trace their iterations and adoptions (with the changes of the adopted waterfall) to
+    save_path/trace_*.jsonl files (see trace.TraceWriter), written in a background thread; the full waterfalls are
+    logged only at the start and end of a search, and every dump_every iterations."""
 
 
     logging.basicConfig(filename=path_log, filemode = 'a', level=logging.INFO)
     logging.info("running search procedure")
+    start_time = time.time()
+    metrics = RunMetrics(track_memory, callbacks).start()
+    profiler = cProfile.Profile() if profile_path is not None else None
+    if profiler is not None:
+        profiler.enable()
+    metrics.notify("run_start", alg=alg, waterfall_name=waterfall_name)
+    stopped = False  # set when the time or evaluations budget is exhausted
 
     all_neighbors = []
     optimal_waterfall = []
@@ -23,165 +420,203 @@ def run_model(csv_path_waterfall, csv_path_users, waterfall_name, save_path, pat
     ################################
     # here search and score starts #
     ################################
-    if alg == 'SandS':
-        for i in range(VALIDATION): # for the S&S we use cross validation
+    if alg == 'SandS' and n_folds is not None:
+        results, mean, variance = run_k_fold(csv_path_waterfall, csv_path_users, waterfall_name, save_path, path_log,
+                                             ADNETWORKS_list, n_folds, n_jobs=n_jobs, seed=seed,
+                                             start_time=start_time, time_budget=time_budget,
+                                             max_evaluations=max_evaluations, checkpoint_every=checkpoint_every,
+                                             racing_fractions=racing_fractions, racing_confidence=racing_confidence,
+                                             metrics=metrics, dump_every=dump_every)
+        # the folds only estimate the out-of-sample uplift, the waterfall is optimized on all the users
+        waterfall = Waterfall(csv_path=csv_path_waterfall)
+        with metrics.phase("load_users"):
+            users = get_users(csv_path_users, csv_path_waterfall, waterfall, ADNETWORKS_list, save_path, fold=None,
+                              seed=seed)
+        best_waterfall, save_best_revenue, stopped = search_and_score(
+            waterfall, users, waterfall_name, save_path, 0, n_jobs=n_jobs, seed=seed, start_time=start_time,
+            time_budget=time_budget, max_evaluations=max_evaluations, checkpoint_every=checkpoint_every,
+            racing_fractions=racing_fractions, racing_confidence=racing_confidence, metrics=metrics,
+            dump_every=dump_every)
 
-            convergence = 1
-            iter = 0
-            cnt = 0
+    elif alg == 'SandS':
+        for i in range(VALIDATION): # for the S&S we use cross validation
+            if stopped:
+                break
 
             waterfall = Waterfall(csv_path=csv_path_waterfall)  # init waterfall with Anna's waterfall
-            if not os.path.exists(f"{save_path}/users_synth_{i}.txt"):
-                users = create_real_users(path=csv_path_users, init_waterfall=waterfall, adnetwork_names=ADNETWORKS_list,
-                                          beta_size=1)
-                with open(f"{save_path}/users_synth_{i}.txt", "wb") as fp:
-                    pickle.dump(users, fp)
-            else:
-                with open(f"{save_path}/users_synth_{i}.txt", "rb") as fp:
-                    users = pickle.load(fp)
+            with metrics.phase("load_users"):
+                users = get_users(csv_path_users, csv_path_waterfall, waterfall, ADNETWORKS_list, save_path, fold=i,
+                                  seed=seed)
+            best_waterfall, save_best_revenue, stopped = search_and_score(
+                waterfall, users, waterfall_name, save_path, i, n_jobs=n_jobs, seed=seed, start_time=start_time,
+                time_budget=time_budget, max_evaluations=max_evaluations, checkpoint_every=checkpoint_every,
+                racing_fractions=racing_fractions, racing_confidence=racing_confidence, metrics=metrics,
+                dump_every=dump_every)
+            if flag == True:
+                all_neighbors, optimal_waterfall, optimal_revenue = generate_all_neighbors(ADNETWORKS_list, range(0,21), users, path_log)
 
-            save_best_revenue = []
+    elif alg == 'DP':
+        ###################################
+        # here dynamic programming starts #
+        ###################################
+
+        waterfall = Waterfall(csv_path=csv_path_waterfall)  # init waterfall with Anna's waterfall
+        with metrics.phase("load_users"):
+            users = get_users(csv_path_users, csv_path_waterfall, waterfall, ADNETWORKS_list, save_path, fold=None,
+                              seed=seed)
+
+        save_best_revenue = []
+        with metrics.phase("delete_invalid"):
             waterfall = delete_invalid_instances(waterfall)
-            _results = waterfall.run(users, reset_waterfall=True)  # run users in the waterfall
-            logging.info("VALIDATION: " + str(i))
-            logging.info("init waterfall:")
-            logging.info('waterfall - {}'.format(waterfall.get_df().to_string()))
-            init_revenue = waterfall.get_revenue()
-            save_best_revenue.append(init_revenue)
-            logging.info(f"init revenue: {init_revenue}")
+        with metrics.phase("simulation"):  # run users in the waterfall, with common random numbers as the searches
+            Evaluator(users, cache_size=0, seed=np.random.SeedSequence(seed, spawn_key=(6,))).run(waterfall)
+        logging.info("init waterfall:")
+        with metrics.phase("logging"):
+            TraceWriter.dump(waterfall)
+        init_revenue = waterfall.get_revenue()
+        save_best_revenue.append(init_revenue)
+        logging.info(f"init revenue: {init_revenue}")
 
-            # start search and score
-            iter_revenue = init_revenue
-            revenue = init_revenue
-            save_waterfalls = []
-            num_neighbors = [0]
-            while convergence:
-                logging.info(f"validation: {i}. iteration: {iter}.")
-                iter += 1
-                neighbors = generate_valid_neighbors(waterfall)  # neighbors is a list of waterfalls
-                for n in neighbors:
-                    cnt += 1
-                    _results = n.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                    n = delete_invalid_instances(n)
-                    _results = n.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                    curr_revenue = n.get_revenue()
-                    if curr_revenue > revenue:  # adopt new waterfall
-                        waterfall = copy.deepcopy(n)
-                        save_waterfalls.append(waterfall)
-                        revenue = curr_revenue
-                        save_best_revenue.append(revenue)
-                        logging.info(f"curr_revenue: {revenue} curr_num_neighbors: {cnt}")
-                        logging.info('curr_waterfall - {}'.format(waterfall.get_df().to_string()))
-                num_neighbors.append(cnt - sum(num_neighbors[:iter]))
-                if iter >= MAX_ITER or revenue - iter_revenue <= EPSILON:  # stop conditions
-                    convergence = 0
-                iter_revenue = revenue  # the revenue in the current iteration (best neighbor)
-            logging.info("final S&S waterfall")
-            logging.info('waterfall - {}'.format(waterfall.get_df().to_string()))
-            best_waterfall = copy.deepcopy(waterfall)
-            waterfall.get_df().to_csv(f"{save_path}/final_SandS_waterfall_{waterfall_name}_{i}.csv", index=False)
-            logging.info(f"total number of neighbors S: {cnt}")
-            logging.info(f"final S&S revenue: {revenue}")
-            save_best_revenue.append(revenue)
-            pd.DataFrame(save_best_revenue).to_csv(f"{save_path}/revenue_SandS_{waterfall_name}_{i}.csv", index=False)
-            pd.DataFrame(num_neighbors).to_csv(f"{save_path}/neighbors_SandS_{waterfall_name}_{i}.csv", index=False)
-
-            with open(f"{save_path}/SandS_All_{waterfall_name}_{i}.txt", "wb") as fp:
-                pickle.dump(save_waterfalls, fp)
-            if flag == True:
-                all_neighbors, optimal_waterfall, optimal_revenue = generate_all_neighbors(ADNETWORKS_list, range(0,21), users, path_log)
+        with metrics.phase("dynamic_programming"):
+            best_waterfall, revenue, certified = optimize_ladder(ADNETWORKS_list, users, path_log)
+        metrics.set("dp_certified", certified)
+        optimal_waterfall, optimal_revenue = best_waterfall, revenue
+        logging.info("final DP waterfall")
+        with metrics.phase("logging"):
+            TraceWriter.dump(best_waterfall)
+        logging.info(f"final DP revenue: {revenue}")
+        save_best_revenue.append(revenue)
+        with metrics.phase("output"):
+            best_waterfall.get_df().to_csv(f"{save_path}/final_DP_waterfall_{waterfall_name}.csv", index=False)
+            pd.DataFrame(save_best_revenue).to_csv(f"{save_path}/revenue_DP_{waterfall_name}.csv", index=False)
 
-        else:
-            #######################################
-            # here monte carlo tree search starts #
-            #######################################
-
-            convergence = 1
-            iter = 0
-            cnt = 0
-            
-            waterfall = Waterfall(csv_path=csv_path_waterfall)  # init waterfall with Anna's waterfall
-            if not os.path.exists(f"{save_path}/users_synth.txt"):
-                users = create_real_users(path=csv_path_users, init_waterfall=waterfall, adnetwork_names=ADNETWORKS_list,
-                                          beta_size=1)
-                with open(f"{save_path}/users_synth.txt", "wb") as fp:
-                    pickle.dump(users, fp)
-            else:
-                with open(f"{save_path}/users_synth.txt", "rb") as fp:
-                    users = pickle.load(fp)
-            
+    else:
+        #######################################
+        # here monte carlo tree search starts #
+        #######################################
+
+        convergence = 1
+        iter = 0
+        cnt = 0
+        
+        waterfall = Waterfall(csv_path=csv_path_waterfall)  # init waterfall with Anna's waterfall
+        with metrics.phase("load_users"):
+            users = get_users(csv_path_users, csv_path_waterfall, waterfall, ADNETWORKS_list, save_path, fold=None,
+                              seed=seed)
+        search_seed, evaluator_seed = np.random.SeedSequence(seed, spawn_key=(2,)).spawn(2)
+        
+        evaluator = Evaluator(users, seed=evaluator_seed) if n_jobs == 1 else \
+            ParallelEvaluator(users, n_jobs=n_jobs, seed=evaluator_seed)
+        try:
             save_best_revenue = []
-            waterfall = delete_invalid_instances(waterfall)
-            _results = waterfall.run(users, reset_waterfall=True)  # run users in the waterfall
+            with metrics.phase("delete_invalid"):
+                waterfall = delete_invalid_instances(waterfall)
+            with metrics.phase("simulation"):
+                init_stats = evaluator.run(waterfall)  # with the common random numbers of the search
             logging.info("init waterfall:")
-            logging.info('waterfall - {}'.format(waterfall.get_df().to_string()))
+            with metrics.phase("logging"):
+                TraceWriter.dump(waterfall)
             init_revenue = waterfall.get_revenue()
             save_best_revenue.append(init_revenue)
             logging.info(f"init revenue: {init_revenue}")
 
             # start monte carlo search
+            mcts = MonteCarloTreeSearch(evaluator, waterfall.to_state(), init_stats, rollout=rollout,
+                                        rng=np.random.default_rng(search_seed), metrics=metrics)
+            with metrics.phase("copy"):
+                best_waterfall = copy.deepcopy(waterfall)
             iter_revenue = init_revenue
             revenue = init_revenue
             save_waterfalls = []
             num_neighbors = [0]
-            while convergence:
-                logging.info(f"iteration: {iter}.")
+            checkpoint_path = get_checkpoint_path(save_path, "MCTS", waterfall_name, users, seed)
+            checkpoint = load_checkpoint(checkpoint_path) if checkpoint_every is not None else None
+            if checkpoint is not None:  # resume the search (and its tree) where the checkpoint was saved
+                convergence, iter, cnt = checkpoint["convergence"], checkpoint["iter"], checkpoint["cnt"]
+                mcts = checkpoint["mcts"]
+                revenue, iter_revenue = checkpoint["revenue"], checkpoint["iter_revenue"]
+                save_best_revenue, num_neighbors = checkpoint["save_best_revenue"], checkpoint["num_neighbors"]
+                save_waterfalls, best_waterfall = checkpoint["save_waterfalls"], checkpoint["best_waterfall"]
+                mcts.evaluator, mcts.metrics = evaluator, metrics
+                logging.info(f"resuming from checkpoint: iteration: {iter}. revenue: {revenue}")
+            trace = TraceWriter(f"{save_path}/trace_MCTS_{waterfall_name}.jsonl", dump_every)
+            with metrics.phase("logging"):
+                trace.start(best_waterfall, revenue, iteration=iter, evaluations=cnt)
+            while convergence and not stopped:
+                logging.info("iteration: %s.", iter)
                 iter += 1
-                neighbors1 = generate_valid_neighbors(waterfall)  # neighbors is a list of waterfalls
-                for n1 in neighbors1:
-                    cnt += 1
-                    _results = n1.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                    n1 = delete_invalid_instances(n1)
-                    _results = n1.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                    neighbors2 = generate_valid_neighbors(n1)  # neighbors is a list of waterfalls:
-                    for n2 in neighbors2:  # depth is two
-                        cnt += 1
-                        _results = n2.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                        n2 = delete_invalid_instances(n2)
-                        _results = n2.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                        neighbors3 = generate_valid_neighbors(n2)  # neighbors is a list of waterfalls:
-                        top_scores_level3 = []
-                        for n3 in neighbors3:  # depth is three
-                            cnt += 1
-                            _results = n3.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                            n3 = delete_invalid_instances(n3)
-                            _results = n3.run(users, reset_waterfall=True)  # run validation users in the waterfall
-                            top_scores_level3.append(n3.get_revenue())
-                        n2.set_best_child(neighbors3[top_scores_level3.index(max(top_scores_level3))])
-                        curr_revenue = max(n2.best_child.get_revenue(), n1.get_revenue(), n2.get_revenue())
-                        if curr_revenue > revenue:  # adopt new waterfall
-                            if n2.best_child.get_revenue() == max(n2.best_child.get_revenue(), n1.get_revenue(),
-                                                                  n2.get_revenue()):
-                                n1.set_best_grandchild(n2.best_child)
-                            elif n2.get_revenue() == max(n2.best_child.get_revenue(), n1.get_revenue(), n2.get_revenue()):
-                                n1.set_best_child(n2)
-                            waterfall = copy.deepcopy(n1)
-                            save_waterfalls.append(waterfall)
-                            revenue = curr_revenue
-                            save_best_revenue.append(revenue)
-                            print("curr_revenue: " + str(revenue) + " curr_num_neighbors: " + str(cnt))
-                            logging.info('curr_waterfall - {}'.format(waterfall.get_df().to_string()))
-
-                num_neighbors.append(cnt - sum(num_neighbors[:iter]))
-                if iter >= MAX_ITER or revenue - iter_revenue <= EPSILON:  # stop conditions
+                with metrics.phase("simulation"):
+                    # most scored states share their top ad-units with the root
+                    evaluator.set_incumbent(mcts.root.state)
+                remaining_time = None if time_budget is None else max(time_budget - (time.time() - start_time), 0)
+                mcts.search(n_simulations=n_simulations, max_evaluations=max_evaluations,
+                            time_budget=min((t for t in (simulation_time, remaining_time) if t is not None),
+                                            default=None))
+                num_neighbors.append(mcts.n_evaluations - cnt)
+                cnt = mcts.n_evaluations
+                if mcts.best_revenue > revenue:  # adopt new waterfall
+                    old_waterfall = best_waterfall
+                    with metrics.phase("copy"):
+                        best_waterfall = Waterfall.from_state(mcts.best_state, mcts.best_stats)
+                    save_waterfalls.append(best_waterfall)
+                    revenue = mcts.best_revenue
+                    save_best_revenue.append(revenue)
+                    metrics.add("adoptions")
+                    metrics.notify("adopt", iteration=iter, revenue=revenue, waterfall=best_waterfall)
+                    with metrics.phase("logging"):
+                        trace.adopt(iter, cnt, revenue, old_waterfall, best_waterfall)
+                root = mcts.root
+                moved = mcts.advance() is not root  # the subtree of the chosen move is reused in the next iteration
+                metrics.add("iterations")
+                metrics.notify("iteration", iteration=iter, revenue=revenue, n_neighbors=num_neighbors[-1])
+                with metrics.phase("logging"):
+                    trace.iteration(iter, cnt, revenue, n_neighbors=num_neighbors[-1])
+                    if trace.should_dump(iter):
+                        trace.dump(best_waterfall, 'curr_waterfall')
+
+                # stop conditions: the search converged when the best revenue stalls and the root stays in place
+                if iter >= MAX_ITER or (revenue - iter_revenue <= EPSILON and not moved):
                     convergence = 0
                 iter_revenue = revenue  # the revenue in the current iteration (best neighbor)
-
-            best_waterfall = copy.deepcopy(save_waterfalls[-1])
-            if best_waterfall.best_child != [] and best_waterfall.best_child.get_revenue() > best_waterfall.get_revenue():
-                save_waterfalls.append(best_waterfall.best_child)
-            if best_waterfall.best_grandchild != [] and best_waterfall.best_grandchild.get_revenue() > best_waterfall.get_revenue():
-                save_waterfalls.append(best_waterfall.best_grandchild)
-            best_waterfall = copy.deepcopy(save_waterfalls[-1])
-            print("Optimize Monte-Carlo tree search waterfall:")
-            print(best_waterfall.get_df())
+                if is_budget_exhausted(start_time, time_budget, cnt, max_evaluations):
+                    logging.info(f"budget exhausted after {time.time() - start_time:.1f}s and {cnt} neighbors")
+                    stopped = True
+                if checkpoint_every is not None and (iter % checkpoint_every == 0 or not convergence or stopped):
+                    with metrics.phase("checkpoint"):
+                        save_checkpoint(checkpoint_path, {"convergence": convergence, "iter": iter, "cnt": cnt,
+                                                          "mcts": mcts, "revenue": revenue,
+                                                          "iter_revenue": iter_revenue,
+                                                          "save_best_revenue": save_best_revenue,
+                                                          "num_neighbors": num_neighbors,
+                                                          "save_waterfalls": save_waterfalls,
+                                                          "best_waterfall": best_waterfall})
+        finally:
+            evaluator.close()
+        add_evaluator_metrics(metrics, evaluator)
+        logging.info("final Monte-Carlo tree search waterfall")
+        with metrics.phase("logging"):
+            trace.dump(best_waterfall)
+            trace.end(revenue, evaluations=cnt, stopped=stopped)
+            trace.close()
+        logging.info(f"total number of neighbors S: {cnt}")
+        if evaluator.cache is not None:
+            logging.info(f"evaluation cache: {evaluator.cache.get_info()}")
+        logging.info(f"final Monte-Carlo tree search revenue: {revenue}")
+        save_best_revenue.append(revenue)
+        with metrics.phase("output"):
             best_waterfall.get_df().to_csv(f"{save_path}/final_MCTS_waterfall_{waterfall_name}.csv", index=False)
-            print("total number of neighbors S: " + str(cnt))
-            print("final Monte-Carlo tree search revenue: " + str(revenue))
-            save_best_revenue.append(revenue)
             pd.DataFrame(save_best_revenue).to_csv(f"{save_path}/revenue_MCTS_{waterfall_name}.csv", index=False)
             pd.DataFrame(num_neighbors).to_csv(f"{save_path}/neighbors_MCTS_{waterfall_name}.csv", index=False)
             with open(f"{save_path}/MCTS_All_{waterfall_name}.txt", "wb") as fp:
                 pickle.dump(save_waterfalls, fp)
 
-        return best_waterfall, save_best_revenue, all_neighbors, optimal_waterfall, optimal_revenue
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        metrics.set("profile", profile_path)
+    metrics.stop()
+    metrics.notify("run_end", revenue=save_best_revenue[-1])
+    alg_name = alg if alg in ('SandS', 'DP') else 'MCTS'
+    metrics.save(f"{save_path}/metrics_{alg_name}_{waterfall_name}.json")
+
+    return best_waterfall, save_best_revenue, all_neighbors, optimal_waterfall, optimal_revenue
@@ -1,198 +1,256 @@
-import random as rnd
-import copy
 import numpy as np
 import pandas as pd
-import itertools
+import heapq
 import logging
 
-from itertools import permutations
 from classes.ad_unit import AdUnit
+from classes.engine import get_rng
 from classes.waterfall import Waterfall
+from classes.waterfall_state import AdUnitState
+from classes.constraints import WaterfallConstraints
 from classes.consts import THRESHOLD, MAX_PRICE, MAX_CAPACITY_PER_ADNETWORK
 
 
-def generate_valid_neighbors(waterfall):
+def generate_valid_neighbors(waterfall, rng=None):
     """this function searches for all possible neighbors"""
 
+    return [Waterfall.from_state(state) for state in generate_valid_neighbor_states(waterfall.to_state(), rng)]
+
+def generate_valid_neighbor_states(state, rng=None):
+    """this function searches for all possible neighbors of a waterfall_state.WaterfallState.
+    Neighbors are new states sharing their untouched ad-units with state, no waterfall is copied.
+    The random price steps are drawn from the numpy Generator rng.
+    The changes are checked on a constraints.WaterfallConstraints index of state, so only the valid neighbors are
+    built (unless the state has 'Auto' or 'Cross' ad-units, which are checked on the index of every new state)."""
+
+    rng = get_rng(rng)
     neighbors = []
-    for i in range(len(waterfall.ad_units)): # for each instance in the waterfall try to increse/decrease the price
-        if waterfall.ad_units[i].ad_unit_name != 'Default': # do not change default prices
+    constraints = WaterfallConstraints(state.ad_units)
+    for i in range(len(state.ad_units)): # for each instance in the waterfall try to increse/decrease the price
+        if state.ad_units[i].ad_unit_name != 'Default': # do not change default prices
             # try to increase the price
-            temp = copy.deepcopy(waterfall)
-            if temp.ad_units[i].get_price() <= 11:
-                temp.set_ad_unit_price(temp.ad_units[i], temp.ad_units[i].get_price() + 1, order=False) # add 1 dollar
+            if state.ad_units[i].get_price() <= 11:
+                temp = get_price_change(state, constraints, i, state.ad_units[i].get_price() + 1) # add 1 dollar
             else:
-                temp.set_ad_unit_price(temp.ad_units[i], temp.ad_units[i].get_price() + rnd.randint(1, 5), order=False)  # add 1-5 dollars
-            id = temp.ad_units[i].ad_unit_id
-            temp.reorder(sort_by='price', reverse=True)
-            if validation_single_change(temp, i, waterfall) and validation_single_change(temp, temp.get_order_by_id(id) - 1, waterfall):
+                temp = get_price_change(state, constraints, i, state.ad_units[i].get_price() + rng.integers(1, 6))  # add 1-5 dollars
+            if temp is not None:
                 neighbors.append(temp)
             # try to decrease the price
-            temp = copy.deepcopy(waterfall)
-            if temp.ad_units[i].get_price() <= 11:
-                temp.set_ad_unit_price(temp.ad_units[i], temp.ad_units[i].get_price() - 1, order=False)  # reduce 1 dollar
+            if state.ad_units[i].get_price() <= 11:
+                temp = get_price_change(state, constraints, i, state.ad_units[i].get_price() - 1)  # reduce 1 dollar
             else:
-                temp.set_ad_unit_price(temp.ad_units[i], temp.ad_units[i].get_price() - rnd.randint(1, 5), order=False) # reduce 1-5 dollars
-            id = temp.ad_units[i].ad_unit_id
-            temp.reorder(sort_by='price', reverse=True)
-            if validation_single_change(temp, i, waterfall) and validation_single_change(temp, temp.get_order_by_id(id) - 1, waterfall):
+                temp = get_price_change(state, constraints, i, state.ad_units[i].get_price() - rng.integers(1, 6)) # reduce 1-5 dollars
+            if temp is not None:
                 neighbors.append(temp)
 
-    # try to add new instance
+    # try to add new instance, at the first valid price among the means of the top 2, 3, 4, 5, 6 and 13 prices
     valid_networks = list(MAX_CAPACITY_PER_ADNETWORK.keys())
+    prices = sorted(state.get_prices(), reverse=True)
     for i in valid_networks:
-        if waterfall.adnetwork_has_capacity(i):
-            flag = 1
-            cnt = 2
-            while flag:
-                temp = copy.deepcopy(waterfall)
-                price = round(temp.get_df()["price"].nlargest(cnt).mean())
-                if cnt > 5: # excelerate to improve runtime performance
-                    cnt *=2
-                if cnt > 30:
-                    break
-                ad_unit_name = f"{len(temp.ad_units)}_'new_inst'_US${price}"
-                ad_unit = AdUnit(adnetwork_name=i,ad_unit_name=ad_unit_name,section='High',price=price)
-                temp.add_ad_unit(ad_unit)
-                temp.reorder(sort_by='price', reverse=True)
-                if validation_single_change(temp,ad_unit.order - 1, waterfall):
-                    flag = 0
+        if state.adnetwork_has_capacity(i):
+            for cnt in (2, 3, 4, 5, 6, 13):
+                price = round(np.mean(prices[:cnt]))
+                if constraints.sortable and not constraints.is_valid_insert(i, price):
+                    continue
+                ad_unit_name = f"{len(state.ad_units)}_'new_inst'_US${price}"
+                ad_unit = AdUnitState(AdUnit.get_next_ad_unit_id(None), adnetwork_name=i, ad_unit_name=ad_unit_name,
+                                      section='High', price=price)
+                temp = state.with_insert(ad_unit)
+                if constraints.sortable or \
+                        WaterfallConstraints(temp.ad_units).is_valid_at(temp.get_order_by_id(ad_unit.ad_unit_id) - 1):
                     neighbors.append(temp)
-                else:
-                    cnt += 1
+                    break
             # update of capacity is in the main
     return neighbors
 
+def get_price_change(state, constraints, i, price):
+    """Returning the state after setting the price of its i-th ad-unit (see WaterfallState.with_price) if it is valid,
+    else None. The change is valid if the ad-unit now at position i and the changed ad-unit are both valid in the new
+    state; when constraints (the index of state) is sortable, this is checked before building the new state."""
+
+    if constraints.sortable:
+        return state.with_price(i, price) if constraints.is_valid_price_change(i, price) else None
+    temp = state.with_price(i, price)
+    temp_constraints = WaterfallConstraints(temp.ad_units)
+    if temp_constraints.is_valid_at(i) and \
+            temp_constraints.is_valid_at(temp.get_order_by_id(state.ad_units[i].ad_unit_id) - 1):
+        return temp
+    return None
+
 def delete_invalid_instances(waterfall, min_impressions = 50):
     """remove instances that are not working"""
 
-    for ad_unit in waterfall.ad_units:
+    for ad_unit in list(waterfall.ad_units):  # removing from the ad-units being iterated would skip the next one
         if ad_unit.section != 'Auto' and ad_unit.revenue < 10 and ad_unit.impressions < min_impressions:
             waterfall.remove_ad_unit(ad_unit) #this will also update "capacities"
     return waterfall
 
-def get_next_price(ad_units_list, ad_unit):
-    """Returning the price of the instance before the given ad_unit from the same ad-network,
-    according to the order given by ad_units_list."""
+def delete_invalid_ad_units(state, stats, min_impressions = 50):
+    """remove instances that are not working from a waterfall_state.WaterfallState, given its engine.SimulationStats"""
 
-    price = None # there is no ad_unit of the same adNetwork above
-    adnetwork_name = ad_unit.adnetwork_name
-    for ad_unit_other in ad_units_list:
-        if ad_unit.ad_unit_id == ad_unit_other.ad_unit_id:
-            break
-        if ad_unit_other.adnetwork_name == adnetwork_name:
-            price = ad_unit_other.price
-    return price
+    for i in reversed(range(len(state.ad_units))):
+        if state.ad_units[i].section != 'Auto' and stats.revenue[i] < 10 and stats.impressions[i] < min_impressions:
+            state = state.with_removal(i)
+    return state
 
 def validation_single_change(waterfall, j, waterfall_old):
-    """validate specific neighbor waterfall"""
-
-    # j is the index of the changed ad unit
-    check = True
-    # validate that another ad_unit of the same adNetwork with that price (or lower/higher) doesn't exist, two consecutive ad_units do not belong to the same ad-network, or that the difference is not greater than a certian threshold
-    if j > 0 and j + 1 < len(waterfall.ad_units):
-        val1 = get_next_price(waterfall.ad_units, waterfall.ad_units[j]) if get_next_price(waterfall.ad_units, waterfall.ad_units[j]) is not None else np.inf
-        val2 = get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[j]) if get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[j]) is not None else 0
-        if (waterfall.ad_units[j].get_price() >= val1 or
-            waterfall.ad_units[j].get_price() <= val2 or
-                abs(waterfall.ad_units[j].get_price() - waterfall.ad_units[j - 1].get_price()) > THRESHOLD or
-                    abs(waterfall.ad_units[j].get_price() - waterfall.ad_units[j + 1].get_price()) > THRESHOLD or
-                        waterfall.ad_units[j].get_price() > MAX_PRICE or
-                            waterfall.ad_units[j].get_price() < 0 or
-                                waterfall.ad_units[j].adnetwork_name == waterfall.ad_units[j - 1].adnetwork_name or
-                                    waterfall.ad_units[j].adnetwork_name == waterfall.ad_units[j + 1].adnetwork_name):
-            check = False
-    # same but for the case that the changed ad_unit is the first instance
-    elif j==0:
-        val2 = get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[j]) if get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[j]) is not None else 0
-        if j + 1 < len(waterfall.ad_units) and (waterfall.ad_units[j].get_price() <= val2 or
-            abs(waterfall.ad_units[j].get_price() - waterfall.ad_units[j + 1].get_price()) > THRESHOLD or
-                waterfall.ad_units[j].get_price() > MAX_PRICE or
-                    waterfall.ad_units[j].get_price() < 0 or
-                        waterfall.ad_units[j].adnetwork_name == waterfall.ad_units[j + 1].adnetwork_name):
-            check = False
-    else: # same but for the case that the changed ad_unit is the last instance
-        val1 = get_next_price(waterfall.ad_units, waterfall.ad_units[j]) if get_next_price(waterfall.ad_units,waterfall.ad_units[j]) is not None else np.inf
-        val2 = get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[j]) if get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[j]) is not None else 0
-        if (waterfall.ad_units[j].get_price() >= val1 or
-                waterfall.ad_units[j].get_price() <= val2 or
-                abs(waterfall.ad_units[j].get_price() - waterfall.ad_units[j - 1].get_price()) > THRESHOLD or
-                waterfall.ad_units[j].get_price() > MAX_PRICE or
-                waterfall.ad_units[j].get_price() < 0 or
-                waterfall.ad_units[j].adnetwork_name == waterfall.ad_units[j - 1].adnetwork_name):
-            check = False
-
-    return check
+    """validate specific neighbor waterfall (see constraints.WaterfallConstraints to check several changes of the same
+    waterfall on one index)"""
+
+    return WaterfallConstraints(waterfall.ad_units).is_valid_at(j)
 
 def validation_entire_waterfall(waterfall):
     """validate entire waterfall"""
 
-    checked = True
-
-    price = waterfall.ad_units[0].get_price()
-    name = waterfall.ad_units[0].adnetwork_name
-    for i in range(len(waterfall.ad_units) - 1):
-        # validate that two ad_units of same ad network don't have contradict prices or that the difference is not greater than a certian threshold
-        val1 = get_next_price(waterfall.ad_units, waterfall.ad_units[i + 1]) if get_next_price(waterfall.ad_units,waterfall.ad_units[i + 1]) is not None else np.inf
-        val2 = get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[i + 1]) if get_next_price(waterfall.ad_units[::-1], waterfall.ad_units[i + 1]) is not None else 0
-        if (waterfall.ad_units[i + 1].get_price() >= val1 or
-            waterfall.ad_units[i + 1].get_price() <= val2 or
-                abs(waterfall.ad_units[i + 1].get_price() - price) > THRESHOLD or waterfall.ad_units[i + 1].get_price() > MAX_PRICE or
-                    waterfall.ad_units[i + 1].get_price() < 0):
-            checked = False
-            break
-        price = waterfall.ad_units[i + 1].get_price()
-        # validate that two consecutive instances don't belong to the same ad network
-        if waterfall.ad_units[i + 1].adnetwork_name == name:
-            checked = False
-            break
-        name = waterfall.ad_units[i + 1].adnetwork_name
-
-    return checked
-
-def generate_all_neighbors(ADNETWORKS_list, prices, users, path_log):
-    """apply exhaustive search"""
-
-    def perm(n, seq):
-        comb = []
-        for p in itertools.product(seq, repeat=n):
-            comb.append(p)
-        return comb
-
-    def create_waterfall(ADNETWORKS, comb):
-        order = 1
-        waterfall_list = []
-        for i in range(len(ADNETWORKS)):
-            waterfall_list.append('High,' + str(order) + ',' + ADNETWORKS[i] + ' $' + str(comb[i]) + ', 0, ' + str(
-                0) + ', 0, ' + str(0) + ', 0, ' + str(0) + '_' + str(0))
-        data = pd.DataFrame(data=[sub.split(",") for sub in waterfall_list[::-1]],
-                     columns=['Section', 'Order', 'Ad unit', 'RPM', 'Impressions', 'Network fill rate',
-                              'Revenue', 'Network RFM', 'Ad unit id'])
-        return Waterfall(df=data)
+    return WaterfallConstraints(waterfall.ad_units).is_valid()
+
+def get_price_grid(prices):
+    """Returning the sorted, distinct, valid (0 to MAX_PRICE) integer prices of the given prices."""
+
+    return np.array(sorted({int(price) for price in prices if 0 <= price <= MAX_PRICE}), dtype=int)
+
+def get_price_buckets(ADNETWORKS_list, users):
+    """Returning buckets[u, n], the number of grid prices (0 to MAX_PRICE) that user u accepts in the n-th ad-network
+    of ADNETWORKS_list when it has a 'High' ad-unit: u accepts price p iff p < buckets[u, n].
+    Users without a valuation (and ad-networks without a column in the population) accept no price."""
+
+    columns = [users.adnetwork_names.index(adnetwork) if adnetwork in users.adnetwork_names else None
+               for adnetwork in ADNETWORKS_list]
+    valuations = users.get_valuations()
+    buckets = np.zeros((len(users), len(ADNETWORKS_list)), dtype=int)
+    for n, column in enumerate(columns):
+        if column is not None:
+            buckets[:, n] = np.searchsorted(np.arange(MAX_PRICE + 1) / 1000, valuations[:, column], side='right')
+            buckets[np.isnan(valuations[:, column]), n] = 0
+    return buckets
+
+def create_waterfall(ADNETWORKS, comb):
+    """Creating a waterfall of 'High' ad-units, one per ad-network in ADNETWORKS with the price in comb."""
+
+    order = 1
+    waterfall_list = []
+    for i in range(len(ADNETWORKS)):
+        waterfall_list.append('High,' + str(order) + ',' + ADNETWORKS[i] + ' $' + str(comb[i]) + ', 0, ' + str(
+            0) + ', 0, ' + str(0) + ', 0, ' + str(0) + '_' + str(0))
+    data = pd.DataFrame(data=[sub.split(",") for sub in waterfall_list[::-1]],
+                 columns=['Section', 'Order', 'Ad unit', 'RPM', 'Impressions', 'Network fill rate',
+                          'Revenue', 'Network RFM', 'Ad unit id'])
+    return Waterfall(df=data)
+
+def generate_canonical_ladders(ADNETWORKS_list, prices, users, threshold, min_length=2, tolerance=1e-6):
+    """Generator of all canonical ladders that may beat threshold(), yielded as (revenue, ladder) where ladder is a
+    tuple of (adnetwork, price) from top to bottom.
+    A canonical ladder has one ad-unit per ad-network, is sorted by descending price, orders ad-units with the same
+    price by ad-network name (as Waterfall(df=...) does) and is constraint-valid (no price above MAX_PRICE and no
+    jump larger than THRESHOLD between successive ad-units), so no ladder is enumerated twice.
+    The search is a depth-first branch-and-bound: all the children of a ladder (one more ad-unit at the bottom) are
+    scored at once from histograms of the users still falling through, and a child is pruned, with its whole subtree,
+    if an upper bound on the revenue of any ladder extending it is not above threshold(). Ladders that do not beat
+    threshold() are not yielded."""
+
+    prices = get_price_grid(prices)
+    n_grid = MAX_PRICE + 1
+    buckets = get_price_buckets(ADNETWORKS_list, users)
+    impressions = users.impressions.astype(float)
+
+    grid = np.arange(n_grid)
+
+    def get_subtree_bounds(bucket, other_buckets, active_impressions):
+        """Upper bounds, for every grid price p, of the revenue that ladders extending a child (ad-network, p) get
+        from the users falling through the child (bucket <= p). Two bounds are combined:
+        the sum over the other ad-networks of the best revenue a single ad-unit of that ad-network (priced at most p)
+        gets from these users, which is exact when a single ad-network is left, and the revenue obtained if every
+        user paid min(p, highest price it accepts in the other ad-networks)."""
+
+        if other_buckets.shape[1] == 0:
+            return np.zeros(n_grid)
+
+        reachable = grid[None, :] <= grid[:, None]  # [p, q]: the next ad-units are priced q <= p
+        if other_buckets.shape[1] == 1:
+            reachable &= grid[:, None] - grid[None, :] <= THRESHOLD
+        single_bounds = np.zeros(n_grid)
+        for other_bucket in other_buckets.T:
+            histogram = np.bincount(bucket * (n_grid + 1) + other_bucket, weights=active_impressions,
+                                    minlength=(n_grid + 1) ** 2).reshape(n_grid + 1, n_grid + 1)
+            falling = np.cumsum(histogram, axis=0)[:n_grid]  # falling[p, b]: users with bucket <= p and other bucket b
+            accepting = np.cumsum(falling[:, ::-1], axis=1)[:, ::-1]  # accepting[p, q]: ... and other bucket >= q
+            single_bounds += np.where(reachable, grid / 1000 * accepting[:, 1:], 0).max(axis=1)
+        if other_buckets.shape[1] == 1:
+            return single_bounds
+
+        max_accepted = other_buckets.max(axis=1) - 1
+        histogram = np.bincount(bucket * (n_grid + 1) + max_accepted + 1, weights=active_impressions,
+                                minlength=(n_grid + 1) ** 2).reshape(n_grid + 1, n_grid + 1)[:, 1:]
+        below = np.hstack([np.zeros((n_grid + 1, 1)), np.cumsum(histogram * grid, axis=1)[:, :-1]])
+        at_or_above = np.cumsum(histogram[:, ::-1], axis=1)[:, ::-1]
+        paid = np.cumsum(below + grid * at_or_above, axis=0)  # paid[b, p]: users with bucket <= b paying at price p
+        return np.minimum(single_bounds, paid[grid, grid] / 1000)
+
+    def expand(active, ladder, revenue):
+        used = {adnetwork for adnetwork, _ in ladder}
+        remaining = [n for n, adnetwork in enumerate(ADNETWORKS_list) if adnetwork not in used]
+        active_impressions = impressions[active]
+        active_buckets = buckets[active]
+
+        children = []
+        for n in remaining:
+            adnetwork = ADNETWORKS_list[n]
+            valid = np.ones(len(prices), dtype=bool)
+            if ladder:
+                last_adnetwork, last_price = ladder[-1]
+                valid = (prices <= last_price) & (last_price - prices <= THRESHOLD) & \
+                        ((prices != last_price) | (adnetwork > last_adnetwork))
+            if not valid.any():
+                continue
+
+            bucket = active_buckets[:, n]
+            accepted = np.cumsum(np.bincount(bucket, weights=active_impressions, minlength=n_grid + 1)[::-1])[::-1]
+            child_revenues = revenue + prices / 1000 * accepted[prices + 1]  # users with bucket > price accept it
+            others = [other for other in remaining if other != n]
+            bounds = child_revenues + get_subtree_bounds(bucket, active_buckets[:, others], active_impressions)[prices]
+            for j in np.flatnonzero(valid):
+                children.append((bounds[j], child_revenues[j], n, prices[j]))
+
+        children.sort(key=lambda child: -child[0])
+        for bound, child_revenue, n, price in children:
+            if bound <= threshold() + tolerance:  # ties up to rounding errors cannot enter the top ladders
+                break
+            child_ladder = ladder + ((ADNETWORKS_list[n], int(price)),)
+            if len(child_ladder) >= min_length and child_revenue > threshold():
+                yield child_revenue, child_ladder
+            if len(child_ladder) < len(ADNETWORKS_list):
+                yield from expand(active[active_buckets[:, n] <= price], child_ladder, child_revenue)
+
+    yield from expand(np.arange(len(users)), (), 0.0)
+
+def generate_all_neighbors(ADNETWORKS_list, prices, users, path_log, top_k=10):
+    """apply exhaustive search.
+    Ladders are streamed by generate_canonical_ladders and only the top_k are kept; returning the top_k waterfalls
+    (sorted by descending revenue), the optimal waterfall and its revenue."""
 
     logging.basicConfig(filename=path_log, filemode = 'a', level=logging.INFO)
     logging.info("running global optimization")
 
-    comb = []
+    top_ladders = []  # min-heap of (revenue, ladder)
+    def threshold():
+        return top_ladders[0][0] if len(top_ladders) >= top_k else -np.inf
+
+    cnt = 0
+    for revenue, ladder in generate_canonical_ladders(ADNETWORKS_list, prices, users, threshold):
+        cnt += 1
+        if len(top_ladders) < top_k:
+            heapq.heappush(top_ladders, (revenue, ladder))
+        else:
+            heapq.heappushpop(top_ladders, (revenue, ladder))
+    logging.info(f"number of scored ladders: {cnt}")
+
     all_waterfall = []
-    optimal_waterfall = []
-    optimal_revenue = 0
-    min_length = 2
-    for i in range(min_length,len(ADNETWORKS_list) + 1):
-        comb.append(perm(i, prices))
-    for i in range(len(comb)):
-        logging.info("running combination of size: " + str(i + min_length))
-        curr_ADNETWORKS_list = list(permutations(ADNETWORKS_list,i+min_length))
-        for k in curr_ADNETWORKS_list:
-            logging.info("curr_ADNETWORKS_list: " + "".join(k))
-            for j in comb[i]:
-                waterfall = create_waterfall(k,j)
-                waterfall.reorder(sort_by='price', reverse=True)
-                _results = waterfall.run(users, reset_waterfall=True)
-                revenue = waterfall.get_revenue()
-                if revenue > optimal_revenue:
-                    optimal_revenue = revenue
-                    optimal_waterfall = copy.deepcopy(waterfall)
-                all_waterfall.append(waterfall)
+    for revenue, ladder in sorted(top_ladders, reverse=True):
+        waterfall = create_waterfall([adnetwork for adnetwork, _ in ladder], [price for _, price in ladder])
+        waterfall.reorder(sort_by='price', reverse=True)
+        _results = waterfall.run(users, reset_waterfall=True)
+        all_waterfall.append(waterfall)
 
+    optimal_waterfall = all_waterfall[0] if all_waterfall else []
+    optimal_revenue = optimal_waterfall.get_revenue() if all_waterfall else 0
     return all_waterfall, optimal_waterfall, optimal_revenue
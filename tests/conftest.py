@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes import engine
+from classes.waterfall import Waterfall
+from classes.population import UserPopulation
+from classes.consts import MAX_CAPACITY_PER_ADNETWORK, THRESHOLD
+
+ADNETWORKS = list(MAX_CAPACITY_PER_ADNETWORK)
+
+
+@pytest.fixture
+def make_population():
+    """Returning a factory of synthetic populations of n_users users with one impression each, whose valuations in
+    every ad-network of classes.consts.MAX_CAPACITY_PER_ADNETWORK are Beta(a, 6) draws scaled to the ad-network, a
+    drawn per user around 1 (as the Beta(1, 6) cells of the synthetic valuation csv)."""
+
+    def make(n_users, seed=None):
+        rng = np.random.default_rng(seed)
+        scales = rng.uniform(0.05, 0.1, size=len(ADNETWORKS))
+        valuations = scales * rng.beta(np.exp(rng.uniform(-0.5, 0.5, size=(n_users, len(ADNETWORKS)))), 6)
+        return UserPopulation(np.arange(n_users), np.ones(n_users, dtype=int), valuations, ADNETWORKS)
+
+    return make
+
+
+@pytest.fixture
+def population(make_population):
+    """A small synthetic population of the three ad-networks of classes.consts.MAX_CAPACITY_PER_ADNETWORK."""
+
+    return make_population(500, seed=0)
+
+
+@pytest.fixture
+def make_waterfall():
+    """Returning a factory of waterfalls of n_ad_units 'High' ad-units whose floor prices go down evenly from
+    max_price while the ad-networks take turns, in the format of the waterfall csv files. With users (a
+    population.UserPopulation), the impressions and revenue of the ad-units are those of a simulation of the users.
+    names replaces the names of some ad-units (position -> name, e.g. 'Unity Med $12')."""
+
+    def make(n_ad_units=3, users=None, max_price=60, names=None):
+        step = min(THRESHOLD, (max_price - 1) / max(n_ad_units - 1, 1))
+        prices = np.round(max_price - step * np.arange(n_ad_units)).astype(int)
+        adnetworks = [ADNETWORKS[i % len(ADNETWORKS)] for i in range(n_ad_units)]
+        impressions, revenue = np.zeros(n_ad_units), np.zeros(n_ad_units)
+        if users is not None:
+            arrays = engine.WaterfallArrays(prices / 1000,
+                                            np.array([users.adnetwork_names.index(name) for name in adnetworks]),
+                                            np.ones(n_ad_units), np.ones(n_ad_units))
+            stats = engine.simulate(arrays, users.valuations, users.impressions, users.scale, users.valuation_sums)
+            impressions, revenue = stats.impressions, stats.revenue
+        df = pd.DataFrame({"Section": "High", "Order": np.arange(1, n_ad_units + 1),
+                           "Ad unit": [f"{name} U{i} ${price}" for i, (name, price) in enumerate(zip(adnetworks,
+                                                                                                     prices))],
+                           "RPM": 0, "Impressions": impressions.astype(int), "Network fill rate": 0,
+                           "Revenue": np.round(revenue, 3), "Network RPM": 0,
+                           "Ad unit id": [f"test{i}" for i in range(n_ad_units)]})
+        for position, name in (names or {}).items():
+            df.loc[position, "Ad unit"] = name
+        return Waterfall(df=df)
+
+    return make
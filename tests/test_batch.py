@@ -0,0 +1,96 @@
+import json
+import pytest
+
+from models import batch
+from models.batch import read_manifest, estimate_cost, run_batch
+
+CSV_PATH_USERS = "data/valuation_folder/synthetic_valuation_matrix.csv"
+CSV_PATH_WATERFALL = "data/waterfall_data/init_synth_waterfall1.csv"
+
+
+def write_manifest(path, entries):
+    path.write_text("\n".join(json.dumps(entry) for entry in entries) + "\n\n")
+    return str(path)
+
+
+def make_job(alg="SandS", adnetworks=("Unity", "Facebook", "Admob"), cost=None, job_id=0, **params):
+    return {"id": job_id, "name": f"job{job_id}", "waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS,
+            "alg": alg, "adnetworks": list(adnetworks), "cost": cost, "params": params}
+
+
+def test_read_manifest(tmp_path):
+    path = write_manifest(tmp_path / "manifest.jsonl", [
+        {"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS, "seed": 3, "max_evaluations": 10},
+        {"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS, "alg": "DP", "cost": 5},
+        {"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS, "adnetworks": ["Unity"]},
+        {"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS, "name": "custom"}])
+    jobs = read_manifest(path)
+
+    assert [job["id"] for job in jobs] == [0, 1, 2, 3]
+    # the names are unique per algorithm
+    assert [job["name"] for job in jobs] == ["init_synth_waterfall1", "init_synth_waterfall1",
+                                             "init_synth_waterfall1_2", "custom"]
+    assert [job["alg"] for job in jobs] == ["SandS", "DP", "SandS", "SandS"]
+    assert jobs[0]["params"] == {"seed": 3, "max_evaluations": 10}
+    assert jobs[1]["cost"] == 5 and jobs[1]["params"] == {}
+    assert jobs[2]["adnetworks"] == ["Unity"] and jobs[0]["adnetworks"] is None
+
+
+@pytest.mark.parametrize("entry, message", [
+    ({"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS, "max_evaluation": 10}, "unknown arguments"),
+    ({"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS, "save_path": "outputs"}, "unknown arguments"),
+    ({"waterfall": CSV_PATH_WATERFALL}, "missing valuation")])
+def test_read_manifest_rejects_invalid_jobs(tmp_path, entry, message):
+    path = write_manifest(tmp_path / "manifest.jsonl",
+                          [{"waterfall": CSV_PATH_WATERFALL, "valuation": CSV_PATH_USERS}, entry])
+    with pytest.raises(ValueError, match=f"job 1 of .*: {message}"):
+        read_manifest(path)
+
+
+def test_estimate_cost():
+    assert estimate_cost(make_job(max_evaluations=10), 100, 5) == 100 * 5 * 10
+    assert estimate_cost(make_job(alg="MCTS", max_evaluations=10), 100, 5) == 100 * 5 * 10
+    # the cost grows with the rows, the ad-units and the searches of a job
+    assert estimate_cost(make_job(), 200, 5) == 2 * estimate_cost(make_job(), 100, 5)
+    assert estimate_cost(make_job(), 100, 10) == 4 * estimate_cost(make_job(), 100, 5)
+    assert estimate_cost(make_job(n_folds=2), 100, 5) == 3 * estimate_cost(make_job(), 100, 5)
+    assert estimate_cost(make_job(alg="DP"), 100, 5) == 3 * estimate_cost(make_job(alg="DP", adnetworks=["Unity"]),
+                                                                          100, 5)
+    assert estimate_cost(make_job(alg="MCTS", n_simulations=20), 100, 5) == \
+        2 * estimate_cost(make_job(alg="MCTS", n_simulations=10), 100, 5)
+
+
+def test_run_batch_longest_first(tmp_path, monkeypatch):
+    started = []
+
+    def run_job(task):
+        job, _save_path, _path_log = task
+        started.append(job["id"])
+        return {"id": job["id"], "name": job["name"], "alg": job["alg"], "status": "done", "uplift": 0.0,
+                "seconds": 0.0}
+
+    monkeypatch.setattr(batch, "run_job", run_job)
+    jobs = [make_job(job_id=0, cost=1), make_job(job_id=1, max_evaluations=10), make_job(job_id=2, cost=1e12),
+            make_job(job_id=3, max_evaluations=1000), make_job(job_id=4, cost=1)]
+    summary = run_batch(jobs, str(tmp_path), str(tmp_path / "log"), n_jobs=1)
+
+    assert started == [2, 3, 1, 0, 4]  # the estimated cost (or the given one) decreases, ties in manifest order
+    assert summary["id"].tolist() == [0, 1, 2, 3, 4]  # the summary is in manifest order
+    assert summary["estimated_cost"].iloc[0] == 1
+    assert summary["estimated_cost"].iloc[3] == 100 * summary["estimated_cost"].iloc[1] > 0
+
+
+def test_run_batch_isolates_failures(tmp_path):
+    jobs = [make_job(job_id=0, seed=3, max_evaluations=5),
+            dict(make_job(job_id=1, seed=3), waterfall=str(tmp_path / "missing.csv")),  # fails to load
+            make_job(job_id=2, seed=3, max_evaluations=5, time_budget="soon"),  # fails in run_model
+            dict(make_job(job_id=3, seed=3), valuation=str(tmp_path / "missing.csv")),  # fails to read the csv
+            make_job(job_id=4, alg="MCTS", seed=3, max_evaluations=5)]
+    summary = run_batch(jobs, str(tmp_path), str(tmp_path / "log"), n_jobs=1)
+
+    assert summary["status"].tolist() == ["done", "failed", "failed", "failed", "done"]
+    assert summary["error"].isna().tolist() == [True, False, False, False, True]
+    assert (summary["revenue"].iloc[[0, 4]] >= summary["init_revenue"].iloc[[0, 4]]).all()
+    assert summary["evaluations"].iloc[0] > 0
+    assert (tmp_path / "batch_summary.csv").exists()
+    assert (tmp_path / "metrics_SandS_job0.json").exists() and (tmp_path / "metrics_MCTS_job4.json").exists()
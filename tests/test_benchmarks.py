@@ -0,0 +1,26 @@
+import json
+
+from benchmarks.run_benchmarks import BENCHMARKS, WATERFALL_BENCHMARKS, run_benchmarks, main
+
+
+def test_run_benchmarks_tiny_grid(tmp_path):
+    # enough users for the ad-units to pass delete_invalid_instances in the run_model_iteration benchmark
+    records = run_benchmarks([2000], [2, 3], n_adnetworks=2, repeats=1, work_dir=str(tmp_path), verbose=False)
+    expected = {(b, None if b in WATERFALL_BENCHMARKS else 2000, n) for b in BENCHMARKS for n in (2, 3)}
+    assert {(r["benchmark"], r["n_users"], r["n_ad_units"]) for r in records} == expected
+    for r in records:
+        assert r["repeats"] == 1 and len(r["seconds"]) == 1 and r["min"] >= 0
+    assert list(tmp_path.iterdir()) == []  # the temporary directory is removed
+
+
+def test_main_writes_and_compares(tmp_path, capsys):
+    output = str(tmp_path / "bench.json")
+    main(["--users", "100", "--ad-units", "2", "--adnetworks", "2", "--beta-params", "5", "--repeats", "1",
+          "--benchmarks", "waterfall_run", "generate_valid_neighbors", "--work-dir", str(tmp_path),
+          "--output", output])
+    with open(output) as fp:
+        results = json.load(fp)
+    assert {"commit", "python", "numpy"} <= set(results["environment"])
+    assert [r["benchmark"] for r in results["results"]] == ["generate_valid_neighbors", "waterfall_run"]
+    main(["--compare", output, output])
+    assert "waterfall_run" in capsys.readouterr().out.splitlines()[-1]
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import pandas as pd
+
+from classes.waterfall import Waterfall
+from classes.utils import create_real_users
+from classes.cache import get_file_hash, get_cache_key, save_population, load_population, delete_population, \
+    save_factors, load_factors
+
+CSV_PATH_USERS = "data/valuation_folder/synthetic_valuation_matrix.csv"
+CSV_PATH_WATERFALL = "data/waterfall_data/init_synth_waterfall1.csv"
+
+
+def test_cache_key():
+    key = get_cache_key("a", b"b", beta_size=1, adnetworks=["Unity", "Admob"])
+
+    assert key == get_cache_key("a", b"b", adnetworks=pd.Index(["Unity", "Admob"]), beta_size=1)
+    assert len({key, get_cache_key("a", b"c", beta_size=1, adnetworks=["Unity", "Admob"]),
+                get_cache_key("a", b"b", beta_size=3, adnetworks=["Unity", "Admob"]),
+                get_cache_key("a", b"b", beta_size=1, adnetworks=["Admob", "Unity"]),
+                get_cache_key("a", b"b", beta_size=1, adnetworks=["Unity", "Admob"], seed=0)}) == 5
+
+
+def test_file_hash(tmp_path):
+    path = tmp_path / "users.csv"
+    path.write_text("user_id,impressions\n1,1\n")
+    file_hash = get_file_hash(path)
+    assert file_hash == get_file_hash(path)
+
+    path.write_text("user_id,impressions\n1,2\n")
+    assert get_file_hash(path) != file_hash
+
+
+def test_population_cache(population, tmp_path):
+    assert load_population(tmp_path, "key") is None
+    save_population(tmp_path, "key", population.compress())
+    cached = load_population(tmp_path, "key")
+
+    np.testing.assert_array_equal(cached.valuations, population.compress().valuations)
+    np.testing.assert_array_equal(cached.valuation_sums, population.compress().valuation_sums)
+    assert cached.get_signature() == population.compress().get_signature()
+    delete_population(tmp_path, "key")
+    assert load_population(tmp_path, "key") is None
+
+
+def test_factors_cache(tmp_path):
+    path = os.path.join(tmp_path, "factors.npz")
+    assert load_factors(path) is None
+    save_factors(path, {"Unity": 1.04, "Admob": 0.8})
+    assert load_factors(path) == {"Unity": 1.04, "Admob": 0.8}
+
+
+def test_create_real_users_caches_factors(tmp_path):
+    csv_path_users = os.path.join(tmp_path, "users.valuations.csv")
+    pd.read_csv(CSV_PATH_USERS, nrows=2000).to_csv(csv_path_users, index=False)
+    cache_dir = os.path.join(tmp_path, "cache")
+    waterfall = Waterfall(csv_path=CSV_PATH_WATERFALL)
+    adnetworks = ["Unity", "Facebook", "Admob"]
+
+    users = create_real_users(csv_path_users, waterfall, adnetworks, beta_size=1, seed=0, cache_dir=cache_dir)
+    assert sorted(os.listdir(tmp_path)) == ["cache", "users.valuations.csv"]  # nothing is written next to the csv
+    factors_files = os.listdir(cache_dir)
+    assert len(factors_files) == 1 and factors_files[0].startswith("users.valuations_factors_")
+    cached = create_real_users(csv_path_users, waterfall, adnetworks, beta_size=1, seed=0, cache_dir=cache_dir)
+    np.testing.assert_array_equal(cached.scale, users.scale)
+
+    waterfall.ad_units[0].impressions += 100  # another observed waterfall invalidates the factors
+    create_real_users(csv_path_users, waterfall, adnetworks, beta_size=1, seed=0, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 2
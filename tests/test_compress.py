@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes.waterfall import Waterfall
+from classes.population import UserPopulation, is_on_price_grid
+from models.run_algorithms import can_compress, get_users
+
+CSV_PATH_USERS = "data/valuation_folder/synthetic_valuation_matrix.csv"
+CSV_PATH_WATERFALL = "data/waterfall_data/init_synth_waterfall1.csv"
+
+
+def get_fields(waterfall):
+    return np.array([[ad_unit.views, ad_unit.impressions, ad_unit.revenue, ad_unit.opt_revenue]
+                     for ad_unit in waterfall.ad_units], dtype=float)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_compress_is_lossless(population, make_waterfall, dtype):
+    users = UserPopulation(population.user_ids, population.impressions, population.valuations,
+                           population.adnetwork_names, dtype=dtype).scaled({"Unity": 1.07, "Admob": 0.93})
+    compressed = users.compress()
+    assert len(compressed) < len(users)
+    assert compressed.valuations.dtype == np.float64
+
+    for max_price in (60, 150):
+        waterfall = make_waterfall(6, users=population, max_price=max_price, names={1: "Facebook Med $48"})
+        waterfall.run(users)
+        expected = get_fields(waterfall)
+        waterfall.run(compressed)
+        np.testing.assert_allclose(get_fields(waterfall), expected)
+
+
+def test_is_on_price_grid():
+    assert is_on_price_grid([0, 5, 150]) and is_on_price_grid(np.array([12.0, 3.0]))
+    assert not is_on_price_grid([5, 151]) and not is_on_price_grid([-1, 5]) and not is_on_price_grid([12.5])
+    assert is_on_price_grid([5, 151], max_price=200)
+
+
+def test_can_compress(population, make_waterfall):
+    assert can_compress(make_waterfall(4, users=population, max_price=150))
+    assert not can_compress(make_waterfall(4, users=population, max_price=200))
+    waterfall = make_waterfall(4, users=population)
+    waterfall.ad_units[1].price = 12.5
+    assert not can_compress(waterfall)
+    waterfall = make_waterfall(4, users=population)
+    waterfall.ad_units[1].p_acceptance = 0.7
+    assert not can_compress(waterfall)
+
+
+def test_get_users_does_not_compress_off_the_price_grid(tmp_path):
+    df = pd.read_csv(CSV_PATH_WATERFALL)
+    df.loc[0, "Ad unit"] = "Facebook A $200"
+    csv_path_waterfall = str(tmp_path / "waterfall.csv")
+    df.to_csv(csv_path_waterfall, index=False)
+    adnetworks = ["Unity", "Facebook", "Admob"]
+
+    users = get_users(CSV_PATH_USERS, csv_path_waterfall, Waterfall(csv_path=csv_path_waterfall), adnetworks,
+                      str(tmp_path), seed=0)
+    assert users.valuation_sums is None
+    assert len(users) == len(get_users(CSV_PATH_USERS, csv_path_waterfall, Waterfall(csv_path=csv_path_waterfall),
+                                       adnetworks, str(tmp_path), seed=0, compress=False))
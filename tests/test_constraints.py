@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+
+from classes.consts import THRESHOLD, MAX_PRICE
+from classes.constraints import WaterfallConstraints
+from classes.waterfall_state import AdUnitState, WaterfallState
+
+ADNETWORKS = ["Unity", "Facebook", "Admob", "Vungle"]
+
+
+# the validators of search_and_score before the constraints index, on lists of ad-units
+def get_next_price(ad_units_list, ad_unit):
+    price = None
+    for ad_unit_other in ad_units_list:
+        if ad_unit.ad_unit_id == ad_unit_other.ad_unit_id:
+            break
+        if ad_unit_other.adnetwork_name == ad_unit.adnetwork_name:
+            price = ad_unit_other.price
+    return price
+
+
+def validation_single_change(ad_units, j):
+    ad_unit = ad_units[j]
+    upper = get_next_price(ad_units, ad_unit)
+    upper = np.inf if upper is None else upper
+    lower = get_next_price(ad_units[::-1], ad_unit)
+    lower = 0 if lower is None else lower
+    if len(ad_units) == 1:
+        return True
+    if ad_unit.get_price() >= upper or ad_unit.get_price() <= lower or ad_unit.get_price() > MAX_PRICE or \
+            ad_unit.get_price() < 0:
+        return False
+    for k in (j - 1, j + 1):
+        if 0 <= k < len(ad_units) and (abs(ad_unit.get_price() - ad_units[k].get_price()) > THRESHOLD or
+                                       ad_unit.adnetwork_name == ad_units[k].adnetwork_name):
+            return False
+    return True
+
+
+def validation_entire_waterfall(ad_units):
+    price, name = ad_units[0].get_price(), ad_units[0].adnetwork_name
+    for i in range(len(ad_units) - 1):
+        ad_unit = ad_units[i + 1]
+        upper = get_next_price(ad_units, ad_unit)
+        lower = get_next_price(ad_units[::-1], ad_unit)
+        if ad_unit.get_price() >= (np.inf if upper is None else upper) or \
+                ad_unit.get_price() <= (0 if lower is None else lower) or \
+                abs(ad_unit.get_price() - price) > THRESHOLD or ad_unit.get_price() > MAX_PRICE or \
+                ad_unit.get_price() < 0 or ad_unit.adnetwork_name == name:
+            return False
+        price, name = ad_unit.get_price(), ad_unit.adnetwork_name
+    return True
+
+
+def get_states(n_states, seed=0):
+    rng = np.random.default_rng(seed)
+    for _ in range(n_states):
+        n = int(rng.integers(1, 8))
+        prices = np.cumsum(-rng.integers(0, 36, n)) + int(rng.integers(0, 170))
+        yield WaterfallState([AdUnitState(k, ADNETWORKS[rng.integers(len(ADNETWORKS))], f"U{k}", 'High', price)
+                              for k, price in enumerate(prices)])
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_constraints_match_validators(seed):
+    for state in get_states(300, seed):
+        ad_units = list(state.ad_units)
+        constraints = WaterfallConstraints(state.ad_units)
+        assert constraints.sortable
+        assert constraints.is_valid() == validation_entire_waterfall(ad_units)
+        for j in range(len(ad_units)):
+            assert constraints.is_valid_at(j) == validation_single_change(ad_units, j)
+
+        for i in range(len(ad_units)):
+            for step in (-40, -5, -1, 1, 5, 40):
+                price = ad_units[i].price + step
+                new_ad_units = list(state.with_price(i, price).ad_units)
+                expected = validation_single_change(new_ad_units, i) and validation_single_change(
+                    new_ad_units, next(k for k, ad_unit in enumerate(new_ad_units) if ad_unit.ad_unit_id == i))
+                assert constraints.is_valid_price_change(i, price) == expected
+
+        for adnetwork in ADNETWORKS:
+            for price in (ad_units[0].price + 10, ad_units[-1].price, ad_units[len(ad_units) // 2].price - 3):
+                position = constraints.get_insert_position(price)
+                new_ad_units = ad_units[:position] + [AdUnitState(-1, adnetwork, "new", 'High', price)] + \
+                    ad_units[position:]
+                assert constraints.is_valid_insert(adnetwork, price) == \
+                    validation_single_change(new_ad_units, position)
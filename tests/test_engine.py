@@ -0,0 +1,42 @@
+import numpy as np
+
+from classes import engine
+
+
+def get_fields(waterfall):
+    return np.array([[ad_unit.views, ad_unit.impressions, ad_unit.revenue, ad_unit.opt_revenue]
+                     for ad_unit in waterfall.ad_units], dtype=float)
+
+
+def test_engine_matches_object_path(population, make_waterfall):
+    users = population.to_users()
+    waterfall = make_waterfall(6, max_price=40, names={2: "Admob Med $30"})
+    vectorized_log = waterfall.run(users)
+    vectorized = get_fields(waterfall)
+    object_log = waterfall.run(users, vectorized=False)
+
+    np.testing.assert_allclose(vectorized, get_fields(waterfall))
+    assert [(user_id, name, price) for user_id, name, _valuation, price in vectorized_log] == \
+        [(user_id, name, price) for user_id, name, _valuation, price in object_log]
+    assert vectorized[:, 1].sum() > 0
+
+
+def test_simulate_many_matches_simulate(population, make_waterfall):
+    arrays_list = [engine.get_waterfall_arrays(make_waterfall(n).ad_units, population.adnetwork_names)
+                   for n in (1, 3, 6)]
+    many = engine.simulate_many(arrays_list, population.valuations, population.impressions, population.scale,
+                                max_cells=700)  # several chunks of users
+    for arrays, stats in zip(arrays_list, many):
+        single = engine.simulate(arrays, population.valuations, population.impressions, population.scale)
+        for field in ("views", "impressions", "revenue", "opt_revenue"):
+            np.testing.assert_allclose(getattr(stats, field), getattr(single, field))
+
+
+def test_legacy_seed(population, make_waterfall):
+    arrays = engine.get_waterfall_arrays(make_waterfall(6).ad_units, population.adnetwork_names)
+    arrays = arrays._replace(p_acceptance=np.full(len(arrays.prices), 0.5))
+    revenues = []
+    for _ in range(2):
+        np.random.seed(0)  # calls without a Generator draw from the legacy global generator
+        revenues.append(engine.simulate(arrays, population.valuations, population.impressions).revenue)
+    np.testing.assert_array_equal(revenues[0], revenues[1])
@@ -0,0 +1,87 @@
+import copy
+import numpy as np
+import pytest
+
+from classes import engine
+from models.evaluator import Evaluator, EvaluationCache
+from models.search_and_score import generate_valid_neighbor_states
+
+FIELDS = ("views", "impressions", "revenue", "opt_revenue")
+
+
+@pytest.mark.parametrize("p_acceptance", [1, 0.7])
+def test_incremental_matches_full_evaluation(population, make_waterfall, p_acceptance):
+    waterfall = make_waterfall(6, users=population)
+    for ad_unit in waterfall.ad_units[::2]:
+        ad_unit.p_acceptance = p_acceptance
+    state = waterfall.to_state()
+    neighbors = generate_valid_neighbor_states(state, np.random.default_rng(0))
+    assert len(neighbors) > 0
+
+    full = Evaluator(population, cache_size=0, seed=1)
+    incremental = Evaluator(population, state, cache_size=0, seed=1)  # the cache drops capture
+    batched = incremental.score_many(neighbors)
+    n_users_simulated = incremental.n_users_simulated
+    for neighbor, neighbor_stats in zip(neighbors, batched):
+        expected = full.get_stats(full.get_arrays(neighbor))
+        stats = incremental.get_stats(incremental.get_arrays(neighbor))
+        np.testing.assert_array_equal(stats.capture, expected.capture)
+        for field in FIELDS:
+            np.testing.assert_allclose(getattr(stats, field), getattr(expected, field))
+            np.testing.assert_allclose(getattr(neighbor_stats, field), getattr(expected, field))
+    assert incremental.n_users_simulated - n_users_simulated < full.n_users_simulated
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_run_many_matches_simulate(population, make_waterfall, compress):
+    users = population.compress() if compress else population
+    waterfalls = [make_waterfall(n, max_price=max_price) for n, max_price in ((1, 20), (3, 40), (6, 60), (2, 10))]
+    expected = [engine.simulate(engine.get_waterfall_arrays(waterfall.ad_units, users.adnetwork_names),
+                                users.valuations, users.impressions, users.scale, users.valuation_sums)
+                for waterfall in waterfalls]
+
+    ran = [copy.deepcopy(waterfall) for waterfall in waterfalls]
+    stats = Evaluator(users, max_cells=50, cache_size=0).run_many(ran)  # chunks of 12 users for the 4 padded ladders
+    for waterfall, waterfall_stats, waterfall_expected in zip(ran, stats, expected):
+        for field in FIELDS:
+            np.testing.assert_allclose(getattr(waterfall_stats, field), getattr(waterfall_expected, field))
+        np.testing.assert_allclose([ad_unit.revenue for ad_unit in waterfall.ad_units], waterfall_expected.revenue)
+
+
+def test_cache_lru_eviction():
+    cache = EvaluationCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # "a" is now the most recently used entry
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert (cache.get("a"), cache.get("c")) == (1, 3)
+    assert cache.get_info() == {"hits": 3, "misses": 1, "size": 2, "hit_rate": 0.75}
+
+
+def test_cache_hits_and_batch_deduplication(population, make_waterfall):
+    state = make_waterfall(3).to_state()
+    other = make_waterfall(3, max_price=40).to_state()
+    evaluator = Evaluator(population)
+    stats = evaluator.score_many([state, state, other])  # the duplicate is simulated once
+
+    assert stats[0] is stats[1] and stats[0] is not stats[2]
+    assert (evaluator.cache.hits, evaluator.cache.misses) == (0, 2)
+    assert evaluator.score_many([other])[0] is stats[2]
+    assert (evaluator.cache.hits, evaluator.cache.misses) == (1, 2)
+    assert evaluator.n_evaluations == 4
+
+
+def test_cache_key_changes_with_calibration(population, make_waterfall):
+    waterfall = make_waterfall(3)
+    evaluator = Evaluator(population)
+    calibrated = Evaluator(population.scaled({adnetwork: 2 for adnetwork in population.adnetwork_names}))
+    arrays = evaluator.get_arrays(waterfall.to_state())
+
+    assert EvaluationCache.get_signature(arrays, Evaluator(population).population_signature) == \
+        EvaluationCache.get_signature(arrays, evaluator.population_signature)
+    assert EvaluationCache.get_signature(arrays, calibrated.population_signature) != \
+        EvaluationCache.get_signature(arrays, evaluator.population_signature)
+    assert calibrated.score_many([waterfall])[0].revenue.sum() != evaluator.score_many([waterfall])[0].revenue.sum()
+    assert calibrated.cache.misses == 1
@@ -0,0 +1,58 @@
+import itertools
+import numpy as np
+import pytest
+
+from classes.consts import THRESHOLD
+from classes.waterfall_state import AdUnitState, WaterfallState
+from models.evaluator import Evaluator
+from models.search_and_score import generate_all_neighbors
+from models.dynamic_programming import optimize_ladder
+
+PRICES = range(0, 61, 5)
+
+
+def brute_force(users, min_length):
+    """Returning the revenues of every valid ladder of one 'High' ad-unit per ad-network, from the highest."""
+
+    states = []
+    for length in range(min_length, len(users.adnetwork_names) + 1):
+        for adnetworks in itertools.permutations(users.adnetwork_names, length):
+            for prices in itertools.product(PRICES, repeat=length):
+                pairs = list(zip(prices, adnetworks))
+                if any(lower[0] > upper[0] or upper[0] - lower[0] > THRESHOLD or
+                       (lower[0] == upper[0] and lower[1] < upper[1]) for upper, lower in zip(pairs, pairs[1:])):
+                    continue
+                states.append(WaterfallState([AdUnitState(n, adnetwork, f"{adnetwork} ${price}", 'High', price)
+                                              for n, (adnetwork, price) in enumerate(zip(adnetworks, prices))]))
+    stats = Evaluator(users, cache_size=0).score_many(states)
+    return sorted((float(state_stats.revenue.sum()) for state_stats in stats), reverse=True)
+
+
+@pytest.fixture
+def small_population(population):
+    return population.subset(np.arange(200))
+
+
+def test_generate_all_neighbors_is_optimal(small_population, tmp_path):
+    all_waterfall, _optimal_waterfall, optimal_revenue = generate_all_neighbors(
+        small_population.adnetwork_names, PRICES, small_population, tmp_path / "log", top_k=5)
+    expected = brute_force(small_population, min_length=2)
+
+    assert optimal_revenue == pytest.approx(expected[0])
+    np.testing.assert_allclose([waterfall.get_revenue() for waterfall in all_waterfall], expected[:5])
+
+
+def test_dynamic_programming_is_optimal(small_population, tmp_path):
+    _waterfall, revenue, certified = optimize_ladder(small_population.adnetwork_names, small_population,
+                                                     tmp_path / "log", prices=PRICES)
+
+    assert certified
+    assert revenue == pytest.approx(brute_force(small_population, min_length=1)[0])
+
+
+def test_dynamic_programming_heuristic(small_population, tmp_path):
+    _waterfall, revenue, certified = optimize_ladder(small_population.adnetwork_names, small_population,
+                                                     tmp_path / "log", prices=PRICES, certify=False)
+
+    assert not certified
+    assert revenue <= brute_force(small_population, min_length=1)[0] + 1e-9
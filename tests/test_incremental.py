@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes.metrics import RunMetrics
+from models import incremental
+from models.evaluator import Evaluator
+from models.incremental import IncrementalOptimizer
+
+CSV_PATH_USERS = "data/valuation_folder/synthetic_valuation_matrix.csv"
+CSV_PATH_WATERFALL = "data/waterfall_data/init_synth_waterfall1.csv"
+ADNETWORKS = ["Unity", "Facebook", "Admob"]
+
+
+@pytest.fixture
+def batches(tmp_path):
+    """Three valuation csv files of 2000 users of the synthetic valuation csv."""
+
+    users_df = pd.read_csv(CSV_PATH_USERS).sample(6000, random_state=0)
+    paths = []
+    for k in range(3):
+        paths.append(os.path.join(tmp_path, f"batch_{k}.csv"))
+        users_df.iloc[2000 * k:2000 * (k + 1)].to_csv(paths[-1], index=False)
+    return paths
+
+
+def get_revenues(optimizer, users):
+    stats = Evaluator(users, cache_size=0, seed=0).score_many([optimizer.state] + optimizer.neighbors)
+    return np.array([float(stats.revenue.sum()) for stats in stats])
+
+
+def test_rescore_delta(batches, tmp_path):
+    optimizer = IncrementalOptimizer(CSV_PATH_WATERFALL, ADNETWORKS, tmp_path, "test", window=2, grid=(1.0,), seed=0)
+    optimizer.update(batches[0], max_evaluations=20)
+    optimizer.update(batches[1], max_evaluations=20)
+
+    added, removed = optimizer.ingest(batches[2])
+    assert len(removed) == 1
+    removed_users = [incremental.load_population(optimizer.get_cache_dir(), key) for _batch_id, key in removed]
+    optimizer.rescore_delta(added, removed_users, np.random.SeedSequence(1), RunMetrics())
+
+    revenues = get_revenues(optimizer, optimizer.get_users().scaled(optimizer.factors).compress())
+    np.testing.assert_allclose([optimizer.revenue] + optimizer.neighbor_revenues.tolist(), revenues, rtol=1e-9)
+
+
+def test_restart_from_best_neighbor(batches, tmp_path, monkeypatch):
+    optimizer = IncrementalOptimizer(CSV_PATH_WATERFALL, ADNETWORKS, tmp_path, "test", full_every=1, seed=0)
+    starts = []
+
+    def search_and_score(waterfall, users, waterfall_name, save_path, i, **kwargs):
+        if optimizer.state is not None:
+            best = int(np.argmax(optimizer.neighbor_revenues))
+            starts.append((waterfall.to_state(), waterfall.get_revenue(), optimizer.neighbors[best],
+                           optimizer.neighbor_revenues[best], waterfall_name, i))
+        return waterfall, [waterfall.get_revenue()], False
+
+    monkeypatch.setattr(incremental, "search_and_score", search_and_score)
+    optimizer.update(batches[0])  # the initial waterfall is kept as the optimum
+    optimizer.update(batches[1])
+
+    assert len(starts) == 1
+    state, revenue, neighbor, neighbor_revenue, waterfall_name, i = starts[0]
+    assert state == neighbor
+    assert revenue == pytest.approx(neighbor_revenue)
+    assert (waterfall_name, i) == ("incremental_test", 0)
+
+
+def test_load_keeps_the_global_random_state(batches, tmp_path):
+    optimizer = IncrementalOptimizer(CSV_PATH_WATERFALL, ADNETWORKS, tmp_path, "test", seed=0)
+    optimizer.update(batches[0], max_evaluations=10)
+    np.random.seed(1)
+    expected = np.random.random()
+    np.random.seed(1)
+    loaded = IncrementalOptimizer.load(tmp_path, "test")
+
+    assert np.random.random() == expected
+    assert loaded.state == optimizer.state
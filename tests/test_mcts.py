@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+
+from classes.consts import N_SIMULATIONS
+from models.evaluator import Evaluator
+from models.mcts import MonteCarloTreeSearch
+from models.dynamic_programming import optimize_ladder
+
+
+@pytest.fixture
+def users(make_population):
+    """A compressed population large enough for its ad-units not to be deleted as invalid."""
+
+    return make_population(3000, seed=0).compress()
+
+
+@pytest.fixture
+def mcts(users, make_waterfall):
+    return MonteCarloTreeSearch(Evaluator(users, seed=0), make_waterfall(3, users=users).to_state(),
+                                rng=np.random.default_rng(0))
+
+
+def expand_all(mcts, node):
+    while node.is_expandable():
+        mcts.expand(node)
+    return node.children
+
+
+def test_expand(mcts, users):
+    root = mcts.root
+    child = mcts.expand(root)
+
+    assert child.parent is root and root.children == [child]
+    assert len(root.untried) + 1 == mcts.metrics.counters["neighbors_generated"]
+    stats = Evaluator(users, cache_size=0, seed=0).score_many([child.state])[0]
+    assert child.revenue == pytest.approx(float(stats.revenue.sum()))
+    assert mcts.best_revenue == max(root.revenue, child.revenue)
+
+
+def test_select(mcts):
+    root = mcts.root
+    assert mcts.select() is root  # the root is not expanded yet
+
+    children = expand_all(mcts, root)
+    mcts.min_reward, mcts.max_reward = 0.0, 1.0
+    for k, child in enumerate(children):
+        child.visits, child.total_reward = 10, 9.0 if k == 1 else 1.0
+    root.visits = 10 * len(children)
+    assert mcts.select() is children[1]  # the best mean, all the children being visited as often
+
+
+def test_backpropagate(mcts):
+    child = mcts.expand(mcts.root)
+    sibling = mcts.expand(mcts.root)
+    grandchild = mcts.expand(child)
+    mcts.backpropagate(grandchild, 5.0)
+    mcts.backpropagate(child, -1.0)
+
+    assert [node.visits for node in (mcts.root, child, grandchild, sibling)] == [2, 2, 1, 0]
+    assert [node.total_reward for node in (mcts.root, child, grandchild, sibling)] == [4.0, 4.0, 5.0, 0.0]
+    assert (mcts.min_reward, mcts.max_reward) == (-1.0, max(5.0, mcts.root.revenue))
+
+
+def test_advance(mcts):
+    root = mcts.root
+    children = expand_all(mcts, root)
+    for child in children:
+        child.visits, child.total_reward, child.revenue = 1, 1.0, root.revenue
+    children[0].total_reward = 100.0
+    assert mcts.advance() is root  # no child beats the root, the root and its tree are kept
+    assert root.children == children
+
+    children[1].revenue = root.revenue + 1
+    grandchild = mcts.expand(children[1])
+    assert mcts.advance() is children[1]  # the best mean among the children beating the root
+    assert children[1].parent is None and children[1].children == [grandchild]
+
+
+def test_search_without_limits(mcts):
+    assert mcts.search(n_simulations=None, time_budget=None, max_evaluations=None) == N_SIMULATIONS
+
+
+def test_search_reaches_optimum(mcts, users, tmp_path):
+    _waterfall, optimal_revenue, certified = optimize_ladder(users.adnetwork_names, users, tmp_path / "log")
+    for _ in range(40):
+        mcts.search(n_simulations=50)
+        mcts.advance()
+
+    assert certified
+    assert mcts.best_revenue == pytest.approx(optimal_revenue)
@@ -0,0 +1,94 @@
+import json
+import time
+
+from classes.metrics import RunCallback, RunMetrics
+from models.run_algorithms import run_model
+
+CSV_PATH_USERS = "data/valuation_folder/synthetic_valuation_matrix.csv"
+CSV_PATH_WATERFALL = "data/waterfall_data/init_synth_waterfall1.csv"
+ADNETWORKS = ["Unity", "Facebook", "Admob"]
+
+
+class RecordingCallback(RunCallback):
+    def __init__(self):
+        self.events = []
+
+    def on_run_start(self, metrics, **info):
+        self.events.append(("run_start", info))
+
+    def on_iteration(self, metrics, **info):
+        self.events.append(("iteration", info))
+
+    def on_adopt(self, metrics, **info):
+        self.events.append(("adopt", info))
+
+    def on_run_end(self, metrics, **info):
+        self.events.append(("run_end", info))
+
+
+def test_phases_and_counters(tmp_path):
+    metrics = RunMetrics().start()
+    for _ in range(2):
+        with metrics.phase("outer"):
+            with metrics.phase("inner"):
+                time.sleep(0.01)
+    metrics.add("evaluations", 3)
+    metrics.add("evaluations")
+    metrics.set("value", [1, 2])
+    metrics.stop()
+    metrics.save(tmp_path / "metrics.json")
+
+    with open(tmp_path / "metrics.json") as fp:
+        result = json.load(fp)
+    assert result["phases"]["inner"]["calls"] == result["phases"]["outer"]["calls"] == 2
+    assert 0.02 <= result["phases"]["inner"]["seconds"] <= result["phases"]["outer"]["seconds"] <= result["seconds"]
+    assert result["counters"] == {"evaluations": 4}
+    assert result["evaluations_per_second"] == 4 / result["seconds"]
+    assert result["value"] == [1, 2] and result["peak_memory_bytes"] is None
+
+
+def test_run_model_callbacks_and_metrics(tmp_path):
+    callback = RecordingCallback()
+    _waterfall, save_best_revenue, *_ = run_model(CSV_PATH_WATERFALL, CSV_PATH_USERS, "test", str(tmp_path),
+                                                  str(tmp_path / "log"), "SandS", ADNETWORKS, seed=3,
+                                                  max_evaluations=30, callbacks=[callback])
+
+    events = [event for event, _info in callback.events]
+    assert events[0] == "run_start" and events[-1] == "run_end"
+    assert callback.events[0][1] == {"alg": "SandS", "waterfall_name": "test"}
+    assert callback.events[-1][1] == {"revenue": save_best_revenue[-1]}
+    iterations = [info["iteration"] for event, info in callback.events if event == "iteration"]
+    assert iterations == list(range(1, len(iterations) + 1))
+    adoptions = []
+    for event, info in callback.events[1:-1]:  # the adoptions are notified before the end of their iteration
+        if event == "adopt":
+            adoptions.append(info["iteration"])
+        else:
+            assert all(iteration == info["iteration"] for iteration in adoptions)
+            adoptions = []
+    assert len(adoptions) == 0
+
+    with open(tmp_path / "metrics_SandS_test.json") as fp:
+        result = json.load(fp)
+    assert result["counters"]["iterations"] == len(iterations)
+    assert result["counters"]["adoptions"] == events.count("adopt")
+    assert result["counters"]["neighbors_scored"] == 30
+    assert result["phases"]["neighbors"]["calls"] == len(iterations)
+    assert {"load_users", "simulation", "neighbors", "logging", "output"} <= set(result["phases"])
+    assert sum(phase["seconds"] for name, phase in result["phases"].items()
+               if name in ("load_users", "neighbors", "output")) <= result["seconds"]
+
+
+def test_run_model_sums_the_fold_counters(tmp_path):
+    callback = RecordingCallback()
+    run_model(CSV_PATH_WATERFALL, CSV_PATH_USERS, "kfold", str(tmp_path), str(tmp_path / "log"), "SandS", ADNETWORKS,
+              seed=3, max_evaluations=20, n_folds=2, n_jobs=1, callbacks=[callback])
+
+    with open(tmp_path / "metrics_SandS_kfold.json") as fp:
+        result = json.load(fp)
+    assert len(result["folds"]) == 2
+    # the counters of the folds are summed with those of the final search on all the users (20 neighbors each)
+    assert result["counters"]["neighbors_scored"] == 3 * 20
+    assert result["counters"]["iterations"] == [event for event, _info in callback.events].count("iteration")
+    for name in ("iterations", "neighbors_scored", "evaluations"):
+        assert result["counters"][name] > sum(fold["counters"][name] for fold in result["folds"]) > 0
@@ -0,0 +1,21 @@
+import numpy as np
+
+from models.evaluator import Evaluator
+from models.parallel import ParallelEvaluator
+from models.search_and_score import generate_valid_neighbor_states
+
+
+def test_parallel_matches_serial(population, make_waterfall):
+    waterfall = make_waterfall(6, users=population)
+    waterfall.ad_units[1].p_acceptance = 0.7
+    state = waterfall.to_state()
+    neighbors = generate_valid_neighbor_states(state, np.random.default_rng(0))
+
+    serial = Evaluator(population, state, seed=1)
+    with ParallelEvaluator(population, state, n_jobs=2, seed=1) as parallel:
+        parallel_stats = parallel.score_many(neighbors)
+    for expected, stats in zip(serial.score_many(neighbors), parallel_stats):
+        for field in ("views", "impressions", "revenue", "opt_revenue"):
+            np.testing.assert_allclose(getattr(stats, field), getattr(expected, field))
+    assert parallel.shms == {}
+    parallel.close()  # closing twice does nothing
@@ -0,0 +1,33 @@
+import numpy as np
+
+from classes.population import UserPopulation
+
+
+def get_fields(waterfall):
+    return np.array([[ad_unit.views, ad_unit.impressions, ad_unit.revenue, ad_unit.opt_revenue]
+                     for ad_unit in waterfall.ad_units], dtype=float)
+
+
+def test_users_round_trip(population):
+    users = UserPopulation.from_users(population.to_users(), population.adnetwork_names)
+
+    np.testing.assert_array_equal(users.user_ids, population.user_ids)
+    np.testing.assert_array_equal(users.impressions, population.impressions)
+    np.testing.assert_array_equal(users.valuations, population.valuations)
+
+
+def test_population_matches_users(population, make_waterfall):
+    scaled = population.scaled({"Facebook": 1.1, "Admob": 0.9})
+    waterfall = make_waterfall(6, users=population)
+    waterfall.run(scaled.to_users())
+    expected = get_fields(waterfall)
+    waterfall.run(scaled)
+
+    np.testing.assert_allclose(get_fields(waterfall), expected)
+
+
+def test_save_load(population, tmp_path):
+    scaled = population.scaled({"Unity": 1.2})
+    scaled.save(tmp_path / "users.npz")
+
+    assert UserPopulation.load(tmp_path / "users.npz").get_signature() == scaled.get_signature()
@@ -0,0 +1,26 @@
+import numpy as np
+
+from models.evaluator import Evaluator
+from models.racing import NeighborRacing
+from models.search_and_score import generate_valid_neighbor_states
+
+
+def test_racing_drops_only_worse_neighbors(make_population, make_waterfall):
+    users = make_population(5000, seed=1)
+    state = make_waterfall(6, users=users).to_state()
+    evaluator = Evaluator(users, state, cache_size=0, seed=2)
+    incumbent_revenue = float(evaluator.incumbent_stats.revenue.sum())
+    racing = NeighborRacing(evaluator, rng=np.random.default_rng(3))
+
+    dropped = []
+    for seed in range(5):
+        neighbors = generate_valid_neighbor_states(state, np.random.default_rng(seed))
+        survivors = racing.race(neighbors)
+        dropped += [neighbor for neighbor in neighbors if neighbor not in survivors]
+    assert racing.n_dropped == len(dropped) > 0
+
+    n_users_simulated = evaluator.n_users_simulated
+    for neighbor in dropped:
+        assert float(evaluator.get_stats(evaluator.get_arrays(neighbor)).revenue.sum()) < incumbent_revenue
+    assert racing.get_info()["users_saved"] == \
+        evaluator.n_users_simulated - n_users_simulated - racing.n_users_simulated
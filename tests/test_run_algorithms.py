@@ -0,0 +1,72 @@
+import os
+import copy
+import json
+import shutil
+import numpy as np
+
+from classes.waterfall import Waterfall
+from classes.metrics import RunMetrics
+from models.evaluator import Evaluator
+from models.search_and_score import delete_invalid_instances
+from models.run_algorithms import search_and_score, get_checkpoint_path, get_users, run_model
+
+
+def test_search_and_score_budget(population, make_waterfall, tmp_path):
+    metrics = RunMetrics()
+    _waterfall, _save_best_revenue, stopped = search_and_score(make_waterfall(6, users=population), population,
+                                                               "test", tmp_path, 0, seed=0, max_evaluations=20,
+                                                               checkpoint_every=1, metrics=metrics)
+
+    assert stopped
+    assert metrics.counters["neighbors_scored"] == 20
+    assert os.path.exists(get_checkpoint_path(tmp_path, "SandS", "test", population, 0, 0))
+    assert get_checkpoint_path(tmp_path, "SandS", "test", population.scaled({"Unity": 1.1}), 0, 0) != \
+        get_checkpoint_path(tmp_path, "SandS", "test", population, 0, 0)
+    assert get_checkpoint_path(tmp_path, "SandS", "test", population, 1, 0) != \
+        get_checkpoint_path(tmp_path, "SandS", "test", population, 0, 0)
+
+
+def test_search_and_score_budget_with_racing(make_population, make_waterfall, tmp_path):
+    users = make_population(5000, seed=1)
+    metrics = RunMetrics()
+    search_and_score(make_waterfall(6, users=users), users, "test", tmp_path, 0, seed=0, max_evaluations=20,
+                     racing_fractions=(0.05, 0.2), metrics=metrics)
+
+    assert metrics.counters["racing_dropped"] > 0
+    assert metrics.counters["neighbors_scored"] == 20  # the dropped neighbors are not charged to the budget
+
+
+def test_search_and_score_init_revenue(population, make_waterfall, tmp_path):
+    waterfall = make_waterfall(6, users=population)
+    for ad_unit in waterfall.ad_units:
+        ad_unit.p_acceptance = 0.7
+    state = delete_invalid_instances(copy.deepcopy(waterfall)).to_state()
+    _search_seed, evaluator_seed, _racing_seed = np.random.SeedSequence(0, spawn_key=(1, 0)).spawn(3)
+    expected = float(Evaluator(population, seed=evaluator_seed).score_many([state])[0].revenue.sum())
+
+    _waterfall, save_best_revenue, _stopped = search_and_score(waterfall, population, "test", tmp_path, 0, seed=0,
+                                                               max_evaluations=0)
+    assert save_best_revenue[0] == expected
+
+
+def test_k_fold_returns_the_waterfall_of_all_users(tmp_path):
+    # the calibration factors are saved next to the valuation csv
+    for path in ("waterfall_data/init_synth_waterfall1.csv", "valuation_folder/synthetic_valuation_matrix.csv"):
+        shutil.copy(f"data/{path}", tmp_path)
+    csv_path_waterfall, csv_path_users = str(tmp_path / "init_synth_waterfall1.csv"), \
+        str(tmp_path / "synthetic_valuation_matrix.csv")
+    adnetworks = ["Unity", "Facebook", "Admob"]
+    waterfall, save_best_revenue, *_ = run_model(csv_path_waterfall, csv_path_users, "kfold", str(tmp_path),
+                                                 str(tmp_path / "log"), "SandS", adnetworks, seed=3,
+                                                 max_evaluations=30, n_folds=2, n_jobs=1)
+
+    users = get_users(csv_path_users, csv_path_waterfall, Waterfall(csv_path=csv_path_waterfall), adnetworks,
+                      str(tmp_path), seed=3)
+    expected, expected_save_best_revenue, _stopped = search_and_score(Waterfall(csv_path=csv_path_waterfall), users,
+                                                                      "all", tmp_path, 0, seed=3, max_evaluations=30)
+    assert save_best_revenue == expected_save_best_revenue
+    assert [(ad_unit.adnetwork_name, ad_unit.ad_unit_name, ad_unit.price) for ad_unit in waterfall.ad_units] == \
+        [(ad_unit.adnetwork_name, ad_unit.ad_unit_name, ad_unit.price) for ad_unit in expected.ad_units]
+    with open(tmp_path / "metrics_SandS_kfold.json") as fp:
+        uplift = json.load(fp)["uplift"]
+    assert len(uplift["folds"]) == 2 and np.isfinite(uplift["mean"])
@@ -0,0 +1,13 @@
+from models.search_and_score import delete_invalid_instances, delete_invalid_ad_units
+
+
+def test_delete_invalid_instances(population, make_waterfall):
+    waterfall = make_waterfall(6, users=population, max_price=150)  # the top ad-units sell nothing
+    stats = waterfall.run(population)
+    state = waterfall.to_state()
+    n_invalid = int(((stats.revenue < 10) & (stats.impressions < 50)).sum())
+    assert n_invalid >= 2
+
+    waterfall = delete_invalid_instances(waterfall)
+    assert len(waterfall.ad_units) == 6 - n_invalid
+    assert waterfall.to_state() == delete_invalid_ad_units(state, stats)
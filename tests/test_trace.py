@@ -0,0 +1,28 @@
+import logging
+
+from classes.trace import TraceWriter, read_trace
+
+
+def test_dump_is_lazy(make_waterfall, caplog, monkeypatch):
+    waterfall = make_waterfall(3)
+    calls = []
+    get_df = waterfall.get_df
+    monkeypatch.setattr(waterfall, "get_df", lambda: calls.append(1) or get_df())
+
+    with caplog.at_level(logging.WARNING):
+        TraceWriter.dump(waterfall)
+    assert calls == []
+    with caplog.at_level(logging.INFO):
+        TraceWriter.dump(waterfall, 'curr_waterfall')
+    assert len(calls) > 0 and caplog.records[-1].getMessage().startswith('curr_waterfall - ')
+
+
+def test_trace(make_waterfall, tmp_path):
+    waterfall = make_waterfall(3)
+    trace = TraceWriter(tmp_path / "trace.jsonl")
+    trace.start(waterfall, 1.0, iteration=0)
+    trace.iteration(1, 10, 2.0)
+    trace.end(2.0)
+    trace.close()
+
+    assert [record["event"] for record in read_trace(tmp_path / "trace.jsonl")] == ["start", "iteration", "end"]
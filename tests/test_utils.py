@@ -0,0 +1,65 @@
+import copy
+import numpy as np
+import pandas as pd
+import pytest
+
+from classes.utils import sample_valuations, optimize_factors
+
+GRID = np.arange(80, 122, 4) / 100
+
+
+def test_sample_valuations():
+    column = pd.Series(["1,2", "1.0,2.0", "0.5", None, "x", "2,3,0.1,2", "0,1"] * 2000)
+    valuations, errors = sample_valuations(column, 3, np.random.default_rng(0))
+
+    assert errors == 2 * 2000  # "x" and a = 0
+    np.testing.assert_array_equal(valuations[2::7], 0.5)
+    assert np.isnan(valuations[3::7]).all() and np.isnan(valuations[6::7]).all()
+    # "1,2" and "1.0,2.0" are the same Beta(1, 2), of mean 1/3
+    np.testing.assert_allclose([valuations[0::7].mean(), valuations[1::7].mean()], 1 / 3, atol=0.01)
+    np.testing.assert_allclose(valuations[5::7].mean(), 0.1 + 2 * 0.4, atol=0.02)
+    np.testing.assert_array_equal(sample_valuations(column, 3, np.random.default_rng(0))[0], valuations)
+
+
+def get_objective(users, init_waterfall, factors):
+    """The weighted distance of the impressions of the waterfall run on the users scaled by factors to its observed
+    impressions (the objective of optimize_factors)."""
+
+    prices = np.array([ad_unit.price for ad_unit in init_waterfall.ad_units], dtype=float)
+    waterfall = copy.deepcopy(init_waterfall)
+    waterfall.run(users.scaled(factors), reset_waterfall=True)
+    return float((np.abs(np.array([ad_unit.impressions for ad_unit in init_waterfall.ad_units]) -
+                         [ad_unit.impressions for ad_unit in waterfall.ad_units]) * prices / prices.sum()).sum())
+
+
+def optimize_factors_per_grid_point(users, init_waterfall, n_rounds, tol):
+    """The calibration scoring every grid value of an ad-network by its own run of the waterfall on a scaled copy of
+    the population (as before the batched grid)."""
+
+    factors = {adnetwork: 1 for adnetwork in users.adnetwork_names}
+    best_score = np.inf
+    for _ in range(n_rounds):
+        previous_score = best_score
+        for adnetwork in dict.fromkeys(ad_unit.adnetwork_name for ad_unit in init_waterfall.ad_units):
+            scores = [get_objective(users, init_waterfall, dict(factors, **{adnetwork: value})) for value in GRID]
+            factors[adnetwork] = float(GRID[int(np.argmin(scores))])
+            best_score = min(scores)
+        if previous_score - best_score <= tol:
+            break
+    return factors
+
+
+@pytest.mark.parametrize("n_rounds, tol", [(1, 0), (4, 0), (4, np.inf)])
+def test_optimize_factors_matches_per_grid_point(population, make_waterfall, n_rounds, tol):
+    # calibrating Unity first, with the other factors at 1, misses: the next rounds correct it
+    observed = population.scaled({adnetwork: 0.84 for adnetwork in population.adnetwork_names})
+    waterfall = make_waterfall(4, users=observed)
+    factors = optimize_factors(population, waterfall, {adnetwork: 1 for adnetwork in population.adnetwork_names},
+                               n_rounds=n_rounds, tol=tol)
+
+    assert factors == optimize_factors_per_grid_point(population, waterfall, n_rounds, tol)
+    one_round = optimize_factors_per_grid_point(population, waterfall, 1, 0)
+    if n_rounds == 1 or tol == np.inf:  # the second round cannot improve by more than tol
+        assert factors == one_round
+    else:
+        assert get_objective(population, waterfall, factors) < get_objective(population, waterfall, one_round)
@@ -0,0 +1,77 @@
+import copy
+import pickle
+
+import numpy as np
+
+
+
+def get_ladder(waterfall):
+    return [(ad_unit.ad_unit_id, ad_unit.price, ad_unit.order) for ad_unit in waterfall.ad_units]
+
+
+def edit(waterfall, changes):
+    ad_units = list(waterfall.ad_units)
+    for change, position, price in changes:
+        ad_unit = ad_units[position]
+        if change == 'price':
+            waterfall.set_ad_unit_price(ad_unit, price)
+        elif change == 'remove':
+            waterfall.remove_ad_unit(ad_unit)
+        else:
+            waterfall.add_ad_unit(ad_unit)
+
+
+def test_edit_matches_sequential_edits(make_population, make_waterfall):
+    users = make_population(200, seed=1)
+    changes = [('price', 0, 7), ('remove', 1, None), ('add', 1, None), ('price', 1, 41), ('remove', 2, None),
+               ('price', 0, 50)]
+    waterfall = make_waterfall(3, users=users)
+    sequential = copy.deepcopy(waterfall)
+
+    edit(sequential, changes)
+    with waterfall.edit():
+        edit(waterfall, changes)
+
+    assert len(waterfall.ad_units) == 2
+    assert get_ladder(waterfall) == get_ladder(sequential)
+    assert waterfall.ad_units_by_id.keys() == sequential.ad_units_by_id.keys()
+    assert waterfall.get_adnetworks_capacities() == sequential.get_adnetworks_capacities()
+
+
+def test_ad_units_in_waterfall_order(make_population, make_waterfall):
+    users = make_population(200, seed=2)
+    rng = np.random.default_rng(0)
+    waterfall = make_waterfall(6, users=users)
+    for _ in range(20):
+        ad_units = list(waterfall.ad_units)
+        with waterfall.edit():
+            for ad_unit in rng.choice(ad_units, size=2, replace=False):
+                waterfall.set_ad_unit_price(ad_unit, int(rng.integers(1, 60)))
+        reordered = copy.deepcopy(waterfall)
+        reordered.reorder()
+
+        assert get_ladder(waterfall) == get_ladder(reordered)
+        assert all(waterfall.ad_units.get_position(ad_unit.ad_unit_id) == i
+                   for i, ad_unit in enumerate(waterfall.ad_units))
+
+
+def check_index(ad_units):
+    assert ad_units.positions == {ad_unit.ad_unit_id: i for i, ad_unit in enumerate(ad_units)}
+    assert ad_units.rises == sum(ad_units[i].price < ad_units[i + 1].price for i in range(len(ad_units) - 1))
+    assert ad_units.numbered == all(ad_unit.order == i + 1 for i, ad_unit in enumerate(ad_units))
+
+
+def test_list_mutators_keep_the_index(make_population, make_waterfall):
+    waterfall = make_waterfall(6, users=make_population(200, seed=3))
+    ad_units = waterfall.ad_units
+    first, last = ad_units[0], ad_units[-1]
+    mutations = [lambda: ad_units.pop(0), lambda: ad_units.append(first), lambda: ad_units.remove(last),
+                 lambda: ad_units.insert(1, last), lambda: ad_units.sort(key=lambda ad_unit: ad_unit.price),
+                 lambda: ad_units.reverse(), lambda: ad_units.__setitem__(slice(0, 2), ad_units[1::-1]),
+                 lambda: ad_units.__delitem__(2), lambda: ad_units.extend([ad_units.pop()])]
+    for mutation in mutations:
+        mutation()
+        check_index(ad_units)
+    for copied in (copy.deepcopy(ad_units), pickle.loads(pickle.dumps(ad_units))):
+        check_index(copied)
+        assert [ad_unit.ad_unit_id for ad_unit in copied] == [ad_unit.ad_unit_id for ad_unit in ad_units]